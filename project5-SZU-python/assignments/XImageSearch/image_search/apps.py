@@ -18,6 +18,7 @@ class ImageSearchConfig(AppConfig):
         try:
             from .views import get_engine
 
+            # 只预热默认图库，其他图库在第一次请求时加载（模型已共享，只需加载特征）
             engine = get_engine()
             engine.warmup(do_embed=bool(getattr(settings, "ENGINE_WARMUP_EMBED", False)))
         except Exception:
@@ -0,0 +1,111 @@
+"""
+ViT 前向的微批调度：并发请求各自预处理好 (1, 3, 224, 224) 的张量后提交，
+调度线程在 window_ms 窗口内（或攒满 max_batch）把它们拼成一个 batch 做一次前向，再把每行结果分回各自的 Future。
+
+- 第一个请求到达后才开始计时，空闲时不轮询；窗口内没有其他请求时单张直接前向，最多多等 window_ms
+- 整批前向失败（如 batch 维固定为 1 的 ONNX 模型）时逐张重试，单张的异常只影响它自己的 Future
+- embed() 等待超时会取消自己的 Future；已取消/已完成的 Future 不再回填，调度线程不会因此退出
+- stats() 给出批大小分布、平均填充率、排队等待和前向耗时
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+class EmbedBatcher:
+    def __init__(self, forward: Callable[[np.ndarray], np.ndarray], window_ms: float = 10.0, max_batch: int = 8):
+        self.forward = forward
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._queue: "queue.SimpleQueue[Tuple[np.ndarray, Future, float]]" = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._sizes = [0] * (self.max_batch + 1)
+        self._wait_s = 0.0
+        self._wait_max_s = 0.0
+        self._forward_s = 0.0
+        self._worker = threading.Thread(target=self._loop, name="embed-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, x: np.ndarray) -> Future:
+        """x: (1, C, H, W)，返回的 Future 结果为该张图的前向输出（一维）。"""
+        fut: Future = Future()
+        self._queue.put((x, fut, time.perf_counter()))
+        return fut
+
+    def embed(self, x: np.ndarray, timeout: Optional[float] = 60.0) -> np.ndarray:
+        fut = self.submit(x)
+        try:
+            return fut.result(timeout)
+        except FutureTimeout:
+            fut.cancel()
+            raise TimeoutError(f"embedding did not finish within {timeout}s ({self._queue.qsize()} queued)")
+
+    def _collect(self) -> List[Tuple[np.ndarray, Future, float]]:
+        items = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(items) < self.max_batch:
+            left = deadline - time.perf_counter()
+            try:
+                items.append(self._queue.get(timeout=left) if left > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _loop(self) -> None:
+        while True:
+            # 等待方超时取消的请求不再前向
+            items = [it for it in self._collect() if it[1].set_running_or_notify_cancel()]
+            if not items:
+                continue
+            t0 = time.perf_counter()
+            try:
+                V = np.asarray(self.forward(np.concatenate([x for x, _, _ in items], axis=0)))
+            except Exception:
+                for x, fut, _ in items:
+                    try:
+                        v = np.asarray(self.forward(x))[0]
+                    except Exception as e:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    else:
+                        if not fut.done():
+                            fut.set_result(v)
+            else:
+                for i, (_, fut, _) in enumerate(items):
+                    if not fut.done():
+                        fut.set_result(V[i])
+            t1 = time.perf_counter()
+
+            waits = [t0 - t for _, _, t in items]
+            with self._lock:
+                self._sizes[len(items)] += 1
+                self._wait_s += sum(waits)
+                self._wait_max_s = max(self._wait_max_s, max(waits))
+                self._forward_s += t1 - t0
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = list(self._sizes)
+            wait_s, wait_max_s, forward_s = self._wait_s, self._wait_max_s, self._forward_s
+        batches = sum(sizes)
+        items = sum(n * c for n, c in enumerate(sizes))
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": batches,
+            "items": items,
+            "batch_sizes": {str(n): c for n, c in enumerate(sizes) if c},
+            "avg_batch": items / batches if batches else 0.0,
+            "fill_ratio": items / (batches * self.max_batch) if batches else 0.0,
+            "avg_wait_ms": 1000.0 * wait_s / items if items else 0.0,
+            "max_wait_ms": 1000.0 * wait_max_s,
+            "avg_forward_ms": 1000.0 * forward_s / batches if batches else 0.0,
+            "pending": self._queue.qsize(),
+        }
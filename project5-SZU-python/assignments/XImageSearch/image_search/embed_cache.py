@@ -0,0 +1,135 @@
+"""
+持久化的 query embedding 缓存：SQLite（WAL）单文件，同机所有 worker 进程共享，重启后仍然有效。
+
+- key = (图片 sha256, tag)，tag 由模型权重指纹和检索空间（PCA）组成，换权重/换投影后旧向量自然不再命中
+- 向量以 float32 BLOB 存储；按最近使用时间做 LRU，总大小超过 max_bytes 时删掉最久未用的约 10%
+- 命中时只在距上次记录超过 touch_interval 秒才回写使用时间，读多的场景下不会每次命中都写库
+- stats() 给出本进程的命中率和库内条目数/大小
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    sha TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    dim INTEGER NOT NULL,
+    vec BLOB NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (sha, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used);
+"""
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_bytes: int = 256 << 20, touch_interval: float = 60.0, evict_every: int = 64):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max(0, int(max_bytes))
+        self.touch_interval = float(touch_interval)
+        self.evict_every = max(1, int(evict_every))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._puts = 0
+        self._evicted = 0
+        with self._conn() as db:
+            db.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程共用，每个线程一个
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, sha: str, tag: str) -> Optional[np.ndarray]:
+        try:
+            db = self._conn()
+            row = db.execute("SELECT dim, vec, used FROM embeddings WHERE sha = ? AND tag = ?", (sha, tag)).fetchone()
+            if row is not None:
+                now = time.time()
+                if now - row[2] > self.touch_interval:
+                    db.execute("UPDATE embeddings SET used = ? WHERE sha = ? AND tag = ?", (now, sha, tag))
+        except sqlite3.Error:
+            row = None
+        with self._lock:
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        dim, blob = int(row[0]), row[1]
+        if len(blob) != dim * 4:
+            return None
+        return np.frombuffer(blob, dtype=np.float32).copy()
+
+    def put(self, sha: str, tag: str, vec: np.ndarray) -> None:
+        v = np.ascontiguousarray(vec, dtype=np.float32).reshape(-1)
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO embeddings (sha, tag, dim, vec, used) VALUES (?, ?, ?, ?, ?)",
+                (sha, tag, int(v.shape[0]), v.tobytes(), time.time()),
+            )
+        except sqlite3.Error:
+            return
+        with self._lock:
+            self._puts += 1
+            check = self._puts % self.evict_every == 0
+        if check:
+            self.evict()
+
+    def evict(self) -> int:
+        """总大小超过 max_bytes 时按 LRU 删到 90% 以下，返回删除条数。"""
+        if self.max_bytes <= 0:
+            return 0
+        try:
+            db = self._conn()
+            n, total = db.execute("SELECT COUNT(*), COALESCE(SUM(dim), 0) * 4 FROM embeddings").fetchone()
+            if total <= self.max_bytes or not n:
+                return 0
+            drop = int(n - n * (0.9 * self.max_bytes / total)) + 1
+            db.execute(
+                "DELETE FROM embeddings WHERE (sha, tag) IN "
+                "(SELECT sha, tag FROM embeddings ORDER BY used LIMIT ?)",
+                (drop,),
+            )
+        except sqlite3.Error:
+            return 0
+        with self._lock:
+            self._evicted += drop
+        return drop
+
+    def stats(self) -> dict:
+        try:
+            n, total = self._conn().execute(
+                "SELECT COUNT(*), COALESCE(SUM(dim), 0) * 4 FROM embeddings").fetchone()
+        except sqlite3.Error:
+            n, total = None, None
+        with self._lock:
+            hits, misses, puts, evicted = self._hits, self._misses, self._puts, self._evicted
+        lookups = hits + misses
+        return {
+            "path": self.path,
+            "entries": n,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "puts": puts,
+            "evicted": evicted,
+        }
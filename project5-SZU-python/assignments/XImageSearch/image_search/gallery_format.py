@@ -0,0 +1,498 @@
+"""
+单文件图库索引格式（.idx），整体 mmap 打开，不解析任何行：
+
+    [header, 4096 bytes]
+        magic(8s) version(u32) dim(u32) count(u64) flags(u32) reserved(u32)
+        feat_offset(u64) offsets_offset(u64) blob_offset(u64) blob_size(u64)
+        fingerprint(64s)
+    [features]  float32 (count, dim)，4096 对齐，可直接作为 ndarray 视图
+    [offsets]   int64 (count + 1)，路径 i 的字节范围为 blob[offsets[i]:offsets[i+1]]
+    [blob]      UTF-8 路径字节（相对 gallery root，统一用 "/" 分隔）
+
+在线增删写在单独的增量段 sidecar（.npz）里，见 write_delta / read_delta；改写增量段和合并进 base 时
+多个进程用 gallery_lock 互斥。
+
+离线 kNN 图（build_knn.py 生成）同样是 4096 字节头 + mmap 视图：
+    [header] magic(8s) version(u32) k(u32) count(u64) ids_offset(u64) scores_offset(u64) tag(64s)
+    [ids]    int32 (count, k)，每行按分数降序，不含自身
+    [scores] float16 (count, k)
+
+ANN 倒排索引（IVF，build_ivf.py 生成），同样整体 mmap：
+    [header] magic(8s) version(u32) dim(u32) count(u64) nlist(u64) centroids_offset(u64) lists_offset(u64)
+             ids_offset(u64) codes_offset(u64) table_offset(u64) table_size(u64) tag(64s)
+    [centroids] float32 (nlist, dim)，聚类中心（已归一化）
+    [lists]     int64 (nlist + 1)，第 l 个倒排表是 ids/codes 的 [lists[l], lists[l+1]) 段
+    [ids]       int32 (count)，按倒排表排列的 base 行号
+    [codes]     float16 (count, dim)，与 ids 同序的特征副本，用于粗排
+    [table]     UTF-8 JSON，离线调参得到的 Pareto 表（nprobe / rerank -> recall、延迟），可为空
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+import threading
+import contextlib
+from array import array
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有 flock，只剩进程内的锁
+    fcntl = None
+
+
+MAGIC = b"XIMGIDX\0"
+FORMAT_VERSION = 1
+FLAG_NORMALIZED = 1
+
+_HEADER = struct.Struct("<8sIIQIIQQQQ64s")
+
+KNN_MAGIC = b"XIMGKNN\0"
+KNN_VERSION = 1
+_KNN_HEADER = struct.Struct("<8sIIQQQ64s")
+IVF_MAGIC = b"XIMGIVF\0"
+IVF_VERSION = 1
+_IVF_HEADER = struct.Struct("<8sIIQQQQQQQQ64s")
+_ALIGN = 4096
+
+
+def _align(n: int, a: int = _ALIGN) -> int:
+    return (n + a - 1) // a * a
+
+
+def model_fingerprint(weights_path: Optional[str]) -> str:
+    """权重文件指纹：大小 + 首尾各 1MiB 的 sha256（几百 MB 的权重也只读 2MiB）。"""
+    if not weights_path or not os.path.exists(weights_path):
+        return ""
+    size = os.path.getsize(weights_path)
+    h = hashlib.sha256(str(size).encode("ascii"))
+    with open(weights_path, "rb") as f:
+        h.update(f.read(1 << 20))
+        if size > (2 << 20):
+            f.seek(-(1 << 20), os.SEEK_END)
+            h.update(f.read(1 << 20))
+    return h.hexdigest()[:32]
+
+
+@dataclass(frozen=True)
+class GalleryHeader:
+    version: int
+    dim: int
+    count: int
+    normalized: bool
+    fingerprint: str
+
+
+class PathTable(Sequence):
+    """紧凑路径表：一块连续字节 + int64 偏移数组，按需解码单条路径。"""
+
+    def __init__(self, offsets: np.ndarray, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    @classmethod
+    def from_strings(cls, paths: Iterable[str]) -> "PathTable":
+        blob = bytearray()
+        offsets = array("q", [0])
+        for p in paths:
+            blob += p.encode("utf-8")
+            offsets.append(len(blob))
+        return cls(np.frombuffer(offsets, dtype=np.int64), bytes(blob))
+
+    def truncate(self, n: int) -> "PathTable":
+        return PathTable(self.offsets[:max(0, int(n)) + 1], self.blob)
+
+    def slice(self, lo: int, hi: int) -> "PathTable":
+        """第 lo..hi 行（共享同一块字节，偏移保持绝对值）。"""
+        return PathTable(self.offsets[int(lo):int(hi) + 1], self.blob)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets.nbytes) + len(self.blob)
+
+    def __len__(self) -> int:
+        return max(0, int(self.offsets.shape[0]) - 1)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return bytes(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]).decode("utf-8")
+
+    def prefix_rows(self, prefix: str) -> np.ndarray:
+        """
+        路径以 prefix 开头的行号（升序）。逐字节在 offsets 起点上向量化比较，不解码任何路径；
+        prefix 里的 "/" 同时匹配 Windows 的 "\\"。
+        """
+        n = len(self)
+        needle = prefix.encode("utf-8")
+        starts = np.asarray(self.offsets[:n], dtype=np.int64)
+        ok = (np.asarray(self.offsets[1:n + 1], dtype=np.int64) - starts) >= len(needle)
+        blob = self.blob if isinstance(self.blob, np.ndarray) else np.frombuffer(self.blob, dtype=np.uint8)
+        for j, ch in enumerate(needle):
+            rows = np.flatnonzero(ok)
+            if rows.size == 0:
+                break
+            c = blob[starts[rows] + j]
+            hit = (c == ch) | (c == 0x5C) if ch == 0x2F else (c == ch)
+            ok[rows[~hit]] = False
+        return np.flatnonzero(ok).astype(np.int64)
+
+    def checksum(self) -> str:
+        """整张表的内容 CRC32（各行长度 + 路径字节）：只跟路径和顺序有关，和文件的 mtime、存放位置无关。"""
+        n = len(self)
+        if n == 0:
+            return "00000000"
+        offsets = np.ascontiguousarray(self.offsets, dtype=np.int64)
+        crc = zlib.crc32(np.diff(offsets).astype("<i8").tobytes())
+        crc = zlib.crc32(memoryview(self.blob)[int(offsets[0]):int(offsets[n])], crc)
+        return f"{crc:08x}"
+
+    def _hash_index(self):
+        """(排好序的路径 CRC32, 对应行号)：每张表第一次反查时建一次（100 万行约 0.5 秒、12 MB），之后复用。"""
+        idx = self._index
+        if idx is None:
+            with self._index_lock:
+                idx = self._index
+                if idx is None:
+                    mv = memoryview(self.blob)
+                    bounds = np.asarray(self.offsets, dtype=np.int64).tolist()
+                    hashes = np.fromiter((zlib.crc32(mv[a:b]) for a, b in zip(bounds, bounds[1:])),
+                                         dtype=np.uint32, count=len(self))
+                    order = np.argsort(hashes, kind="stable")
+                    idx = self._index = (hashes[order], order.astype(np.int64))
+        return idx
+
+    def find_many(self, paths: Iterable[str]) -> np.ndarray:
+        """按路径反查行号（找不到为 -1）：查 CRC32 索引，再比对该行字节排除碰撞；不复制、不扫描整块字节。"""
+        hashes, rows = self._hash_index()
+        mv = memoryview(self.blob)
+        offsets = self.offsets
+        out = []
+        for p in paths:
+            needle = p.encode("utf-8")
+            h = np.uint32(zlib.crc32(needle))
+            lo = int(np.searchsorted(hashes, h, side="left"))
+            hi = int(np.searchsorted(hashes, h, side="right"))
+            row = -1
+            for i in rows[lo:hi].tolist():
+                if mv[int(offsets[i]):int(offsets[i + 1])] == needle:
+                    row = i
+                    break
+            out.append(row)
+        return np.asarray(out, dtype=np.int64)
+
+
+class GalleryFile:
+    """只读打开 .idx：header 校验 + 特征/路径表都是同一个 mmap 上的零拷贝视图。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        mm = np.memmap(path, dtype=np.uint8, mode="r")
+        if mm.shape[0] < _HEADER.size:
+            raise ValueError("gallery file too small")
+
+        (magic, version, dim, count, flags, _reserved,
+         feat_off, offsets_off, blob_off, blob_size, fp) = _HEADER.unpack(bytes(mm[:_HEADER.size]))
+        if magic != MAGIC:
+            raise ValueError(f"bad gallery file magic: {magic!r}")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"unsupported gallery file version: {version}")
+        if blob_off + blob_size > mm.shape[0]:
+            raise ValueError("gallery file truncated")
+
+        self.header = GalleryHeader(
+            version=int(version),
+            dim=int(dim),
+            count=int(count),
+            normalized=bool(flags & FLAG_NORMALIZED),
+            fingerprint=fp.rstrip(b"\0").decode("ascii", errors="ignore"),
+        )
+        self.features = mm[feat_off:feat_off + count * dim * 4].view(np.float32).reshape(int(count), int(dim))
+        self.paths = PathTable(
+            mm[offsets_off:offsets_off + (count + 1) * 8].view(np.int64),
+            mm[blob_off:blob_off + blob_size],
+        )
+
+
+def write_gallery_file(
+    path: str,
+    feats: np.ndarray,
+    paths: Iterable[str],
+    fingerprint: str = "",
+    normalize: bool = True,
+    chunk_rows: int = 65536,
+) -> GalleryHeader:
+    """
+    写出 .idx（先写临时文件再原子替换）。feats 可以是 memmap，按 chunk_rows 分块写入。
+    normalize=True 时按行 L2 归一化并在 header 中置位，Web 端可直接 mmap 检索。
+    """
+    if feats.ndim != 2:
+        raise ValueError(f"bad features shape: {feats.shape}")
+    count, dim = int(feats.shape[0]), int(feats.shape[1])
+
+    encoded = [p.replace("\\", "/").encode("utf-8") for p in paths]
+    if len(encoded) != count:
+        raise ValueError(f"paths/features length mismatch: {len(encoded)} != {count}")
+    offsets = np.zeros((count + 1,), dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+    blob = b"".join(encoded)
+
+    feat_off = _ALIGN
+    offsets_off = _align(feat_off + count * dim * 4, 64)
+    blob_off = offsets_off + offsets.nbytes
+    flags = FLAG_NORMALIZED if normalize else 0
+
+    header = _HEADER.pack(
+        MAGIC, FORMAT_VERSION, dim, count, flags, 0,
+        feat_off, offsets_off, blob_off, len(blob),
+        (fingerprint or "").encode("ascii")[:64],
+    )
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.write(b"\0" * (feat_off - len(header)))
+        for i in range(0, count, chunk_rows):
+            x = np.asarray(feats[i:i + chunk_rows], dtype=np.float32)
+            if normalize:
+                x = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+            f.write(np.ascontiguousarray(x, dtype=np.float32).tobytes())
+        f.write(b"\0" * (offsets_off - (feat_off + count * dim * 4)))
+        f.write(offsets.tobytes())
+        f.write(blob)
+    os.replace(tmp, path)
+
+    return GalleryHeader(FORMAT_VERSION, dim, count, bool(normalize), fingerprint or "")
+
+
+@dataclass(frozen=True)
+class DeltaSegment:
+    features: np.ndarray  # (m, D) float32，原始空间（已归一化、未做 PCA 投影），和 base 文件一致
+    paths: List[str]      # 新增图片的相对路径
+    deleted: List[str]    # 被删除的 base 图片路径（墓碑）
+    tag: str              # 特征所在空间，目前只写 "raw"；其他取值（旧版写的投影后特征）加载时作废
+
+
+def read_delta(path: str) -> DeltaSegment:
+    with np.load(path, allow_pickle=False) as z:
+        return DeltaSegment(
+            features=np.asarray(z["feats"], dtype=np.float32),
+            paths=[str(p) for p in z["paths"]],
+            deleted=[str(p) for p in z["deleted"]],
+            tag=str(z["tag"]),
+        )
+
+
+@contextlib.contextmanager
+def gallery_lock(path: str):
+    """
+    进程间互斥锁：对 path + ".lock" 加 fcntl.flock(LOCK_EX)，退出 with 时释放（进程崩溃时内核自动释放）。
+    所有改写增量段 / 合并 base 的进程都要先拿这把锁，读-改-写之间不会互相覆盖。
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a+b") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def write_delta(path: str, feats: np.ndarray, paths: Sequence[str], deleted: Sequence[str], tag: str = "raw") -> None:
+    """写增量段（先写临时文件再原子替换，watcher 不会读到写了一半的文件）。"""
+    feats = np.asarray(feats, dtype=np.float32)
+    if feats.ndim != 2 or feats.shape[0] != len(paths):
+        raise ValueError(f"paths/features length mismatch: {len(paths)} != {feats.shape}")
+    tmp = path + ".tmp.npz"
+    np.savez(
+        tmp,
+        feats=feats,
+        paths=np.asarray(list(paths), dtype=np.str_),
+        deleted=np.asarray(list(deleted), dtype=np.str_),
+        tag=np.asarray(tag or "raw"),
+    )
+    os.replace(tmp, path)
+
+
+class KnnGraph:
+    """只读打开 kNN 图：ids/scores 都是同一个 mmap 上的零拷贝视图，取一行邻居只读 k 个元素。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        mm = np.memmap(path, dtype=np.uint8, mode="r")
+        if mm.shape[0] < _KNN_HEADER.size:
+            raise ValueError("knn file too small")
+
+        magic, version, k, count, ids_off, scores_off, tag = _KNN_HEADER.unpack(bytes(mm[:_KNN_HEADER.size]))
+        if magic != KNN_MAGIC:
+            raise ValueError(f"bad knn file magic: {magic!r}")
+        if version != KNN_VERSION:
+            raise ValueError(f"unsupported knn file version: {version}")
+        if scores_off + count * k * 2 > mm.shape[0]:
+            raise ValueError("knn file truncated")
+
+        self.k = int(k)
+        self.count = int(count)
+        self.tag = tag.rstrip(b"\0").decode("ascii", errors="ignore")
+        self.ids = mm[ids_off:ids_off + count * k * 4].view(np.int32).reshape(self.count, self.k)
+        self.scores = mm[scores_off:scores_off + count * k * 2].view(np.float16).reshape(self.count, self.k)
+
+
+def write_knn_graph(path: str, count: int, k: int, blocks: Iterable[tuple], tag: str = "") -> None:
+    """
+    写 kNN 图：blocks 依次产出 (ids (b, k), scores (b, k))，按行号顺序覆盖全部 count 行。
+    输出文件预先分配后以 memmap 逐块填充，内存只占一个块；先写临时文件再原子替换。
+    """
+    count, k = int(count), int(k)
+    if count <= 0 or k <= 0:
+        raise ValueError(f"bad knn shape: ({count}, {k})")
+    ids_off = _ALIGN
+    scores_off = _align(ids_off + count * k * 4, 64)
+    size = scores_off + count * k * 2
+
+    tmp = path + ".tmp"
+    mm = np.memmap(tmp, dtype=np.uint8, mode="w+", shape=(size,))
+    header = _KNN_HEADER.pack(KNN_MAGIC, KNN_VERSION, k, count, ids_off, scores_off, (tag or "").encode("ascii")[:64])
+    mm[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+    ids = mm[ids_off:ids_off + count * k * 4].view(np.int32).reshape(count, k)
+    scores = mm[scores_off:size].view(np.float16).reshape(count, k)
+
+    row = 0
+    for bi, bs in blocks:
+        b = int(bi.shape[0])
+        ids[row:row + b] = bi
+        scores[row:row + b] = bs
+        row += b
+    if row != count:
+        raise ValueError(f"knn blocks covered {row} rows, expected {count}")
+    mm.flush()
+    del ids, scores, mm  # Windows 上替换前必须先关闭 mmap
+    os.replace(tmp, path)
+
+
+class IvfIndex:
+    """只读打开 IVF 倒排索引：centroids/lists 很小直接读入内存，ids/codes 是 mmap 视图。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        mm = np.memmap(path, dtype=np.uint8, mode="r")
+        if mm.shape[0] < _IVF_HEADER.size:
+            raise ValueError("ivf file too small")
+
+        (magic, version, dim, count, nlist, cent_off, lists_off, ids_off, codes_off,
+         table_off, table_size, tag) = _IVF_HEADER.unpack(bytes(mm[:_IVF_HEADER.size]))
+        if magic != IVF_MAGIC:
+            raise ValueError(f"bad ivf file magic: {magic!r}")
+        if version != IVF_VERSION:
+            raise ValueError(f"unsupported ivf file version: {version}")
+        if codes_off + count * dim * 2 > mm.shape[0] or table_off + table_size > mm.shape[0]:
+            raise ValueError("ivf file truncated")
+
+        self.dim = int(dim)
+        self.count = int(count)
+        self.nlist = int(nlist)
+        self.tag = tag.rstrip(b"\0").decode("ascii", errors="ignore")
+        self.table_offset = int(table_off)
+        self.centroids = np.array(mm[cent_off:cent_off + nlist * dim * 4].view(np.float32).reshape(self.nlist, self.dim))
+        self.lists = np.array(mm[lists_off:lists_off + (nlist + 1) * 8].view(np.int64))
+        self.ids = mm[ids_off:ids_off + count * 4].view(np.int32)
+        self.codes = mm[codes_off:codes_off + count * dim * 2].view(np.float16).reshape(self.count, self.dim)
+        self.table: dict = json.loads(bytes(mm[table_off:table_off + table_size]).decode("utf-8")) if table_size else {}
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + self.ids.nbytes + self.centroids.nbytes + self.lists.nbytes)
+
+
+def write_ivf_index(
+    path: str,
+    centroids: np.ndarray,
+    lists: np.ndarray,
+    blocks: Iterable[tuple],
+    tag: str = "",
+    table: Optional[dict] = None,
+) -> None:
+    """
+    写 IVF 索引：lists 为 (nlist + 1) 的倒排表边界，blocks 按倒排表顺序依次产出 (ids (b,), features (b, dim))。
+    codes 以 float16 保存；与 write_knn_graph 一样 memmap 逐块填充，先写临时文件再原子替换。
+    """
+    centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+    lists = np.ascontiguousarray(lists, dtype=np.int64)
+    nlist, dim = (int(x) for x in centroids.shape)
+    count = int(lists[-1])
+    if count <= 0 or lists.shape[0] != nlist + 1:
+        raise ValueError(f"bad ivf lists: nlist={nlist} count={count}")
+    table_bytes = json.dumps(table, ensure_ascii=False).encode("utf-8") if table else b""
+
+    cent_off = _ALIGN
+    lists_off = _align(cent_off + centroids.nbytes, 64)
+    ids_off = _align(lists_off + lists.nbytes, 64)
+    codes_off = _align(ids_off + count * 4, 64)
+    table_off = codes_off + count * dim * 2
+    size = table_off + len(table_bytes)
+
+    tmp = path + ".tmp"
+    mm = np.memmap(tmp, dtype=np.uint8, mode="w+", shape=(size,))
+    header = _IVF_HEADER.pack(IVF_MAGIC, IVF_VERSION, dim, count, nlist, cent_off, lists_off, ids_off, codes_off,
+                              table_off, len(table_bytes), (tag or "").encode("ascii")[:64])
+    mm[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+    mm[cent_off:cent_off + centroids.nbytes] = np.frombuffer(centroids.tobytes(), dtype=np.uint8)
+    mm[lists_off:lists_off + lists.nbytes] = np.frombuffer(lists.tobytes(), dtype=np.uint8)
+    ids = mm[ids_off:ids_off + count * 4].view(np.int32)
+    codes = mm[codes_off:table_off].view(np.float16).reshape(count, dim)
+    if table_bytes:
+        mm[table_off:size] = np.frombuffer(table_bytes, dtype=np.uint8)
+
+    row = 0
+    for bi, bf in blocks:
+        b = int(bi.shape[0])
+        ids[row:row + b] = bi
+        codes[row:row + b] = bf
+        row += b
+    if row != count:
+        raise ValueError(f"ivf blocks covered {row} rows, expected {count}")
+    mm.flush()
+    del ids, codes, mm  # Windows 上替换前必须先关闭 mmap
+    os.replace(tmp, path)
+
+
+def write_ivf_table(path: str, table: dict) -> None:
+    """
+    只替换 IVF 文件末尾的 Pareto 表：把表之前的部分原样拷到临时文件，写新表、改头部，再原子替换。
+    正在读旧文件（mmap）的进程不受影响，其他 worker 通过 watcher 看到 mtime/size 变化后重新加载。
+    """
+    ivf = IvfIndex(path)
+    table_off = ivf.table_offset
+    del ivf
+
+    data = json.dumps(table, ensure_ascii=False).encode("utf-8")
+    tmp = path + ".tmp"
+    with open(path, "rb") as src, open(tmp, "wb") as f:
+        head = _IVF_HEADER.unpack(src.read(_IVF_HEADER.size))
+        f.write(_IVF_HEADER.pack(*head[:10], len(data), head[11]))
+        left = table_off - _IVF_HEADER.size
+        while left > 0:
+            buf = src.read(min(left, 16 << 20))
+            if not buf:
+                raise ValueError("ivf file truncated")
+            f.write(buf)
+            left -= len(buf)
+        f.write(data)
+    os.replace(tmp, path)
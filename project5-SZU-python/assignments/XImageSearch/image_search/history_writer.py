@@ -0,0 +1,163 @@
+"""
+历史记录的 write-behind 持久化：检索任务把要写的记录交给专用写线程后立即返回，
+写线程把攒到的多条记录放进同一个事务提交（SQLite 只有一个写者，多条记录只占一次写锁、一次提交）。
+
+- 第一条到达后才开始计时，在 window_ms 窗口内（或攒满 max_batch）收集更多，空闲时不轮询
+- 整批写入失败时逐条重试，单条的异常交给 on_error，不影响同批其他记录
+- 队列有界：排队的记录达到 max_pending 时 submit() 返回 False，由调用方同步写库（backlogged 供准入检查用）
+- flush() 等到此前提交的记录全部写完；close() 停止接收并把队列里剩下的写完（进程正常退出时由 atexit 调用）
+- stats() 给出批大小、排队等待和写入耗时
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+_STOP = object()
+
+
+class HistoryWriter:
+    def __init__(
+        self,
+        write: Callable[[list], None],
+        window_ms: float = 20.0,
+        max_batch: int = 64,
+        on_error: Optional[Callable[[object, BaseException], None]] = None,
+        max_pending: int = 1024,
+    ):
+        self.write = write
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self.max_pending = max(1, int(max_pending))
+        self.on_error = on_error
+        self._queue: "queue.SimpleQueue[Tuple[object, float]]" = queue.SimpleQueue()
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._closed = False
+        self._batches = 0
+        self._items = 0
+        self._failed = 0
+        self._retried_batches = 0
+        self._rejected = 0
+        self._wait_s = 0.0
+        self._wait_max_s = 0.0
+        self._write_s = 0.0
+        self._worker = threading.Thread(target=self._loop, name="history-writer", daemon=True)
+        self._worker.start()
+
+    def submit(self, item) -> bool:
+        """交给写线程；队列已满时不入队并返回 False（调用方自己同步写）。关闭后抛 RuntimeError。"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("history writer is closed")
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                return False
+            self._pending += 1
+        self._queue.put((item, time.perf_counter()))
+        return True
+
+    @property
+    def backlogged(self) -> bool:
+        """排队的记录已达上限：写库跟不上检索，新任务应当限流。"""
+        with self._cond:
+            return self._pending >= self.max_pending
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等此前 submit 的记录全部写完（或失败）；超时返回 False。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """停止接收新记录，写完队列里剩下的再让写线程退出；返回是否在 timeout 内写完。"""
+        with self._cond:
+            if not self._closed:
+                self._closed = True
+                self._queue.put((_STOP, 0.0))
+        self._worker.join(timeout)
+        return not self._worker.is_alive()
+
+    def _collect(self) -> Tuple[List[Tuple[object, float]], bool]:
+        first = self._queue.get()
+        if first[0] is _STOP:
+            return [], True
+        items = [first]
+        deadline = time.perf_counter() + self.window
+        while len(items) < self.max_batch:
+            left = deadline - time.perf_counter()
+            try:
+                nxt = self._queue.get(timeout=left) if left > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if nxt[0] is _STOP:
+                # 关闭前已提交的记录都在 STOP 之前，这一批写完就退出
+                return items, True
+            items.append(nxt)
+        return items, False
+
+    def _loop(self) -> None:
+        stop = False
+        while not stop:
+            items, stop = self._collect()
+            if not items:
+                continue
+            t0 = time.perf_counter()
+            batch = [item for item, _ in items]
+            failed = 0
+            retried = False
+            try:
+                self.write(batch)
+            except Exception:
+                retried = True
+                for item in batch:
+                    try:
+                        self.write([item])
+                    except Exception as e:
+                        failed += 1
+                        if self.on_error is not None:
+                            try:
+                                self.on_error(item, e)
+                            except Exception:
+                                pass
+            t1 = time.perf_counter()
+
+            waits = [t0 - t for _, t in items]
+            with self._cond:
+                self._batches += 1
+                self._items += len(items)
+                self._failed += failed
+                self._retried_batches += int(retried)
+                self._wait_s += sum(waits)
+                self._wait_max_s = max(self._wait_max_s, max(waits))
+                self._write_s += t1 - t0
+                self._pending -= len(items)
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            batches, items = self._batches, self._items
+            return {
+                "window_ms": self.window * 1000.0,
+                "max_batch": self.max_batch,
+                "closed": self._closed,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "rejected": self._rejected,
+                "batches": batches,
+                "items": items,
+                "failed": self._failed,
+                "retried_batches": self._retried_batches,
+                "avg_batch": items / batches if batches else 0.0,
+                "avg_wait_ms": 1000.0 * self._wait_s / items if items else 0.0,
+                "max_wait_ms": 1000.0 * self._wait_max_s,
+                "avg_write_ms": 1000.0 * self._write_s / batches if batches else 0.0,
+            }
@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image_search.views import get_engine
+
+
+class Command(BaseCommand):
+    help = "Embed images and add them to the live gallery delta (searchable without a rebuild)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("images", nargs="+", help="Image files to add")
+        parser.add_argument("--gallery", type=str, default="", help="Gallery id (default: DEFAULT_GALLERY)")
+
+    def handle(self, *args, **options):
+        items = []
+        for path in options["images"]:
+            if not os.path.isfile(path):
+                raise CommandError(f"not a file: {path}")
+            with open(path, "rb") as f:
+                items.append((os.path.basename(path), f.read()))
+
+        try:
+            engine = get_engine(options["gallery"] or None)
+        except KeyError as e:
+            raise CommandError(str(e))
+        try:
+            added = engine.add_images(items)
+        except Exception as e:
+            raise CommandError(str(e))
+        for rel in added:
+            self.stdout.write(rel)
+        self.stdout.write(self.style.SUCCESS(f"Added {len(added)} image(s); gallery version {engine.gallery_version}."))
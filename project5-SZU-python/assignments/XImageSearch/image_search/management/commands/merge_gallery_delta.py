@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image_search.views import get_engine, touch_reload_trigger
+
+
+class Command(BaseCommand):
+    help = "Fold the live gallery delta (new images + tombstones) into the base index files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--every", type=float, default=0, help="Keep running and merge every N seconds (0 = once)")
+        parser.add_argument("--gallery", type=str, default="", help="Gallery id (default: DEFAULT_GALLERY)")
+
+    def handle(self, *args, **options):
+        try:
+            engine = get_engine(options["gallery"] or None)
+        except KeyError as e:
+            raise CommandError(str(e))
+        while True:
+            try:
+                rows = engine.merge_delta()
+            except Exception as e:
+                raise CommandError(str(e))
+            touch_reload_trigger(options["gallery"] or None)
+            self.stdout.write(self.style.SUCCESS(f"Merged; base now has {rows} rows (version {engine.gallery_version})."))
+            if options["every"] <= 0:
+                return
+            time.sleep(options["every"])
+            engine.reload_gallery()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image_search.views import touch_reload_trigger
+
+
+class Command(BaseCommand):
+    help = "Ask every running worker to reload the gallery index (touches GALLERY_RELOAD_TRIGGER)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--gallery", type=str, default="", help="Gallery id (default: DEFAULT_GALLERY)")
+
+    def handle(self, *args, **options):
+        try:
+            touched = touch_reload_trigger(options["gallery"] or None)
+        except KeyError as e:
+            raise CommandError(str(e))
+        if not touched:
+            raise CommandError("No reload trigger is configured for this gallery")
+        self.stdout.write(self.style.SUCCESS("Reload triggered; workers pick it up within GALLERY_WATCH_INTERVAL seconds."))
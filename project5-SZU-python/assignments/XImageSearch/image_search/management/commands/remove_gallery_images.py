@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image_search.views import get_engine
+
+
+class Command(BaseCommand):
+    help = "Remove images from the live gallery (tombstones for base rows, dropped from the delta otherwise)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Gallery-relative paths or /gallery/ URLs")
+        parser.add_argument("--gallery", type=str, default="", help="Gallery id (default: DEFAULT_GALLERY)")
+
+    def handle(self, *args, **options):
+        try:
+            engine = get_engine(options["gallery"] or None)
+        except KeyError as e:
+            raise CommandError(str(e))
+        try:
+            removed = engine.remove_images(options["paths"])
+        except Exception as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} image(s); gallery version {engine.gallery_version}."))
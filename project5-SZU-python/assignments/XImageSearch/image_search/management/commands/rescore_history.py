@@ -0,0 +1,85 @@
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from image_search.models import HistoryRecord
+from image_search.views import (
+    RESULT_FIELDS, _SAVE_LOCK, _result_count, _store_results, _stored_feat, default_gallery, get_engine,
+)
+
+
+class Command(BaseCommand):
+    help = "Re-run every history query from its stored embedding against the current gallery (no image decode, no ViT)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--topk", type=int, default=0, help="Results per record (0 = keep each record's current count)")
+        parser.add_argument("--batch_size", type=int, default=256, help="Records scored per GEMM")
+        parser.add_argument("--gallery", type=str, default="", help="Only rescore records of this gallery (default: all)")
+
+    def handle(self, *args, **options):
+        qs = HistoryRecord.objects.exclude(query_feat=None)
+        galleries = sorted(set(qs.values_list("gallery", flat=True)))
+        if options["gallery"]:
+            # 旧记录 gallery 为空，归属默认图库
+            want = options["gallery"]
+            galleries = [g for g in galleries if (g or default_gallery()) == want]
+
+        for gallery in galleries:
+            try:
+                engine = get_engine(gallery or None)
+            except KeyError:
+                self.stdout.write(self.style.WARNING(f"Skipping records of unknown gallery {gallery!r}."))
+                continue
+            if not engine.ready:
+                raise CommandError(f"Gallery {gallery or default_gallery()} not loaded: {engine.last_error}")
+            ids = list(qs.filter(gallery=gallery).order_by("id").values_list("id", flat=True))
+            self._rescore(engine, ids, options)
+
+    def _rescore(self, engine, ids, options):
+        batch_size = max(1, options["batch_size"])
+        done = skipped = 0
+
+        for b0 in range(0, len(ids), batch_size):
+            recs = list(HistoryRecord.objects.filter(id__in=ids[b0:b0 + batch_size])
+                        .annotate(n_items=Count("items")).order_by("id"))
+            rows, feats, topks = [], [], []
+            for rec in recs:
+                q = _stored_feat(rec, engine)
+                if q is None:
+                    skipped += 1
+                    continue
+                rows.append(rec)
+                feats.append(q)
+                topks.append(max(1, min(options["topk"] or _result_count(rec) or 50, 200)))
+            if not rows:
+                continue
+
+            # 原始维度（PCA 之前）和已投影的向量不能放进同一个矩阵，按维度分组各做一次批量检索
+            by_dim = {}
+            for i, q in enumerate(feats):
+                by_dim.setdefault(q.shape[0], []).append(i)
+            results = [None] * len(rows)
+            for idx in by_dim.values():
+                hits = engine.search_batch(np.stack([feats[i] for i in idx]), topk=max(topks[i] for i in idx))
+                for i, h in zip(idx, hits):
+                    results[i] = h[:topks[i]]
+
+            # 和 api_history_refresh 一样锁住这批记录再写：Web 端可能正在写同一条记录
+            with _SAVE_LOCK, transaction.atomic():
+                locked = HistoryRecord.objects.select_for_update().in_bulk([rec.id for rec in rows])
+                for rec, res in zip(rows, results):
+                    cur = locked.get(rec.id)
+                    if cur is None or cur.query_feat != rec.query_feat:
+                        # 期间被删掉或换了 query，这次的结果作废
+                        skipped += 1
+                        continue
+                    _store_results(cur, res)
+                    cur.save(update_fields=RESULT_FIELDS)
+                    done += 1
+            self.stdout.write(f"  {min(b0 + batch_size, len(ids))}/{len(ids)} records")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rescored {done} record(s) against gallery version {engine.gallery_version}; "
+            f"skipped {skipped} with an incompatible stored embedding or changed meanwhile."
+        ))
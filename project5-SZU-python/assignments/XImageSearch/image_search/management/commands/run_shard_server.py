@@ -0,0 +1,55 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from image_search.shards import ShardServer
+from image_search.views import _build_engine, default_gallery, get_registry, shard_allow_remote, shard_authkey
+
+
+class Command(BaseCommand):
+    help = "Serve one row partition of the gallery to a coordinator (GALLERY_SHARDS) over a Unix socket or TCP."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shard", type=str, required=True, help="Partition as i/n, e.g. 0/4")
+        parser.add_argument("--listen", type=str, required=True, help="unix:/path/to.sock or host:port")
+        parser.add_argument("--gallery", type=str, default="", help="Gallery id (default: DEFAULT_GALLERY)")
+
+    def handle(self, *args, **options):
+        try:
+            i, n = (int(x) for x in options["shard"].split("/"))
+        except ValueError:
+            raise CommandError("--shard must look like i/n")
+        try:
+            authkey = shard_authkey()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        gid = options["gallery"] or default_gallery()
+        try:
+            cfg = dict(get_registry().configs[gid])
+        except KeyError:
+            raise CommandError(f"unknown gallery: {gid}")
+        # 分片只读 base：增量段的行号接在整库之后，各分片各自编号会冲突，在线增删请在合并后重新分片
+        cfg.update(shards=[], delta="")
+        try:
+            engine = _build_engine(gid, cfg, shard=(i, n))
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not engine.ready:
+            raise CommandError(f"Gallery not loaded: {engine.last_error}")
+
+        try:
+            server = ShardServer(engine, options["listen"], authkey, allow_remote=shard_allow_remote())
+        except ValueError as e:
+            engine.close()
+            raise CommandError(str(e))
+
+        g = engine._gallery
+        self.stdout.write(self.style.SUCCESS(
+            f"Shard {i}/{n} of gallery {gid}: rows {g.row_offset}..{g.row_offset + g.size()} on {options['listen']}"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            engine.close()
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.11 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_search', '0009_historyrecord_feat_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historyrecord',
+            name='gallery',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
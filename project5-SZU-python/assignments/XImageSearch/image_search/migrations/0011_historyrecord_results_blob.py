@@ -0,0 +1,23 @@
+# Generated by Django 4.2.11 on 2026-10-19 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_search', '0010_historyrecord_gallery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historyrecord',
+            name='results_blob',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historyrecord',
+            name='results_tag',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -7,6 +7,14 @@ class HistoryRecord(models.Model):
     query_image = models.ImageField(upload_to="queries/", null=True, blank=True)
     query_feat = models.BinaryField(null=True, blank=True, editable=False)
     feat_dim = models.IntegerField(default=0)
+    # query_feat 所在的检索空间（SearchEngine.embedding_tag），PCA 变化后旧向量不能直接复用
+    feat_tag = models.CharField(max_length=64, default="", blank=True)
+    # 检索所用的图库 id（多图库部署），空 = 默认图库
+    gallery = models.CharField(max_length=64, default="", blank=True)
+    # 紧凑结果：按名次排列的 (图库行号 int32, 分数 float32) 对，读取时用图库路径表解析 url；
+    # 行号只在 results_tag 对应的图库快照（SearchEngine.rows_tag）里有效。为空时结果在 HistoryItem 里（旧记录/分片协调端）
+    results_blob = models.BinaryField(null=True, blank=True, editable=False)
+    results_tag = models.CharField(max_length=64, default="", blank=True)
 
     class Meta:
         ordering = ["-id"]
@@ -0,0 +1,96 @@
+"""
+多图库注册表：按 gallery id 懒加载 SearchEngine。
+
+- 模型权重在进程内共享（search_engine._shared_model），新图库只加载自己的特征/路径表
+- 已加载图库的总大小超过预算时，按最近最少使用（LRU）卸载，正在进行的检索持有快照引用不受影响
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .search_engine import SearchEngine
+
+
+class EngineRegistry:
+    def __init__(
+        self,
+        configs: Dict[str, dict],
+        factory: Callable[[str, dict], SearchEngine],
+        budget_bytes: int = 0,
+    ):
+        self.configs = dict(configs)
+        self.factory = factory
+        # 0 = 不限制
+        self.budget_bytes = max(0, int(budget_bytes or 0))
+        self._engines: "OrderedDict[str, SearchEngine]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def ids(self) -> List[str]:
+        return list(self.configs)
+
+    def peek(self, gid: str) -> Optional[SearchEngine]:
+        """已加载的图库（不触发加载、不更新 LRU 顺序）。"""
+        with self._lock:
+            return self._engines.get(gid)
+
+    def get(self, gid: str) -> SearchEngine:
+        """取图库对应的引擎，未加载时加载。未知 gid 抛 KeyError。"""
+        if gid not in self.configs:
+            raise KeyError(f"unknown gallery: {gid}")
+
+        with self._lock:
+            eng = self._engines.get(gid)
+            if eng is not None:
+                self._engines.move_to_end(gid)
+                evicted = self._evict(keep=gid)
+            else:
+                load_lock = self._load_locks.setdefault(gid, threading.Lock())
+        if eng is not None:
+            self._close(evicted)
+            return eng
+
+        # 同一图库只加载一次；加载在全局锁之外进行，其他图库的请求不被阻塞
+        with load_lock:
+            with self._lock:
+                eng = self._engines.get(gid)
+                if eng is not None:
+                    self._engines.move_to_end(gid)
+                    return eng
+            eng = self.factory(gid, self.configs[gid])
+            with self._lock:
+                self._engines[gid] = eng
+                evicted = self._evict(keep=gid)
+        self._close(evicted)
+        return eng
+
+    def loaded(self) -> List[Tuple[str, int]]:
+        """[(gid, 占用字节)]，按 LRU 顺序（最久未用在前）。"""
+        with self._lock:
+            return [(gid, eng.memory_bytes()) for gid, eng in self._engines.items()]
+
+    def _evict(self, keep: str) -> List[SearchEngine]:
+        if not self.budget_bytes:
+            return []
+        sizes = {gid: eng.memory_bytes() for gid, eng in self._engines.items()}
+        total = sum(sizes.values())
+        out = []
+        for gid in list(self._engines):
+            if total <= self.budget_bytes:
+                break
+            if gid == keep:
+                continue
+            out.append(self._engines.pop(gid))
+            total -= sizes[gid]
+        return out
+
+    @staticmethod
+    def _close(engines: List[SearchEngine]) -> None:
+        for eng in engines:
+            try:
+                eng.close()
+            except Exception:
+                pass
@@ -0,0 +1,112 @@
+"""
+进程内的 TopK 结果缓存：热门图片反复检索时，embedding 缓存命中后仍要整库打分，这里把打分结果也缓存下来。
+
+- key = (query 向量的哈希, topk, SearchFilter, 图库快照版本)；值为那次检索的 SearchHits（行号/分数 + 绑定快照的路径解析）
+- 快照版本变化（热更新、增删图片）后旧条目不会再命中；invalidate(version) 立即清空，不等 LRU 慢慢挤出
+- 按估算字节数做 LRU，超过 max_bytes 时淘汰最久未用的条目
+"""
+
+from __future__ import annotations
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Hashable, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from .search_engine import SearchHits
+
+# 每条目除 ndarray 外的大致开销（key 元组、SearchHits 对象、OrderedDict 节点）
+_ENTRY_OVERHEAD = 256
+
+
+def query_digest(q: np.ndarray) -> bytes:
+    """query 向量的内容哈希（含 dtype 和形状，768 维原始向量和降维后的向量不会混淆）。"""
+    a = np.ascontiguousarray(q)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{a.dtype.str}{a.shape}".encode("ascii"))
+    h.update(a.tobytes())
+    return h.digest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes: int = 32 << 20):
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._version: Optional[int] = None
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, version: int, key: Hashable) -> Optional[SearchHits]:
+        with self._lock:
+            entry = self._items.get((version, key))
+            if entry is None:
+                self._misses += 1
+                return None
+            self._items.move_to_end((version, key))
+            self._hits += 1
+            return entry[0]
+
+    def put(self, version: int, key: Hashable, hits: SearchHits) -> None:
+        if not self.enabled:
+            return
+        size = int(hits.indices.nbytes) + int(hits.scores.nbytes) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        # 缓存的结果会返回给多个调用方，数组设为只读
+        hits.indices.flags.writeable = False
+        hits.scores.flags.writeable = False
+        with self._lock:
+            if self._version is not None and version < self._version:
+                # 检索开始后图库已经换了新快照，旧结果没有必要再占空间
+                return
+            if version != self._version:
+                self._clear()
+                self._version = version
+            old = self._items.pop((version, key), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[(version, key)] = (hits, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._items:
+                _, (_, n) = self._items.popitem(last=False)
+                self._bytes -= n
+                self._evicted += 1
+
+    def invalidate(self, version: Optional[int] = None) -> None:
+        """图库快照替换后调用：清空全部条目，之后只接受 version 及更新版本的结果。"""
+        with self._lock:
+            if self._items:
+                self._invalidations += 1
+            self._clear()
+            self._version = version
+
+    def _clear(self) -> None:
+        self._items.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            lookups = hits + misses
+            return {
+                "version": self._version,
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "evicted": self._evicted,
+                "invalidations": self._invalidations,
+            }
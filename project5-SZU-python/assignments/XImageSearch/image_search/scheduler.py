@@ -0,0 +1,211 @@
+"""
+检索任务调度：固定数量的工作线程 + 带优先级的有界队列，取代不设上限的 ThreadPoolExecutor。
+
+- 准入控制：排队任务数达到 max_queue 时直接拒绝（Overloaded，附带建议的 Retry-After 秒数），不再无限堆积
+- 每个会话（session / 客户端 IP）同时在队列里或正在执行的任务数不超过 per_session
+- 优先级通道：lanes 按顺序优先，前面的通道有任务时总是先执行；低优先级通道只能占用 max_queue 的一部分，
+  同时执行的任务数也不超过 workers - 1，保证交互式上传在批量重检索堆积时仍然有位置和空闲线程；
+  因此有多个通道时至少开 2 个线程（workers 给 1 也按 2 算）
+- 下游积压：backlogged() 为真时（例如历史写线程的队列已满）新任务一律拒绝，避免检索越快、写库积压越多
+- 排队等待时间：on_start(wait_s) 在任务开始执行前回调（调用方可转给客户端），stats() 给出各通道的等待分布
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Sequence
+
+
+class Overloaded(Exception):
+    """队列已满或会话并发超限；retry_after 为建议的重试间隔（秒）。"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = int(retry_after)
+
+
+class Ticket:
+    """admit() 成功后拿到的名额：submit() 提交任务，或 release() 放弃（例如建记录失败）。"""
+
+    __slots__ = ("_sched", "lane", "session", "_used")
+
+    def __init__(self, sched: "TaskScheduler", lane: str, session: str):
+        self._sched = sched
+        self.lane = lane
+        self.session = session
+        self._used = False
+
+    def submit(self, fn: Callable, *args, on_start: Optional[Callable[[float], None]] = None) -> Future:
+        if self._used:
+            raise RuntimeError("ticket already used")
+        self._used = True
+        return self._sched._enqueue(self, fn, args, on_start)
+
+    def release(self) -> None:
+        if not self._used:
+            self._used = True
+            self._sched._release(self)
+
+
+class TaskScheduler:
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue: int = 64,
+        per_session: int = 4,
+        lanes: Sequence[str] = ("interactive", "bulk"),
+        low_lane_share: float = 0.5,
+        name: str = "search-task",
+        backlogged: Optional[Callable[[], bool]] = None,
+    ):
+        self.lanes = tuple(lanes)
+        # 只有一个线程时低优先级任务会占住它，给第一个通道留的线程就不存在了
+        self.workers = max(2 if len(self.lanes) > 1 else 1, int(workers))
+        self.backlogged = backlogged
+        self.max_queue = max(1, int(max_queue))
+        self.per_session = max(0, int(per_session))
+        # 第一个通道可以用满队列，其余通道最多占 low_lane_share
+        self._lane_cap = {lane: self.max_queue if i == 0 else max(1, int(self.max_queue * low_lane_share))
+                          for i, lane in enumerate(self.lanes)}
+        self._prio = {lane: i for i, lane in enumerate(self.lanes)}
+        # 同时执行的上限：第一个通道可以用满线程，其余通道给它留一个
+        self._run_cap = {lane: self.workers if i == 0 else self.workers - 1
+                         for i, lane in enumerate(self.lanes)}
+
+        self._cond = threading.Condition()
+        # 每个通道一个 FIFO；取任务时按通道优先级找第一个未达执行上限的通道
+        self._pending: Dict[str, deque] = {lane: deque() for lane in self.lanes}
+        self._running_lane: Dict[str, int] = {lane: 0 for lane in self.lanes}
+        # 已准入但还没开始执行的任务数（含已拿到 Ticket 未 submit 的），按通道
+        self._queued: Dict[str, int] = {lane: 0 for lane in self.lanes}
+        self._sessions: Dict[str, int] = {}
+        self._running = 0
+
+        self._admitted = {lane: 0 for lane in self.lanes}
+        self._rejected = {"queue_full": 0, "session_limit": 0, "backlog": 0}
+        self._waits = {lane: deque(maxlen=1024) for lane in self.lanes}
+        # 执行耗时的指数滑动平均，用于估计 Retry-After
+        self._service_s = 0.5
+
+        self._threads = [
+            threading.Thread(target=self._loop, name=f"{name}-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def admit(self, lane: str, session: str = "") -> Ticket:
+        """检查队列深度、下游积压和会话并发并占一个名额；超限抛 Overloaded。"""
+        if lane not in self._prio:
+            raise ValueError(f"unknown lane: {lane}")
+        backlogged = self.backlogged is not None and self.backlogged()
+        with self._cond:
+            queued = sum(self._queued.values())
+            if backlogged:
+                self._rejected["backlog"] += 1
+                raise Overloaded("write backlog", self._retry_after(queued))
+            if queued >= self.max_queue or self._queued[lane] >= self._lane_cap[lane]:
+                self._rejected["queue_full"] += 1
+                raise Overloaded("queue full", self._retry_after(queued))
+            if session and self.per_session and self._sessions.get(session, 0) >= self.per_session:
+                self._rejected["session_limit"] += 1
+                raise Overloaded("too many concurrent searches for this session", self._retry_after(0))
+            self._queued[lane] += 1
+            if session:
+                self._sessions[session] = self._sessions.get(session, 0) + 1
+            self._admitted[lane] += 1
+        return Ticket(self, lane, session)
+
+    def submit(self, lane: str, session: str, fn: Callable, *args,
+               on_start: Optional[Callable[[float], None]] = None) -> Future:
+        return self.admit(lane, session).submit(fn, *args, on_start=on_start)
+
+    def _retry_after(self, queued: int) -> int:
+        # 排在前面的任务按 workers 个并行执行完所需的时间
+        return max(1, min(60, int(math.ceil((queued + 1) * self._service_s / self.workers))))
+
+    def _enqueue(self, ticket: Ticket, fn: Callable, args: tuple, on_start) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            self._pending[ticket.lane].append((time.perf_counter(), ticket, fn, args, on_start, fut))
+            self._cond.notify_all()
+        return fut
+
+    def _next_lane(self) -> Optional[str]:
+        for lane in self.lanes:
+            if self._pending[lane] and self._running_lane[lane] < self._run_cap[lane]:
+                return lane
+        return None
+
+    def _release(self, ticket: Ticket, started: bool = False) -> None:
+        with self._cond:
+            if not started:
+                self._queued[ticket.lane] -= 1
+            if ticket.session:
+                n = self._sessions.get(ticket.session, 0) - 1
+                if n > 0:
+                    self._sessions[ticket.session] = n
+                else:
+                    self._sessions.pop(ticket.session, None)
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                lane = self._next_lane()
+                while lane is None:
+                    self._cond.wait()
+                    lane = self._next_lane()
+                t_enq, ticket, fn, args, on_start, fut = self._pending[lane].popleft()
+                self._queued[lane] -= 1
+                self._running += 1
+                self._running_lane[lane] += 1
+                wait_s = time.perf_counter() - t_enq
+                self._waits[ticket.lane].append(wait_s)
+
+            t0 = time.perf_counter()
+            try:
+                if fut.set_running_or_notify_cancel():
+                    try:
+                        if on_start is not None:
+                            on_start(wait_s)
+                        fut.set_result(fn(*args))
+                    except BaseException as e:
+                        fut.set_exception(e)
+            finally:
+                dt = time.perf_counter() - t0
+                with self._cond:
+                    self._running -= 1
+                    self._running_lane[ticket.lane] -= 1
+                    self._service_s = 0.9 * self._service_s + 0.1 * dt
+                    # 这个通道空出了执行名额，等在执行上限上的线程可以继续取任务
+                    self._cond.notify_all()
+                self._release(ticket, started=True)
+
+    def stats(self) -> dict:
+        with self._cond:
+            lanes = {}
+            for lane in self.lanes:
+                w = sorted(self._waits[lane])
+                lanes[lane] = {
+                    "queued": self._queued[lane],
+                    "capacity": self._lane_cap[lane],
+                    "running": self._running_lane[lane],
+                    "max_running": self._run_cap[lane],
+                    "admitted": self._admitted[lane],
+                    "avg_wait_ms": 1000.0 * sum(w) / len(w) if w else 0.0,
+                    "p95_wait_ms": 1000.0 * w[min(len(w) - 1, int(0.95 * len(w)))] if w else 0.0,
+                    "max_wait_ms": 1000.0 * w[-1] if w else 0.0,
+                }
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "max_queue": self.max_queue,
+                "per_session": self.per_session,
+                "avg_service_ms": 1000.0 * self._service_s,
+                "rejected": dict(self._rejected),
+                "lanes": lanes,
+            }
@@ -1,18 +1,132 @@
 from __future__ import annotations
-import io, os, csv, sys
+import io, os, csv, sys, zlib, hashlib, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
-from urllib.parse import quote
+from typing import Callable, List, Optional, Sequence, Tuple
+from urllib.parse import quote, unquote
+
+from array import array
 
 import numpy as np
 from PIL import Image
 
+from .batching import EmbedBatcher
+from .result_cache import ResultCache, query_digest
+from .shards import ShardClient
+from .shared_matrix import SharedMatrix
+from .gallery_format import (
+    GalleryFile, IvfIndex, KnnGraph, PathTable, gallery_lock, model_fingerprint, read_delta, write_delta,
+    write_gallery_file,
+)
+
+
+_BLAS_LOCK = threading.Lock()
+_BLAS_THREADS: Optional[int] = None
+
+
+def _limit_blas_threads(n: int) -> None:
+    """
+    分片并行时每个分片线程的 BLAS 线程数，避免 分片数 x BLAS 线程 的过度订阅（需要 threadpoolctl）。
+
+    BLAS 线程数是进程级的，不能按次检索设置再恢复（并发检索会互相覆盖）：每个进程只在第一个
+    search_threads > 1 的引擎创建时设置一次，之后不再改动。
+    """
+    global _BLAS_THREADS
+    with _BLAS_LOCK:
+        if _BLAS_THREADS is not None:
+            return
+        _BLAS_THREADS = n
+        try:
+            from threadpoolctl import threadpool_limits  # type: ignore
+
+            threadpool_limits(limits=n, user_api="blas")
+        except Exception:
+            pass
+
+
+# DINO_BACKEND 里表示 ONNX Runtime 的写法，统一成 "onnx"
+_ONNX_BACKENDS = ("onnx", "ort", "onnxrt", "onnxruntime")
+
 
-@dataclass(frozen=True)
 class SearchResult:
-    url: str
-    score: float
+    """单条检索结果：只存 gallery 行号和分数，url 在第一次访问时才解析。"""
+
+    __slots__ = ("index", "score", "_url", "_resolve")
+
+    def __init__(self, index: int, score: float, resolve: Optional[Callable[[int], str]] = None, url: Optional[str] = None):
+        self.index = int(index)
+        self.score = float(score)
+        self._url = url
+        self._resolve = resolve
+
+    @property
+    def url(self) -> str:
+        if self._url is None:
+            self._url = self._resolve(self.index) if self._resolve else f"{self.index}.jpg"
+        return self._url
+
+    def __repr__(self) -> str:
+        return f"SearchResult(index={self.index}, score={self.score:.6f})"
+
+
+class SearchHits(Sequence):
+    """
+    一次检索的 TopK：行号/分数保留为 ndarray，按下标访问时才生成 SearchResult。
+
+    resolve 绑定的是检索时刻的路径表，之后即使图库被替换，url 也与行号保持一致。
+    rows_tag 标识行号所在的行号空间（见 SearchEngine._hits_tag），为空表示行号不能脱离本次结果单独解析。
+    """
+
+    __slots__ = ("indices", "scores", "_resolve", "rows_tag")
+
+    def __init__(self, indices: np.ndarray, scores: np.ndarray, resolve: Callable[[int], str], rows_tag: str = ""):
+        self.indices = indices
+        self.scores = scores
+        self._resolve = resolve
+        self.rows_tag = rows_tag
+
+    def __len__(self) -> int:
+        return int(self.indices.shape[0])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return SearchHits(self.indices[i], self.scores[i], self._resolve, self.rows_tag)
+        return SearchResult(int(self.indices[i]), float(self.scores[i]), self._resolve)
+
+    def urls(self) -> List[str]:
+        return [self._resolve(int(i)) for i in self.indices]
+
+
+# 进程内共享的模型：多个图库（SearchEngine）用同一份权重，只加载一次
+_MODELS: dict = {}
+_MODELS_LOCK = threading.Lock()
+
+
+def _shared_model(key: tuple, load: Callable[[], object]):
+    with _MODELS_LOCK:
+        vit = _MODELS.get(key)
+        if vit is None:
+            vit = load()
+            _MODELS[key] = vit
+        return vit
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """检索过滤条件：图库子目录前缀 和/或 索引 CSV 属性列的取值，全部满足的行才参与打分。"""
+
+    folder: str = ""
+    attrs: tuple = ()  # ((列名, 值), ...)，排好序以便作为缓存 key
+
+    @classmethod
+    def make(cls, folder: Optional[str] = None, attrs: Optional[dict] = None) -> Optional["SearchFilter"]:
+        folder = (folder or "").replace("\\", "/").strip().strip("/")
+        items = tuple(sorted((str(k), str(v)) for k, v in (attrs or {}).items() if str(k)))
+        if not folder and not items:
+            return None
+        return cls(folder=folder, attrs=items)
 
 
 def _norm(v: np.ndarray) -> np.ndarray:
@@ -20,6 +134,136 @@ def _norm(v: np.ndarray) -> np.ndarray:
     return (v / n).astype(np.float32, copy=False)
 
 
+def _rows_normalized(feats: np.ndarray, samples: int = 256, tol: float = 1e-3) -> bool:
+    """抽样检查磁盘上的特征是否已经按行 L2 归一化（只读少量行，不触发全量读取）。"""
+    n = int(feats.shape[0])
+    idx = np.unique(np.linspace(0, n - 1, num=min(samples, n)).astype(np.int64))
+    norms = np.linalg.norm(np.asarray(feats[idx], dtype=np.float32), axis=1)
+    return bool(np.all(np.abs(norms - 1.0) < tol))
+
+
+def _topk_rows(sims: np.ndarray, topk: int):
+    """(b, n) 相似度 -> 每行 TopK 的 (scores, indices)，均按分数降序，形状 (b, k)。"""
+    n = int(sims.shape[1])
+    topk = min(int(topk), n)
+    if topk == n:
+        top = np.argsort(-sims, axis=1)
+    else:
+        top = np.argpartition(-sims, kth=topk - 1, axis=1)[:, :topk]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+    return np.take_along_axis(sims, top, axis=1), top
+
+
+def _merge_topk(best_s, best_i, cand_s, cand_i, topk: int):
+    """把候选并入 running TopK（按行），返回按分数降序的 (scores, indices)。"""
+    if best_s is None:
+        return cand_s, cand_i
+    s = np.concatenate([best_s, cand_s], axis=1)
+    i = np.concatenate([best_i, cand_i], axis=1)
+    top_s, pos = _topk_rows(s, topk)
+    return top_s, np.take_along_axis(i, pos, axis=1)
+
+
+class GalleryState:
+    """
+    一次加载得到的图库快照：特征矩阵、路径表、PCA 投影。
+
+    加载完成后不再修改。热更新时整体替换 SearchEngine._gallery 引用（赋值是原子的），
+    正在执行的检索持有旧快照，自然在旧索引上跑完。
+    """
+
+    __slots__ = (
+        "features", "paths", "streaming", "gallery_file",
+        "pca_mean", "pca_proj", "embedding_tag",
+        "version", "stamp", "error",
+        "delta_features", "delta_paths", "tombstones", "delta_stamp",
+        "attrs", "filter_cache", "filter_lock", "knn", "ivf", "ann",
+        "row_offset", "remote", "shared", "rows_tag",
+    )
+
+    def __init__(self, version: int = 0):
+        self.features: Optional[np.ndarray] = None
+        self.paths: Sequence[str] = []
+        # True: features 是磁盘上预归一化文件的 memmap，检索按 chunk_rows 分块扫描
+        self.streaming = False
+        self.gallery_file: Optional[GalleryFile] = None
+        # 可选 PCA/whitening 投影（fit_pca.py 离线生成）：x -> (x - mean) @ proj
+        self.pca_mean: Optional[np.ndarray] = None
+        self.pca_proj: Optional[np.ndarray] = None
+        self.embedding_tag = "raw"
+        self.version = int(version)
+        self.stamp: tuple = ()
+        self.error: Optional[str] = None
+        # 增量段：上线后新增的图片（行号从 base 行数开始编号）+ 被删除的 base 行（墓碑，升序）
+        self.delta_features: Optional[np.ndarray] = None
+        self.delta_paths: List[str] = []
+        self.tombstones = np.zeros((0,), dtype=np.int64)
+        self.delta_stamp: tuple = ()
+        # 索引 CSV 里除路径外的列：{列名: (每行取值编码 int32, {取值: 编码})}
+        self.attrs: dict = {}
+        # SearchFilter -> 命中的行集合（随快照失效，见 SearchEngine._filter_rows）；并发检索共用，按 LRU 淘汰
+        self.filter_cache: "OrderedDict[SearchFilter, tuple]" = OrderedDict()
+        self.filter_lock = threading.Lock()
+        # 离线 kNN 图（build_knn.py），只覆盖 base 行
+        self.knn: Optional[KnnGraph] = None
+        # IVF 倒排索引（build_ivf.py），只覆盖 base 行；ann 为按延迟/召回目标从 Pareto 表选出的 (nprobe, rerank)
+        self.ivf: Optional[IvfIndex] = None
+        self.ann: Optional[tuple] = None
+        # 分片服务：本快照是整库的第 row_offset 行起的一段；协调端：remote 为分片客户端，本地没有特征
+        self.row_offset = 0
+        self.remote: Optional[ShardClient] = None
+        # features 放在命名共享内存里时持有该块（快照释放时由创建方 unlink）
+        self.shared: Optional[SharedMatrix] = None
+        # base 行号空间的标识（SearchEngine._rows_tag 首次用到时计算）
+        self.rows_tag: Optional[str] = None
+
+    def with_base(self, version: int) -> "GalleryState":
+        """复制 base 部分（不复制数组），用于只替换增量段。"""
+        g = GalleryState(version=version)
+        for k in ("features", "paths", "streaming", "gallery_file", "pca_mean", "pca_proj", "embedding_tag", "stamp",
+                  "attrs", "knn", "ivf", "ann", "row_offset", "remote", "shared"):
+            setattr(g, k, getattr(self, k))
+        return g
+
+    @property
+    def has_delta(self) -> bool:
+        return self.delta_features is not None or bool(self.tombstones.size)
+
+    def size(self) -> int:
+        """可检索的行数：base - 墓碑 + 增量。"""
+        if self.remote is not None:
+            return self.remote.rows
+        if self.features is None:
+            return 0
+        m = 0 if self.delta_features is None else int(self.delta_features.shape[0])
+        return int(self.features.shape[0]) - int(self.tombstones.size) + m
+
+    def nbytes(self) -> int:
+        """快照引用的数组总大小（mmap 的按映射大小计），用于多图库的内存预算。"""
+        total = 0
+        for a in (self.features, self.delta_features, self.pca_proj):
+            if a is not None:
+                total += int(a.nbytes)
+        if isinstance(self.paths, PathTable):
+            total += self.paths.nbytes
+        for codes, _values in self.attrs.values():
+            total += int(codes.nbytes)
+        if self.knn is not None:
+            total += int(self.knn.ids.nbytes) + int(self.knn.scores.nbytes)
+        if self.ivf is not None:
+            total += self.ivf.nbytes
+        return total
+
+    def project(self, x: np.ndarray) -> np.ndarray:
+        """Apply the PCA/whitening projection (1-D or 2-D input) and re-normalize rows."""
+        if self.pca_proj is None or x.shape[-1] != self.pca_proj.shape[0]:
+            return x
+        y = (x - self.pca_mean) @ self.pca_proj
+        denom = np.linalg.norm(y, axis=-1, keepdims=True) + 1e-12
+        return (y / denom).astype(np.float32, copy=False)
+
+
 class SearchEngine:
     """
     DINOv2 NumPy embedding + cosine retrieval.
@@ -28,6 +272,27 @@ class SearchEngine:
     - Gallery loading uses mmap to reduce memory spikes
     - Any load failure -> features=None (no crash), error message accessible
     - Path handling prevents traversal and encodes safely for /gallery/
+    - Optional PCA/whitening projection (gallery_pca.npz) applied to gallery and queries
+    - Pre-normalized float32 galleries stay memory-mapped and are scanned in chunks
+    - Single-file .idx gallery (gallery_format.py) opens via mmap without parsing rows
+    - Paths live in a compact PathTable; results are index/score records with lazy URLs
+    - Exact search can be split into row shards scored on a thread pool (search_threads)
+    - Gallery state is an immutable GalleryState snapshot that can be reloaded and swapped live
+    - Live add/remove goes to a delta segment (new rows + tombstones) merged into the base later
+    - Filtered search (SearchFilter: folder prefix / index attributes) scores only matching rows
+    - Range search returns every row above a score threshold (optionally capped)
+    - "More like this" serves precomputed kNN neighbors (build_knn.py), else exact search from the stored row
+    - Model weights are shared process-wide, so several galleries (engines) load the ViT once
+    - Optional IVF index (build_ivf.py): fp16 coarse scan of nprobe lists + exact re-rank; parameters picked
+      from the index's tuned Pareto table to meet ann_target_p95_ms / ann_target_recall
+    - share_features keeps a normalized in-memory gallery in named shared memory, mapped once per machine
+      and reused by every process that loads the same files (Django workers, workers.WorkerPool processes)
+    - Concurrent single-image queries are micro-batched into one ViT forward (batching.EmbedBatcher)
+    - Scatter-gather: shard=(i, n) loads one row partition for a shard server (shards.py);
+      shard_addresses makes a coordinator that fans queries out to shard servers and merges their TopK
+    - TopK results are LRU-cached per (query hash, topk, filter, gallery version); swapping the snapshot clears them
+    - Hits carry rows_tag (base row space + the delta prefix they reference); resolve_rows turns stored row ids
+      back into results while the base rows are unchanged and the delta has only been appended to
     """
 
     def __init__(
@@ -41,35 +306,164 @@ class SearchEngine:
         backend: str = "numpy",
         onnx_model_path: Optional[str] = None,
         ort_providers: Optional[List[str]] = None,
+        pca_path: Optional[str] = None,
+        mmap_search: bool = True,
+        chunk_rows: int = 65536,
+        gallery_file_path: Optional[str] = None,
+        search_threads: int = 1,
+        min_shard_rows: int = 50000,
+        reload_trigger_path: Optional[str] = None,
+        delta_path: Optional[str] = None,
+        upload_subdir: str = "uploads",
+        knn_path: Optional[str] = None,
+        ivf_path: Optional[str] = None,
+        ann_target_p95_ms: float = 0.0,
+        ann_target_recall: float = 0.0,
+        shard: Optional[tuple] = None,
+        shard_addresses: Optional[List[str]] = None,
+        shard_authkey: bytes = b"",
+        shard_timeout: float = 30.0,
+        shard_allow_remote: bool = False,
+        embed_batch_window_ms: float = 0.0,
+        embed_max_batch: int = 8,
+        share_features: bool = False,
+        result_cache_bytes: int = 32 << 20,
     ):
         self.gallery_features_path = gallery_features_path or ""
+        self.gallery_file_path = gallery_file_path or ""
         self.gallery_index_path = gallery_index_path or ""
+        self.pca_path = pca_path or ""
+        self.reload_trigger_path = reload_trigger_path or ""
+        self.delta_path = delta_path or ""
+        self.knn_path = knn_path or ""
+        self.ivf_path = ivf_path or ""
+        # 两个目标都为 0 时不用 ANN（始终精确检索）
+        self.ann_target_p95_ms = max(0.0, float(ann_target_p95_ms or 0.0))
+        self.ann_target_recall = max(0.0, float(ann_target_recall or 0.0))
+        # 分片服务只加载第 i 段（共 n 段）行；协调端不加载特征，检索转发给 shard_addresses
+        self.shard = (int(shard[0]), int(shard[1])) if shard else None
+        if self.shard is not None and not 0 <= self.shard[0] < self.shard[1]:
+            raise ValueError(f"bad shard: {shard}")
+        self._shards = (
+            ShardClient(shard_addresses, shard_authkey, timeout=shard_timeout, allow_remote=shard_allow_remote)
+            if shard_addresses else None
+        )
+        self.upload_subdir = (upload_subdir or "uploads").strip("/\\")
+        self.mmap_search = bool(mmap_search)
+        self.chunk_rows = max(1024, int(chunk_rows or 65536))
+        self.share_features = bool(share_features)
+
+        # 分片并行暴力检索：search_threads 是总线程预算（0=CPU 核数），分片内 BLAS 线程按预算均分
+        threads = int(search_threads if search_threads is not None else 1)
+        self.search_threads = max(1, threads if threads > 0 else (os.cpu_count() or 1))
+        self.min_shard_rows = max(1024, int(min_shard_rows or 50000))
+        self._search_pool: Optional[ThreadPoolExecutor] = None
+        if self.search_threads > 1:
+            _limit_blas_threads(max(1, (os.cpu_count() or 1) // self.search_threads))
         self.gallery_url_prefix = (gallery_url_prefix or "/gallery/").rstrip("/") + "/"
         self.cdn_base = (cdn_base.rstrip("/") + "/") if cdn_base else None
 
         self.gallery_root_abs = os.path.abspath(gallery_root) if gallery_root else None
         self.weights_path = weights_path
 
-        self.backend = (backend or "numpy").strip().lower()
+        backend = (backend or "numpy").strip().lower()
+        self.backend = "onnx" if backend in _ONNX_BACKENDS else backend
         self.onnx_model_path = onnx_model_path
         self.ort_providers = ort_providers
 
         self._vit = None
+        self._model_tag: Optional[str] = None
         self._weights_loaded = False
+        # 微批：window_ms=0 时每个 query 单独前向；同一模型的所有引擎共享一个调度器
+        self.embed_batch_window_ms = max(0.0, float(embed_batch_window_ms or 0.0))
+        self.embed_max_batch = max(1, int(embed_max_batch or 1))
+        self._batcher: Optional[EmbedBatcher] = None
+        # TopK 结果缓存（0=关闭），快照替换时清空
+        self._results = ResultCache(result_cache_bytes)
 
-        self.features: Optional[np.ndarray] = None
-        self.paths: List[str] = []
         self.last_error: Optional[str] = None
+        # 当前图库快照；热更新只替换这个引用（见 reload_gallery）
+        self._gallery = GalleryState()
+        # RLock：增删图片时持锁并在锁内刷新增量段
+        self._reload_lock = threading.RLock()
+        self._watcher: Optional[threading.Thread] = None
+        self._closed = threading.Event()
 
         self._load_gallery()
 
+    # 当前图库快照的只读视图（调用方拿到的是某一时刻的快照，检索内部只读一次 self._gallery）
+    @property
+    def features(self) -> Optional[np.ndarray]:
+        return self._gallery.features
+
+    @property
+    def paths(self) -> Sequence[str]:
+        return self._gallery.paths
+
+    @property
+    def streaming(self) -> bool:
+        return self._gallery.streaming
+
+    @property
+    def gallery_file(self) -> Optional[GalleryFile]:
+        return self._gallery.gallery_file
+
+    @property
+    def pca_proj(self) -> Optional[np.ndarray]:
+        return self._gallery.pca_proj
+
+    @property
+    def embedding_tag(self) -> str:
+        return self._gallery.embedding_tag
+
+    @property
+    def model_tag(self) -> str:
+        """
+        query 模型的指纹（ONNX 模型或 numpy 权重文件），持久化 embedding 缓存用它区分不同模型。
+        先加载模型：ONNX 加载失败会回退到 numpy，tag 要按实际在用的后端算。
+        """
+        if self._model_tag is None:
+            if not self._weights_loaded:
+                try:
+                    self._ensure_vit()
+                except Exception:
+                    # 模型加载不了时照配置算，检索本身会报错
+                    pass
+            path = self.onnx_model_path if self.backend == "onnx" else self.weights_path
+            fp = model_fingerprint(os.path.abspath(str(path))) if path else ""
+            self._model_tag = f"{self.backend}-{fp[:16] or 'none'}"
+        return self._model_tag
+
+    @property
+    def cache_tag(self) -> str:
+        """同一张图的 query embedding 可复用的范围：同一模型 + 同一检索空间（PCA）。"""
+        return f"{self.model_tag}:{self.embedding_tag}"
+
+    @property
+    def ready(self) -> bool:
+        """图库可检索（本地已加载特征，或已连上全部分片）。"""
+        g = self._gallery
+        return g.features is not None or g.remote is not None
+
+    @property
+    def query_dim(self) -> Optional[int]:
+        """检索空间的维度（query 需要投影到的维度），未就绪时为 None。"""
+        g = self._gallery
+        if g.remote is not None:
+            return g.remote.dim
+        return None if g.features is None else int(g.features.shape[1])
+
+    @property
+    def gallery_version(self) -> int:
+        return self._gallery.version
+
     def _set_error(self, msg: str):
         self.last_error = msg
 
     def _ensure_vit(self):
         if self._weights_loaded:
             return
-        if self.backend in ("onnx", "ort", "onnxrt", "onnxruntime"):
+        if self.backend == "onnx":
             try:
                 if not self.onnx_model_path:
                     raise RuntimeError("Missing onnx_model_path (DINO_ONNX_PATH)")
@@ -79,13 +473,18 @@ class SearchEngine:
 
                 from .dinov2_onnx import Dinov2Onnx, OrtConfig
 
-                self._vit = Dinov2Onnx(OrtConfig(model_path=model_abs, providers=self.ort_providers))
+                self._vit = _shared_model(
+                    ("onnx", model_abs, tuple(self.ort_providers or ())),
+                    lambda: Dinov2Onnx(OrtConfig(model_path=model_abs, providers=self.ort_providers)),
+                )
+                self._start_batcher(("onnx", model_abs, tuple(self.ort_providers or ())))
                 self._weights_loaded = True
                 return
             except Exception as e:
                 # 自动回退到 numpy，保证服务可用
                 self._set_error(f"ONNX backend failed: {e}. Falling back to numpy.")
                 self.backend = "numpy"
+                self._model_tag = None
 
         # default: numpy CPU backend
         if not self.weights_path:
@@ -103,10 +502,30 @@ class SearchEngine:
         except Exception as e:
             raise RuntimeError(f"Cannot import dinov2_numpy.Dinov2Numpy: {e}")
 
-        weights = np.load(weights_path_abs, allow_pickle=False)
-        self._vit = Dinov2Numpy(weights)
+        self._vit = _shared_model(
+            ("numpy", weights_path_abs),
+            lambda: Dinov2Numpy(np.load(weights_path_abs, allow_pickle=False)),
+        )
+        self._start_batcher(("numpy", weights_path_abs))
         self._weights_loaded = True
 
+    def _start_batcher(self, model_key: tuple) -> None:
+        if self.embed_batch_window_ms <= 0 or self.embed_max_batch <= 1:
+            return
+        vit = self._vit
+        self._batcher = _shared_model(
+            ("batcher",) + model_key,
+            lambda: EmbedBatcher(vit, window_ms=self.embed_batch_window_ms, max_batch=self.embed_max_batch),
+        )
+
+    def batch_stats(self) -> Optional[dict]:
+        """微批调度器的统计（未启用或模型尚未加载时为 None）。"""
+        return self._batcher.stats() if self._batcher is not None else None
+
+    def result_cache_stats(self) -> Optional[dict]:
+        """TopK 结果缓存的命中率和占用（未启用时为 None）。"""
+        return self._results.stats() if self._results.enabled else None
+
     @staticmethod
     def _preprocess_pil(img: Image.Image, target: int = 224) -> np.ndarray:
         img = img.convert("RGB")
@@ -131,26 +550,147 @@ class SearchEngine:
         x = arr.transpose(2, 0, 1)[None, ...]  # (1,3,224,224)
         return x
 
-    def _load_gallery(self):
-        self.features = None
-        self.paths = []
-        self.last_error = None
+    def _load_pca(self, g: GalleryState) -> None:
+        if not self.pca_path or not os.path.exists(self.pca_path):
+            return
+        try:
+            with np.load(self.pca_path, allow_pickle=False) as z:
+                mean = np.asarray(z["mean"], dtype=np.float32).reshape(-1)
+                proj = np.ascontiguousarray(z["proj"], dtype=np.float32)
+            if proj.ndim != 2 or proj.shape[0] != mean.shape[0] or proj.shape[1] <= 0:
+                raise ValueError(f"bad pca shapes: mean={mean.shape} proj={proj.shape}")
+            g.pca_mean = mean
+            g.pca_proj = proj
+            # 投影变了缓存的 embedding 就不能复用，tag 用于区分缓存 key
+            g.embedding_tag = f"pca{proj.shape[1]}-{zlib.crc32(proj.tobytes()):08x}"
+        except Exception as e:
+            g.error = f"Failed to load PCA projection: {e}"
+
+    def _project(self, x: np.ndarray) -> np.ndarray:
+        return self._gallery.project(x)
+
+    def _use_features(self, g: GalleryState, feats: np.ndarray, normalized: Optional[bool] = None) -> None:
+        """
+        设置检索矩阵。磁盘上已是检索空间（float32、C 连续、按行归一化、维度与 query 一致）时
+        直接保留 memmap，不做任何拷贝；多个 worker 共享同一份 OS page cache，常驻内存与图库大小无关。
+        normalized=None 表示未知，抽样检查行范数。
+        """
+        if feats.ndim != 2 or feats.shape[0] <= 0 or feats.shape[1] <= 0:
+            raise ValueError(f"bad gallery_features shape: {feats.shape}")
+        if self.shard is not None:
+            # 先切片再拷贝/归一化，分片进程只为自己那段行付内存
+            i, count = self.shard
+            n = int(feats.shape[0])
+            g.row_offset = n * i // count
+            feats = feats[g.row_offset:n * (i + 1) // count]
+            if feats.shape[0] <= 0:
+                raise ValueError(f"shard {i}/{count} of a {n}-row gallery is empty")
+
+        query_dim = int(g.pca_proj.shape[1]) if g.pca_proj is not None else int(feats.shape[1])
+        if (
+            self.mmap_search
+            and isinstance(feats, np.memmap)
+            and feats.dtype == np.float32
+            and feats.flags.c_contiguous
+            and int(feats.shape[1]) == query_dim
+            and (normalized if normalized is not None else _rows_normalized(feats))
+        ):
+            g.features = feats
+            g.streaming = True
+            return
+
+        if self.share_features:
+            try:
+                self._use_shared_features(g, feats, query_dim)
+                return
+            except Exception as e:
+                g.error = f"Shared gallery unavailable, using a private copy: {e}"
+
+        feats = np.asarray(feats, dtype=np.float32)
+        # normalize
+        denom = np.linalg.norm(feats, axis=1, keepdims=True) + 1e-12
+        feats = (feats / denom).astype(np.float32, copy=False)
+        # 降维：(N,768) -> (N,d)，GEMM 和常驻内存同比例缩小
+        feats = g.project(feats)
+        g.features = np.ascontiguousarray(feats)
+        g.streaming = False
+
+    def _use_shared_features(self, g: GalleryState, feats: np.ndarray, dim: int) -> None:
+        """
+        归一化 + 投影后的矩阵放进命名共享内存：名字取自特征/PCA 文件的 stamp（和分片号），
+        同机其他进程加载同一批文件时直接映射，不再重复计算和复制。填充按 chunk_rows 分块，不产生整库临时副本。
+        """
+        key = repr((self._file_stamp([self.gallery_file_path, self.gallery_features_path, self.pca_path]),
+                    self.shard, tuple(feats.shape), dim))
+        name = "xis_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+
+        def fill(out: np.ndarray) -> None:
+            for i in range(0, int(feats.shape[0]), self.chunk_rows):
+                x = np.asarray(feats[i:i + self.chunk_rows], dtype=np.float32)
+                x = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+                out[i:i + x.shape[0]] = g.project(x)
+
+        g.shared = SharedMatrix.open_or_create(name, (int(feats.shape[0]), dim), fill)
+        g.features = g.shared.array
+        g.streaming = False
+
+    def _load_gallery_file(self, g: GalleryState) -> None:
+        """从单文件 .idx 加载：mmap + header 校验，路径表零拷贝，不逐行解析。"""
+        try:
+            gf = GalleryFile(self.gallery_file_path)
+            self._use_features(g, gf.features, normalized=gf.header.normalized)
+            g.paths = gf.paths
+            g.gallery_file = gf
+        except Exception as e:
+            g.error = f"Failed to load gallery file: {e}"
+            g.features = None
+            g.paths = []
+            g.streaming = False
+            return
+
+        # 建库所用权重与当前 query 权重不一致时检索结果会错乱，给出提示但不阻断服务
+        fp = gf.header.fingerprint
+        if fp and self.backend == "numpy" and self.weights_path:
+            mine = model_fingerprint(os.path.abspath(self.weights_path))
+            if mine and mine != fp:
+                g.error = f"Gallery file was built with different weights (fingerprint {fp} != {mine})"
+
+    def _build_gallery(self, version: int = 0) -> GalleryState:
+        g = GalleryState(version=version)
+        g.stamp = self._gallery_stamp()
+
+        self._load_pca(g)
+
+        if self._shards is not None:
+            try:
+                self._shards.connect()
+                if g.pca_proj is not None and int(g.pca_proj.shape[1]) != self._shards.dim:
+                    raise ValueError(f"shards serve dim {self._shards.dim}, local PCA projects to {g.pca_proj.shape[1]}")
+                g.remote = self._shards
+            except Exception as e:
+                g.error = f"Failed to reach gallery shards: {e}"
+            return g
+
+        if self.gallery_file_path and os.path.exists(self.gallery_file_path):
+            self._load_gallery_file(g)
+            self._slice_shard(g)
+            self._load_knn(g)
+            self._load_ivf(g)
+            self._load_delta(g)
+            return g
 
         # Features
         if self.gallery_features_path and os.path.exists(self.gallery_features_path):
             try:
                 feats = np.load(self.gallery_features_path, mmap_mode="r", allow_pickle=False)
-                feats = np.asarray(feats, dtype=np.float32)
-                if feats.ndim != 2 or feats.shape[0] <= 0 or feats.shape[1] <= 0:
-                    raise ValueError(f"bad gallery_features shape: {feats.shape}")
-                # normalize
-                denom = np.linalg.norm(feats, axis=1, keepdims=True) + 1e-12
-                self.features = np.ascontiguousarray((feats / denom).astype(np.float32, copy=False))
+                self._use_features(g, feats)
             except Exception as e:
-                self._set_error(f"Failed to load gallery features: {e}")
-                self.features = None
+                g.error = f"Failed to load gallery features: {e}"
+                g.features = None
+                g.streaming = False
 
         # Index
+        # 路径存成一块连续字节 + 偏移数组（PathTable），而不是每张图一个 Python str 对象
         if self.gallery_index_path and os.path.exists(self.gallery_index_path):
             try:
                 with open(self.gallery_index_path, "r", encoding="utf-8") as f:
@@ -162,41 +702,512 @@ class SearchEngine:
                                 key = c
                                 break
                         key = key or reader.fieldnames[0]
+                    attr_cols = [c for c in (reader.fieldnames or []) if c != key]
+                    attr_codes = {c: array("i") for c in attr_cols}
+                    attr_values = {c: {} for c in attr_cols}
 
-                    for row in reader:
-                        p = (row.get(key) or "").strip()
-                        if not p:
-                            continue
-                        # Normalize windows separators
-                        norm = p.replace("/", "\\")
-                        if self.gallery_root_abs and os.path.isabs(norm):
-                            # convert absolute -> relative to root
-                            try:
-                                rel = os.path.relpath(norm, start=self.gallery_root_abs)
-                                p = rel
-                            except Exception:
-                                p = os.path.basename(norm)
-                        self.paths.append(p)
+                    def iter_paths():
+                        for row in reader:
+                            p = (row.get(key) or "").strip()
+                            if not p:
+                                continue
+                            # 其余列按取值编码，过滤检索时一次比较就能得到整列的命中行
+                            for c in attr_cols:
+                                v = (row.get(c) or "").strip()
+                                attr_codes[c].append(attr_values[c].setdefault(v, len(attr_values[c])))
+                            # Normalize windows separators
+                            norm = p.replace("/", "\\")
+                            if self.gallery_root_abs and os.path.isabs(norm):
+                                # convert absolute -> relative to root
+                                try:
+                                    rel = os.path.relpath(norm, start=self.gallery_root_abs)
+                                    p = rel
+                                except Exception:
+                                    p = os.path.basename(norm)
+                            yield p
+
+                    g.paths = PathTable.from_strings(iter_paths())
+                    g.attrs = {c: (np.frombuffer(attr_codes[c], dtype=np.int32), attr_values[c]) for c in attr_cols}
             except Exception as e:
-                self._set_error(f"Failed to load gallery index: {e}")
+                g.error = f"Failed to load gallery index: {e}"
+                g.paths = []
+
+        self._slice_shard(g)
 
         # fallback paths
-        if self.features is not None and not self.paths:
-            self.paths = [f"{i}.jpg" for i in range(int(self.features.shape[0]))]
+        if g.features is not None and not len(g.paths):
+            g.paths = PathTable.from_strings(f"{i}.jpg" for i in range(int(g.features.shape[0])))
 
         # align lengths
-        if self.features is not None and len(self.paths) != int(self.features.shape[0]):
-            n = min(len(self.paths), int(self.features.shape[0]))
-            self.paths = self.paths[:n]
-            self.features = self.features[:n]
+        if g.features is not None and len(g.paths) != int(g.features.shape[0]):
+            n = min(len(g.paths), int(g.features.shape[0]))
+            g.paths = g.paths.truncate(n)
+            g.features = g.features[:n]
+
+        self._load_knn(g)
+        self._load_ivf(g)
+        self._load_delta(g)
+        return g
+
+    def _slice_shard(self, g: GalleryState) -> None:
+        """分片服务：路径表和属性列取与特征相同的行段（路径表共享字节块，不复制）。"""
+        if self.shard is None or g.features is None:
+            return
+        lo, hi = g.row_offset, g.row_offset + int(g.features.shape[0])
+        if isinstance(g.paths, PathTable):
+            g.paths = g.paths.slice(lo, hi)
+        g.attrs = {c: (codes[lo:hi], values) for c, (codes, values) in g.attrs.items()}
+
+    def knn_tag(self, g: GalleryState) -> str:
+        """
+        kNN 图 / IVF 索引与 base 图库的对应关系：行数 + embedding 空间 + base 文件的元数据
+        （.idx 取 header 里的行数、路径表大小和建库指纹，npy + csv 取两个文件的 mtime/size）。
+        不扫描路径表；不含文件路径本身，离线脚本和 Web 端用不同写法指向同一文件时结果相同。base 变了图就作废。
+        """
+        if g.gallery_file is not None:
+            h = g.gallery_file.header
+            src = ("idx", h.count, int(g.gallery_file.paths.blob.shape[0]), h.fingerprint)
+        else:
+            src = ("npy",) + tuple(st[1:] for st in self._file_stamp([self.gallery_features_path,
+                                                                     self.gallery_index_path]))
+        n = 0 if g.features is None else int(g.features.shape[0])
+        return f"{n}-{zlib.crc32(repr(src).encode('utf-8')):08x}-{g.embedding_tag}"[:64]
+
+    def _load_knn(self, g: GalleryState) -> None:
+        if g.features is None or not self.knn_path or not os.path.exists(self.knn_path):
+            return
+        try:
+            kg = KnnGraph(self.knn_path)
+            if kg.tag != self.knn_tag(g):
+                raise ValueError("graph was built for a different gallery; rebuild with build_knn.py")
+            g.knn = kg
+        except Exception as e:
+            g.error = f"Ignoring kNN graph: {e}"
+
+    def _load_ivf(self, g: GalleryState) -> None:
+        if g.features is None or not self.ivf_path or not os.path.exists(self.ivf_path):
+            return
+        try:
+            ivf = IvfIndex(self.ivf_path)
+            if ivf.tag != self.knn_tag(g) or ivf.dim != int(g.features.shape[1]):
+                raise ValueError("index was built for a different gallery; rebuild with build_ivf.py")
+            g.ivf = ivf
+            g.ann = self.ann_params(ivf.table.get("points", []))
+        except Exception as e:
+            g.error = f"Ignoring ANN index: {e}"
+
+    def ann_params(self, points: List[dict]) -> Optional[tuple]:
+        """
+        从 Pareto 表选 (nprobe, rerank)；None 表示走精确检索（没有目标、没有调参表，或精确扫描本身就是最优点）。
+
+        - 设置了 ann_target_p95_ms：只考虑 p95 不超过预算的点（都超了就取最快的点）
+        - 设置了 ann_target_recall：在上面的点里取满足召回的最快点，达不到就取召回最高的点
+        - 只有延迟目标：取预算内召回最高的点
+        """
+        if not points or (self.ann_target_p95_ms <= 0 and self.ann_target_recall <= 0):
+            return None
+        pts = sorted(points, key=lambda p: (p["p95_ms"], -p["recall"]))
+        if self.ann_target_p95_ms > 0:
+            pts = [p for p in pts if p["p95_ms"] <= self.ann_target_p95_ms] or pts[:1]
+        ok = [p for p in pts if p["recall"] >= self.ann_target_recall] if self.ann_target_recall > 0 else []
+        best = ok[0] if ok else max(pts, key=lambda p: (p["recall"], -p["p95_ms"]))
+        if int(best.get("nprobe", 0)) <= 0:
+            return None
+        return int(best["nprobe"]), int(best["rerank"])
+
+    def _load_delta(self, g: GalleryState) -> None:
+        """
+        读取增量段 sidecar（gallery_format.write_delta 写出），原始特征在这里投影到检索空间，墓碑按路径反查为 base 行号。
+
+        已经在 base 里的路径跳过：合并写完 base、还没清空增量段时进程崩溃，留下的增量段不会重复出行。
+        """
+        g.delta_stamp = self._file_stamp([self.delta_path])
+        if g.features is None or not self.delta_path or not os.path.exists(self.delta_path):
+            return
+        try:
+            d = read_delta(self.delta_path)
+            if d.tag != "raw":
+                raise ValueError(f"delta holds '{d.tag}' features, expected raw (re-add these images)")
+            keep = np.flatnonzero(~self._in_base(g, d.paths))
+            if keep.size:
+                feats = g.project(np.asarray(d.features[keep], dtype=np.float32))
+                if feats.shape[1] != g.features.shape[1]:
+                    raise ValueError(f"delta dim {d.features.shape[1]} does not match the gallery")
+                g.delta_features = np.ascontiguousarray(feats, dtype=np.float32)
+                g.delta_paths = [d.paths[int(i)] for i in keep]
+            if d.deleted:
+                rows = g.paths.find_many(d.deleted) if isinstance(g.paths, PathTable) else np.zeros((0,), np.int64)
+                g.tombstones = np.unique(rows[rows >= 0])
+        except Exception as e:
+            g.error = f"Failed to load gallery delta: {e}"
+
+    def _load_gallery(self):
+        g = self._build_gallery(version=self._gallery.version + 1)
+        self._gallery = g
+        self._results.invalidate(g.version)
+        self.last_error = g.error
+
+    # ---------- Hot reload ----------
+    def _gallery_stamp(self) -> tuple:
+        """base 图库相关文件的 (path, mtime_ns, size)；任何一个变化都视为需要重新加载。"""
+        return self._file_stamp([self.gallery_file_path, self.gallery_features_path, self.gallery_index_path,
+                                 self.pca_path, self.knn_path, self.ivf_path, self.reload_trigger_path])
+
+    @staticmethod
+    def _file_stamp(paths: List[str]) -> tuple:
+        stamp = []
+        for p in paths:
+            if not p:
+                continue
+            try:
+                st = os.stat(p)
+                stamp.append((p, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append((p, None, None))
+        return tuple(stamp)
+
+    def reload_gallery(self) -> bool:
+        """
+        重新加载图库并原子替换，模型保持加载状态。
+
+        新索引加载失败时保留旧索引继续服务，返回 False。并发调用会串行化。
+        """
+        with self._reload_lock:
+            old = self._gallery
+            g = self._build_gallery(version=old.version + 1)
+            if g.features is None and old.features is not None:
+                self.last_error = f"Gallery reload failed, keeping version {old.version}: {g.error}"
+                return False
+            self._gallery = g
+            self._results.invalidate(g.version)
+            self.last_error = g.error
+            return True
+
+    def reload_delta(self) -> None:
+        """只重新读取增量段（base 不变），生成新快照并替换。"""
+        with self._reload_lock:
+            old = self._gallery
+            g = old.with_base(old.version + 1)
+            self._load_delta(g)
+            self._gallery = g
+            self._results.invalidate(g.version)
+            self.last_error = g.error
+
+    def reload_gallery_async(self) -> threading.Thread:
+        t = threading.Thread(target=self.reload_gallery, name="gallery-reload", daemon=True)
+        t.start()
+        return t
+
+    # ---------- Live add / remove ----------
+    @staticmethod
+    def _in_base(g: GalleryState, rels: List[str]) -> np.ndarray:
+        """每个相对路径是否已经在 base 里（base 里的路径可能是 "/" 或 Windows "\\" 分隔）。"""
+        if not rels or not isinstance(g.paths, PathTable):
+            return np.zeros((len(rels),), dtype=bool)
+        rows = g.paths.find_many(list(rels) + [p.replace("/", "\\") for p in rels])
+        return (rows[:len(rels)] >= 0) | (rows[len(rels):] >= 0)
+
+    def _raw_dim(self, g: GalleryState) -> int:
+        return int(g.pca_proj.shape[0]) if g.pca_proj is not None else int(g.features.shape[1])
+
+    def _sync_with_disk(self) -> None:
+        """拿到 gallery_lock 后调用：别的进程可能已经改写增量段或合并过 base，先按磁盘上的文件刷新快照。"""
+        g = self._gallery
+        if self._gallery_stamp() != g.stamp:
+            self.reload_gallery()
+        elif self._file_stamp([self.delta_path]) != g.delta_stamp:
+            self.reload_delta()
+
+    @staticmethod
+    def _read_raw_delta(path: str):
+        d = read_delta(path) if os.path.exists(path) else None
+        if d is not None and d.tag != "raw":
+            raise RuntimeError(f"gallery delta holds '{d.tag}' features from an older version; remove {path} first")
+        return d
+
+    def _gallery_rel(self, path_or_url: str) -> str:
+        """图库 url 或相对路径 -> 相对 gallery root 的路径（"/" 分隔）。"""
+        p = (path_or_url or "").strip()
+        for prefix in (self.cdn_base, self.gallery_url_prefix):
+            if prefix and p.startswith(prefix):
+                p = unquote(p[len(prefix):])
+                break
+        return p.replace("\\", "/").lstrip("/")
+
+    def add_images(self, images: List[tuple]) -> List[str]:
+        """
+        在线加入新图片：images 为 [(文件名, 图片字节)]。
+
+        用已加载的模型批量 embedding，原图存到 gallery_root/upload_subdir（按内容 sha256 命名，
+        重复上传自动去重），原始特征追加到增量段文件，其他 worker 由 watcher 感知。返回新图的相对路径。
+        """
+        if not self.gallery_root_abs:
+            raise RuntimeError("gallery_root is required to store new images")
+        if not self.delta_path:
+            raise RuntimeError("delta_path is not configured")
+
+        with self._reload_lock, gallery_lock(self.delta_path):
+            self._sync_with_disk()
+            g = self._gallery
+            if g.features is None:
+                raise RuntimeError(self.last_error or "gallery not loaded")
+
+            d = self._read_raw_delta(self.delta_path)
+            known = set(d.paths) if d is not None else set()
+            new_rels, new_bytes = [], []
+            for name, data in images:
+                ext = os.path.splitext(name or "")[1].lower()
+                if ext not in (".jpg", ".jpeg", ".png", ".webp", ".bmp"):
+                    ext = ".jpg"
+                rel = f"{self.upload_subdir}/{hashlib.sha256(data).hexdigest()[:24]}{ext}"
+                if rel in known or rel in new_rels:
+                    continue
+                new_rels.append(rel)
+                new_bytes.append(data)
+            if not new_rels:
+                return []
+
+            # 先 embedding（坏图直接抛错），成功后再落盘；增量段存投影前的特征，合并进 base 时原样写入
+            V = self._embed_raw(new_bytes)
+            for rel, data in zip(new_rels, new_bytes):
+                dst = os.path.join(self.gallery_root_abs, *rel.split("/"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                with open(dst, "wb") as f:
+                    f.write(data)
+
+            if d is not None and len(d.paths):
+                feats = np.concatenate([d.features, V], axis=0)
+                paths = list(d.paths) + new_rels
+            else:
+                feats, paths = V, new_rels
+            # 重新加入之前删除过的图片时撤销墓碑
+            deleted = [p for p in (d.deleted if d is not None else []) if p not in set(new_rels)]
+            write_delta(self.delta_path, feats, paths, deleted, tag="raw")
+            self.reload_delta()
+            return new_rels
+
+    def remove_images(self, paths_or_urls: List[str]) -> int:
+        """在线删除：增量段里的图直接移除，base 里的图记为墓碑（合并时真正删掉）。返回删除条数。"""
+        if not self.delta_path:
+            raise RuntimeError("delta_path is not configured")
+
+        with self._reload_lock, gallery_lock(self.delta_path):
+            self._sync_with_disk()
+            g = self._gallery
+            if g.features is None:
+                raise RuntimeError(self.last_error or "gallery not loaded")
+
+            d = self._read_raw_delta(self.delta_path)
+            feats = d.features if d is not None else np.zeros((0, self._raw_dim(g)), dtype=np.float32)
+            paths = list(d.paths) if d is not None else []
+            deleted = list(d.deleted) if d is not None else []
+
+            removed = 0
+            keep = np.ones((len(paths),), dtype=bool)
+            pos = {p: i for i, p in enumerate(paths)}
+            base_rels = []
+            for raw in paths_or_urls:
+                rel = self._gallery_rel(raw)
+                if not rel:
+                    continue
+                if rel in pos:
+                    if keep[pos[rel]]:
+                        keep[pos[rel]] = False
+                        removed += 1
+                    continue
+                base_rels.append(rel)
+
+            # base 里的路径可能是 "/" 或 Windows "\\" 分隔：两种写法一次批量反查（持锁期间不逐条查）
+            if base_rels and isinstance(g.paths, PathTable):
+                rows = g.paths.find_many(base_rels + [p.replace("/", "\\") for p in base_rels])
+                gone = set(deleted)
+                for i, rel in enumerate(base_rels):
+                    cand = rel if rows[i] >= 0 else rel.replace("/", "\\") if rows[len(base_rels) + i] >= 0 else None
+                    if cand is not None and cand not in gone:
+                        gone.add(cand)
+                        deleted.append(cand)
+                        removed += 1
+
+            if removed:
+                write_delta(self.delta_path, feats[keep], [p for p, k in zip(paths, keep) if k], deleted, tag="raw")
+                self.reload_delta()
+            return removed
+
+    def merge_delta(self) -> int:
+        """
+        把增量段合并进 base：剔除墓碑行、追加新行，分块写出新的 base 文件（.idx 或 npy + csv），
+        随后删除增量段并重新加载。返回合并后的行数。
+
+        全程持有 gallery_lock：base 和增量段都从磁盘上的原始特征（未投影）读出，写到临时文件后 os.replace；
+        base 替换完成后才删除增量段，中间崩溃时留下的增量段在加载时按路径跳过已合并的行（见 _load_delta）。
+        """
+        if not self.delta_path:
+            raise RuntimeError("delta_path is not configured")
+        if self.shard is not None or self._shards is not None:
+            raise RuntimeError("merge the delta on the full gallery, not on a shard")
+
+        with self._reload_lock, gallery_lock(self.delta_path):
+            self._sync_with_disk()
+            g = self._gallery
+            if g.features is None:
+                raise RuntimeError(self.last_error or "gallery not loaded")
+            if not g.has_delta:
+                if os.path.exists(self.delta_path):
+                    # 只剩已经合并过的行（上次合并在删除增量段前中断）
+                    os.remove(self.delta_path)
+                    self.reload_delta()
+                return int(g.features.shape[0])
+
+            # 检索矩阵可能已经投影/归一化过，合并用磁盘上的原始特征
+            if g.gallery_file is not None:
+                base = g.gallery_file.features
+            else:
+                base = np.load(self.gallery_features_path, mmap_mode="r", allow_pickle=False)
+            n = int(g.features.shape[0])
+            dim = self._raw_dim(g)
+            if base.ndim != 2 or base.shape[0] < n or base.shape[1] != dim:
+                raise RuntimeError(f"base features {base.shape} changed on disk, expected ({n}, {dim})")
+            d = self._read_raw_delta(self.delta_path) if g.delta_paths else None
+            if d is not None:
+                pos = {p: i for i, p in enumerate(d.paths)}
+                delta_raw = d.features[[pos[p] for p in g.delta_paths]]
+            else:
+                delta_raw = np.zeros((0, dim), dtype=np.float32)
+
+            alive = np.ones((n,), dtype=bool)
+            alive[g.tombstones] = False
+            m = int(delta_raw.shape[0])
+            total = int(alive.sum()) + m
+
+            target = self.gallery_file_path if g.gallery_file is not None else self.gallery_features_path
+            tmp = target + ".merge.npy"
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(total, dim))
+            w = 0
+            for off in range(0, n, self.chunk_rows):
+                x = np.asarray(base[off:min(n, off + self.chunk_rows)], dtype=np.float32)[alive[off:off + self.chunk_rows]]
+                out[w:w + x.shape[0]] = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+                w += x.shape[0]
+            if m:
+                out[w:w + m] = delta_raw
+            out.flush()
+
+            def iter_paths():
+                for i in np.flatnonzero(alive):
+                    yield g.paths[int(i)]
+                yield from g.delta_paths
+
+            # 属性列原样保留（增量段的新图没有属性，留空）
+            attr_cols = list(g.attrs)
+            attr_names = {c: list(g.attrs[c][1]) for c in attr_cols}
+
+            def iter_rows():
+                rows = np.flatnonzero(alive)
+                for i, p in zip(rows, iter_paths()):
+                    yield [p] + [attr_names[c][int(g.attrs[c][0][i])] for c in attr_cols]
+                for p in g.delta_paths:
+                    yield [p] + [""] * len(attr_cols)
+
+            if g.gallery_file is not None:
+                write_gallery_file(target, out, list(iter_paths()), fingerprint=g.gallery_file.header.fingerprint,
+                                   normalize=True, chunk_rows=self.chunk_rows)
+                del out
+                os.remove(tmp)
+            else:
+                del out
+                # 两个临时文件都写完整了再连续替换，npy 和 csv 行数不一致的窗口只有两次 rename 之间
+                idx_tmp = self.gallery_index_path + ".tmp"
+                with open(idx_tmp, "w", encoding="utf-8", newline="") as f:
+                    wr = csv.writer(f)
+                    wr.writerow(["path"] + attr_cols)
+                    wr.writerows(iter_rows())
+                os.replace(tmp, target)
+                os.replace(idx_tmp, self.gallery_index_path)
+
+            # 持有锁期间没有别的进程能改增量段，磁盘上的增量段已经全部合并
+            if os.path.exists(self.delta_path):
+                os.remove(self.delta_path)
+            self.reload_gallery()
+            return total
+
+    def start_watcher(self, interval: float = 5.0) -> None:
+        """
+        后台轮询图库文件（含 reload_trigger_path）的 mtime/size，变化后在后台加载新索引并替换。
+
+        要求连续两次轮询看到相同的新 stamp 才触发，避免读到正在写入的文件。
+        """
+        if interval <= 0 or self._watcher is not None:
+            return
+
+        def loop():
+            pending = None
+            while not self._closed.wait(interval):
+                try:
+                    cur = self._gallery
+                    stamp = (self._gallery_stamp(), self._file_stamp([self.delta_path]))
+                    if stamp == (cur.stamp, cur.delta_stamp):
+                        pending = None
+                        continue
+                    if stamp != pending:
+                        pending = stamp
+                        continue
+                    pending = None
+                    if stamp[0] != cur.stamp:
+                        self.reload_gallery()
+                    else:
+                        self.reload_delta()
+                except Exception as e:
+                    self.last_error = f"Gallery watcher error: {e}"
+
+        self._watcher = threading.Thread(target=loop, name="gallery-watcher", daemon=True)
+        self._watcher.start()
+
+    def memory_bytes(self) -> int:
+        return self._gallery.nbytes()
+
+    def close(self) -> None:
+        """停止 watcher 和分片线程池（多图库 LRU 卸载时调用）。进行中的检索持有快照引用，不受影响。"""
+        self._closed.set()
+        self._results.invalidate()
+        if self._shards is not None:
+            self._shards.close()
+        if self._search_pool is not None:
+            self._search_pool.shutdown(wait=False)
+            self._search_pool = None
 
     def embed_query(self, image_bytes: bytes) -> np.ndarray:
         self._ensure_vit()
         assert self._vit is not None
         img = Image.open(io.BytesIO(image_bytes))
         x = self._preprocess_pil(img, target=224)
-        v = self._vit(x)[0].astype(np.float32, copy=False)
-        return _norm(v)
+        # 预处理在调用线程里做，只有前向进入微批
+        v = self._batcher.embed(x) if self._batcher is not None else self._vit(x)[0]
+        return self._project(_norm(np.asarray(v, dtype=np.float32)))
+
+    def embed_queries(self, images: List[bytes], batch_size: int = 8) -> np.ndarray:
+        """批量 embedding：每 batch_size 张图做一次前向，返回检索空间的 (B, D)。"""
+        return self._project(self._embed_raw(images, batch_size))
+
+    def _embed_raw(self, images: List[bytes], batch_size: int = 8) -> np.ndarray:
+        """批量 embedding，只做 L2 归一化、不做 PCA 投影（增量段按这个空间存）。"""
+        self._ensure_vit()
+        assert self._vit is not None
+        xs = [self._preprocess_pil(Image.open(io.BytesIO(b)), target=224) for b in images]
+        if not xs:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        out = []
+        step = max(1, int(batch_size))
+        for i in range(0, len(xs), step):
+            x = np.concatenate(xs[i:i + step], axis=0)
+            try:
+                v = self._vit(x)
+            except Exception:
+                # 部分 ONNX 模型导出时 batch 维固定为 1，逐张回退
+                v = np.concatenate([self._vit(xi) for xi in xs[i:i + step]], axis=0)
+            out.append(np.asarray(v, dtype=np.float32))
+        V = np.concatenate(out, axis=0)
+        V = V / (np.linalg.norm(V, axis=1, keepdims=True) + 1e-12)
+        return V.astype(np.float32, copy=False)
 
     def warmup(self, do_embed: bool = False) -> None:
         """预热模型加载，减少第一次检索的额外开销。
@@ -222,14 +1233,60 @@ class SearchEngine:
             return self.cdn_base + rel_q
         return self.gallery_url_prefix + rel_q
 
-    def search(self, q: np.ndarray, topk: int = 50) -> List[SearchResult]:
-        feats = self.features
+    def search(self, q: np.ndarray, topk: int = 50, flt: Optional[SearchFilter] = None) -> Sequence[SearchResult]:
+        g = self._gallery
+        key = None
+        # 协调端不缓存：各分片各自热更新，本地快照版本看不到分片的变化
+        if self._results.enabled and g.features is not None and g.remote is None:
+            key = (query_digest(q), int(topk), flt)
+            hits = self._results.get(g.version, key)
+            if hits is not None:
+                return hits
+        if g.remote is not None:
+            hits = self._remote_search(g, q, topk, flt)[0]
+        else:
+            hits = self._search(g, q, topk, flt)
+        # 失败/空库时返回的是空 list，不缓存
+        if key is not None and isinstance(hits, SearchHits):
+            self._results.put(g.version, key, hits)
+        return hits
+
+    def _remote_query(self, g: GalleryState, Q: np.ndarray) -> np.ndarray:
+        Q = np.asarray(Q, dtype=np.float32)
+        if Q.ndim == 1:
+            Q = Q[None, :]
+        Q = Q / (np.linalg.norm(Q, axis=1, keepdims=True) + 1e-12)
+        if Q.shape[1] != g.remote.dim:
+            Q = g.project(Q)
+        if Q.shape[1] != g.remote.dim:
+            raise ValueError(f"query dim {Q.shape[1]} != shard dim {g.remote.dim}")
+        return Q
+
+    def _remote_hits(self, scores: np.ndarray, ids: np.ndarray, paths: List[str]) -> SearchHits:
+        by_id = dict(zip(ids.tolist(), paths))
+        to_url = self._to_url
+        return SearchHits(ids, scores, lambda idx: to_url(by_id[int(idx)]))
+
+    def _remote_search(self, g: GalleryState, Q: np.ndarray, topk: int, flt: Optional[SearchFilter] = None):
+        """协调端：query 并行发给所有分片，各分片的 TopK 合并成全局 TopK。"""
+        Q = self._remote_query(g, Q)
+        return [self._remote_hits(*hit) for hit in g.remote.search(Q, int(topk), flt)]
+
+    def _search(self, g: GalleryState, q: np.ndarray, topk: int, flt: Optional[SearchFilter] = None):
+        feats = g.features
         if feats is None:
             return []
+        # 允许直接传入未降维的 768-d 向量（例如历史记录里的 query_feat）
+        if q.ndim == 1 and q.shape[0] != feats.shape[1]:
+            q = g.project(_norm(q.astype(np.float32, copy=False)))
         if q.ndim != 1 or q.shape[0] != feats.shape[1]:
             return []
 
-        n = int(feats.shape[0])
+        if flt is not None:
+            subset = self._filter_rows(g, flt)
+            n = int(subset[0].size + subset[3].size)
+        else:
+            n = g.size()
         if n <= 0:
             return []
 
@@ -239,6 +1296,16 @@ class SearchEngine:
         if topk > n:
             topk = n
 
+        if flt is not None:
+            scores, top = self._scan_subset(g, q[None, :], topk, subset)
+            return self._make_results(g, top[0], scores[0])
+        if g.has_delta:
+            scores, top = self._scan_all(g, q[None, :], topk)
+            return self._make_results(g, top[0], scores[0])
+        if g.ann is not None or g.streaming or len(self._shard_bounds(n)) > 1:
+            scores, top = self._scan_base(g, q[None, :], topk)
+            return self._make_results(g, top[0], scores[0])
+
         # Cosine similarity: dot product with normalized vectors
         sims = feats @ q
 
@@ -249,11 +1316,503 @@ class SearchEngine:
             top_indices = np.argpartition(-sims, kth=topk - 1)[:topk]
             top_indices = top_indices[np.argsort(-sims[top_indices])]
 
-        results = []
-        for idx in top_indices:
-            score = float(sims[idx])
-            path = self.paths[int(idx)] if int(idx) < len(self.paths) else f"{idx}.jpg"
-            url = self._to_url(path)
-            results.append(SearchResult(url=url, score=score))
+        return self._make_results(g, top_indices, sims[top_indices])
+
+    # ---------- More like this ----------
+    def row_of(self, path_or_url: str) -> int:
+        """图库 url / 相对路径 -> 行号（增量段的行号接在 base 之后），找不到返回 -1。"""
+        return self._row_of(self._gallery, path_or_url)
+
+    def neighbors(self, row: int, topk: int = 50) -> Sequence[SearchResult]:
+        """图库第 row 行的相似图（不含自身），见 _neighbors。"""
+        return self._neighbors(self._gallery, row, topk)
+
+    def similar_to(self, path_or_url: Optional[str] = None, row: int = -1, topk: int = 50,
+                   scan: bool = True) -> Tuple[int, Optional[str], Optional[Sequence[SearchResult]]]:
+        """
+        more like this：给 url（或直接给行号）返回 (行号, 该行 url, 相似图)。
+        三者取自同一个快照，热更新前后不会把行号和另一份图库对上；找不到时行号为 -1、url 为 None。
+        scan=False 时只读 kNN 图：需要精确检索（没有 kNN 图、增量行、topk 超过图的 k）时相似图返回 None，
+        由调用方放进任务队列再调一次。
+        """
+        g = self._gallery
+        if path_or_url:
+            row = self._row_of(g, path_or_url)
+        row = int(row)
+        n = 0 if g.features is None else int(g.features.shape[0])
+        m = 0 if g.delta_features is None else int(g.delta_features.shape[0])
+        if row < 0 or row >= n + m:
+            return -1, None, []
+        url = self._resolver(g)(row)
+        if not scan and not self._knn_covers(g, row, int(topk)):
+            return row, url, None
+        return row, url, self._neighbors(g, row, topk)
+
+    @staticmethod
+    def _knn_covers(g: GalleryState, row: int, topk: int) -> bool:
+        return g.knn is not None and row < int(g.features.shape[0]) and topk <= g.knn.k
+
+    def _row_of(self, g: GalleryState, path_or_url: str) -> int:
+        rel = self._gallery_rel(path_or_url)
+        if g.features is None or not rel:
+            return -1
+        n = int(g.features.shape[0])
+        if isinstance(g.paths, PathTable):
+            rows = g.paths.find_many([rel, rel.replace("/", "\\")])
+            hit = rows[rows >= 0]
+            if hit.size and not np.isin(hit[0], g.tombstones):
+                return int(hit[0])
+        if rel in g.delta_paths:
+            return n + g.delta_paths.index(rel)
+        return -1
 
-        return results
+    def _neighbors(self, g: GalleryState, row: int, topk: int) -> Sequence[SearchResult]:
+        """
+        有 kNN 图时直接读预计算的邻居（只读 k 个 int32/float16，无 embedding、无扫描），
+        墓碑行在这里剔除；增量段的新图、或 topk 超过图的 k 时，用该行已存的特征向量做一次精确检索。
+        """
+        if g.features is None:
+            return []
+        n = int(g.features.shape[0])
+        row, topk = int(row), int(topk)
+        m = 0 if g.delta_features is None else int(g.delta_features.shape[0])
+        if topk <= 0 or row < 0 or row >= n + m:
+            return []
+
+        if self._knn_covers(g, row, topk):
+            ids = np.asarray(g.knn.ids[row], dtype=np.int64)
+            scores = np.asarray(g.knn.scores[row], dtype=np.float32)
+            if g.tombstones.size:
+                alive = ~np.isin(ids, g.tombstones)
+                ids, scores = ids[alive], scores[alive]
+            return self._make_results(g, ids[:topk], scores[:topk])
+
+        q = np.asarray(g.features[row] if row < n else g.delta_features[row - n], dtype=np.float32)
+        hits = self._search(g, q, topk + 1)
+        if not len(hits):
+            return hits
+        keep = hits.indices != row
+        return self._make_results(g, hits.indices[keep][:topk], hits.scores[keep][:topk])
+
+    def exact_neighbors(self, lo: int, hi: int, k: int):
+        """
+        base 第 lo..hi 行各自的 k 个最近邻（不含自身），返回 (ids int64 (b, k), scores float32 (b, k))。
+        供 build_knn.py 离线建图，直接在检索空间的行向量上打分，不经过 embedding。
+        """
+        g = self._gallery
+        n = int(g.features.shape[0])
+        k = min(int(k), n - 1)
+        Q = np.asarray(g.features[lo:hi], dtype=np.float32)
+        scores, ids = self._scan_topk(g, Q, k + 1)
+        rows = np.arange(lo, lo + Q.shape[0], dtype=np.int64)[:, None]
+        drop = ids == rows
+        # 自身没进 k+1（大量完全重复的图时可能出现）就丢掉最后一列
+        miss = ~drop.any(axis=1)
+        drop[miss, -1] = True
+        first = drop & (np.cumsum(drop, axis=1) == 1)
+        keep = ~first
+        return ids[keep].reshape(-1, k), scores[keep].reshape(-1, k)
+
+    def _resolver(self, g: GalleryState) -> Callable[[int], str]:
+        paths = g.paths
+        delta_paths = g.delta_paths
+        n = len(paths)
+        to_url = self._to_url
+
+        def resolve(idx: int) -> str:
+            if idx < n:
+                return to_url(paths[idx])
+            if idx - n < len(delta_paths):
+                return to_url(delta_paths[idx - n])
+            return to_url(f"{idx}.jpg")
+
+        return resolve
+
+    def _make_results(self, g: GalleryState, indices: np.ndarray, scores: np.ndarray) -> SearchHits:
+        return SearchHits(indices, scores, self._resolver(g), self._hits_tag(g, indices))
+
+    def _rows_tag(self, g: GalleryState) -> str:
+        """
+        base 行号 -> 图片的对应关系的标识，只看 base 行：.idx 取 header 里的行数、路径表大小和建库指纹，
+        npy + csv 取路径表的内容 CRC（CSV 加载时已整份读入，算一遍只要几十毫秒），再加分片起始行。
+        跨进程、跨重启都相同；touch/拷贝/重新部署同样内容的 CSV、重建 kNN/IVF、换 PCA 都不影响，
+        合并增量或重建图库后改变。
+        协调端的行号来自分片，本地解析不了，返回空串。
+        """
+        if g.rows_tag is None:
+            if g.remote is not None or g.features is None:
+                g.rows_tag = ""
+            else:
+                if g.gallery_file is not None:
+                    h = g.gallery_file.header
+                    src = ("idx", h.count, int(g.gallery_file.paths.blob.shape[0]), h.fingerprint)
+                elif self.gallery_index_path and isinstance(g.paths, PathTable):
+                    src = ("csv", g.paths.checksum())
+                else:
+                    src = ("none",)
+                key = repr((src, int(g.features.shape[0]), g.row_offset)).encode("utf-8")
+                g.rows_tag = hashlib.sha1(key).hexdigest()[:32]
+        return g.rows_tag
+
+    @staticmethod
+    def _delta_crc(g: GalleryState, k: int) -> Optional[str]:
+        """增量段前 k 行路径的 crc；增量段只追加时前缀不变，删过其中的图后前缀改变。"""
+        if k > len(g.delta_paths):
+            return None
+        blob = "\n".join(g.delta_paths[:k]).encode("utf-8")
+        return f"{zlib.crc32(blob):08x}"
+
+    def _hits_tag(self, g: GalleryState, indices: np.ndarray) -> str:
+        """结果的行号空间：base 标识，结果里有增量行时再加上所引用的增量段前缀（行数 + crc）。"""
+        base = self._rows_tag(g)
+        n = 0 if g.features is None else int(g.features.shape[0])
+        if not base or not len(indices) or int(np.max(indices)) < n:
+            return base
+        k = int(np.max(indices)) - n + 1
+        return f"{base}+{k}-{self._delta_crc(g, k)}"
+
+    @property
+    def rows_tag(self) -> str:
+        return self._rows_tag(self._gallery)
+
+    def resolve_rows(self, rows: np.ndarray, scores: np.ndarray, rows_tag: str) -> Optional[SearchHits]:
+        """按保存下来的行号/分数重建结果（url 用当前快照解析）；行号在当前快照里已经对不上时返回 None。"""
+        g = self._gallery
+        base, _, delta = (rows_tag or "").partition("+")
+        if not base or base != self._rows_tag(g):
+            return None
+        if delta:
+            k, _, crc = delta.partition("-")
+            if not k.isdigit() or self._delta_crc(g, int(k)) != crc:
+                return None
+        return self._make_results(g, rows, scores)
+
+    def _shard_bounds(self, n: int) -> List[tuple]:
+        if self.search_threads <= 1 or n < 2 * self.min_shard_rows:
+            return [(0, n)]
+        shards = min(self.search_threads, n // self.min_shard_rows)
+        edges = np.linspace(0, n, shards + 1).astype(np.int64).tolist()
+        return list(zip(edges[:-1], edges[1:]))
+
+    def _get_search_pool(self) -> ThreadPoolExecutor:
+        if self._search_pool is None:
+            self._search_pool = ThreadPoolExecutor(max_workers=self.search_threads, thread_name_prefix="search-shard")
+        return self._search_pool
+
+    def _scan_range(self, g: GalleryState, Q: np.ndarray, topk: int, lo: int, hi: int):
+        feats = g.features
+        step = self.chunk_rows if g.streaming else hi - lo
+        best_s = best_i = None
+        for off in range(lo, hi, step):
+            sims = Q @ feats[off:min(off + step, hi)].T  # (b, chunk)
+            cand_s, cand_i = _topk_rows(sims, topk)
+            best_s, best_i = _merge_topk(best_s, best_i, cand_s, cand_i + off, topk)
+        return best_s, best_i
+
+    def _scan_topk(self, g: GalleryState, Q: np.ndarray, topk: int):
+        """
+        (b, D) query 对整个图库取 TopK，返回 (scores, indices)，形状 (b, k)。
+
+        streaming 时按 chunk_rows 分块扫描 memmap，每块只保留局部 TopK 并与 running TopK 合并，
+        常驻内存 = 一个分块的相似度矩阵 + (b, k) 候选，与图库大小无关。
+        图库足够大且 search_threads > 1 时按行分片，分片在线程池里各自打分取局部 TopK
+        （matmul/argpartition 都会释放 GIL），最后合并，结果与单线程完全一致。
+        """
+        n = int(g.features.shape[0])
+        bounds = self._shard_bounds(n)
+        if len(bounds) == 1:
+            return self._scan_range(g, Q, topk, 0, n)
+
+        pool = self._get_search_pool()
+        parts = list(pool.map(lambda b: self._scan_range(g, Q, topk, b[0], b[1]), bounds))
+
+        best_s = best_i = None
+        for cand_s, cand_i in parts:
+            best_s, best_i = _merge_topk(best_s, best_i, cand_s, cand_i, topk)
+        return best_s, best_i
+
+    def _scan_base(self, g: GalleryState, Q: np.ndarray, topk: int):
+        """base 行的 TopK：选出了 ANN 参数时走 IVF，否则精确扫描。"""
+        if g.ann is not None:
+            return self._ivf_topk(g, Q, topk, *g.ann)
+        return self._scan_topk(g, Q, topk)
+
+    def _ivf_topk(self, g: GalleryState, Q: np.ndarray, topk: int, nprobe: int, rerank: int):
+        """
+        IVF 近似 TopK，返回形状与 _scan_topk 相同的 (scores, indices)。
+
+        每个 query 取粗排分最高的 nprobe 个倒排表，用 float16 副本打分，留下 max(rerank, topk) 个候选，
+        再用 base 特征（float32）精确重排。候选不足 topk 的 query（倒排表太小）退回精确扫描。
+        """
+        ivf = g.ivf
+        feats = g.features
+        nprobe = max(1, min(int(nprobe), ivf.nlist))
+        keep = max(int(rerank), topk)
+        coarse = Q @ ivf.centroids.T
+        probe = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe] if nprobe < ivf.nlist else None
+
+        out_s = np.empty((Q.shape[0], topk), dtype=np.float32)
+        out_i = np.empty((Q.shape[0], topk), dtype=np.int64)
+        for r in range(Q.shape[0]):
+            q = Q[r]
+            lists = probe[r] if probe is not None else np.arange(ivf.nlist)
+            parts_s, parts_p = [], []
+            for l in lists:
+                lo, hi = int(ivf.lists[l]), int(ivf.lists[l + 1])
+                if hi > lo:
+                    parts_s.append(ivf.codes[lo:hi].astype(np.float32) @ q)
+                    parts_p.append(np.arange(lo, hi, dtype=np.int64))
+            n_cand = sum(p.size for p in parts_p)
+            if n_cand < topk:
+                s, i = self._scan_topk(g, Q[r:r + 1], topk)
+                out_s[r], out_i[r] = s[0], i[0]
+                continue
+
+            sims = np.concatenate(parts_s)
+            pos = np.concatenate(parts_p)
+            if n_cand > keep:
+                sel = np.argpartition(-sims, keep - 1)[:keep]
+                pos = pos[sel]
+            # 按行号排序后再取 base 特征，mmap 上读取更连续
+            rows = np.sort(ivf.ids[pos].astype(np.int64))
+            exact = np.asarray(feats[rows], dtype=np.float32) @ q
+            s, i = _topk_rows(exact[None, :], topk)
+            out_s[r], out_i[r] = s[0], rows[i[0]]
+        return out_s, out_i
+
+    def _scan_all(self, g: GalleryState, Q: np.ndarray, topk: int):
+        """
+        base + 增量段的 TopK。base 多取 len(墓碑) 个候选再剔除墓碑行，
+        增量段（通常很小）直接整块打分，行号加上 base 行数后合并。调用方保证 topk <= g.size()。
+        """
+        n = int(g.features.shape[0])
+        best_s = best_i = None
+        k = min(n, topk + int(g.tombstones.size))
+        if k > 0:
+            best_s, best_i = self._scan_base(g, Q, k)
+            if g.tombstones.size:
+                dead = np.isin(best_i, g.tombstones)
+                best_s, pos = _topk_rows(np.where(dead, -np.inf, best_s), min(topk, k))
+                best_i = np.take_along_axis(best_i, pos, axis=1)
+        if g.delta_features is not None:
+            cand_s, cand_i = _topk_rows(Q @ g.delta_features.T, topk)
+            best_s, best_i = _merge_topk(best_s, best_i, cand_s, cand_i + n, topk)
+        return best_s, best_i
+
+    def _filter_rows(self, g: GalleryState, flt: SearchFilter):
+        """
+        过滤条件 -> (base 行号升序, 连续区间 starts, ends, 增量段行号)，墓碑行已剔除。
+
+        前缀匹配在路径字节上向量化完成，属性列直接比较取值编码；结果按快照缓存，
+        同一图集的后续检索不再重新计算。未知属性列抛 ValueError。
+        """
+        with g.filter_lock:
+            hit = g.filter_cache.get(flt)
+            if hit is not None:
+                g.filter_cache.move_to_end(flt)
+                return hit
+
+        n = int(g.features.shape[0])
+        mask = np.ones((n,), dtype=bool)
+        prefix = flt.folder + "/" if flt.folder else ""
+        if prefix:
+            mask[:] = False
+            if isinstance(g.paths, PathTable):
+                mask[g.paths.prefix_rows(prefix)] = True
+            else:
+                mask[[i for i, p in enumerate(g.paths) if p.replace("\\", "/").startswith(prefix)]] = True
+        for col, val in flt.attrs:
+            if col not in g.attrs:
+                raise ValueError(f"unknown gallery attribute: {col}")
+            codes, values = g.attrs[col]
+            mask &= codes[:n] == values.get(val, -1)
+        if g.tombstones.size:
+            mask[g.tombstones] = False
+
+        rows = np.flatnonzero(mask).astype(np.int64)
+        brk = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = rows[np.r_[0, brk]] if rows.size else rows
+        ends = rows[np.r_[brk - 1, rows.size - 1]] + 1 if rows.size else rows
+
+        # 增量段没有属性列，带属性条件时不参与
+        delta_rows = np.asarray(
+            [] if flt.attrs else [j for j, p in enumerate(g.delta_paths) if p.replace("\\", "/").startswith(prefix)],
+            dtype=np.int64,
+        )
+
+        entry = (rows, starts, ends, delta_rows)
+        # 计算在锁外做，两个线程同时算同一个条件时后写的覆盖先写的，结果相同
+        with g.filter_lock:
+            g.filter_cache[flt] = entry
+            g.filter_cache.move_to_end(flt)
+            while len(g.filter_cache) > 64:
+                g.filter_cache.popitem(last=False)
+        return entry
+
+    def _scan_subset(self, g: GalleryState, Q: np.ndarray, topk: int, subset):
+        """
+        只对过滤命中的行打分。行号基本连续时（按目录建库的常态）按区间切片扫描，memmap 顺序读；
+        行号分散时按块 gather 这些行再打分。调用方保证 topk <= 命中行数。
+        """
+        rows, starts, ends, delta_rows = subset
+        feats = g.features
+        step = self.chunk_rows
+        best_s = best_i = None
+        if starts.size * 64 <= rows.size:
+            for lo, hi in zip(starts.tolist(), ends.tolist()):
+                for off in range(lo, hi, step):
+                    cand_s, cand_i = _topk_rows(Q @ feats[off:min(off + step, hi)].T, topk)
+                    best_s, best_i = _merge_topk(best_s, best_i, cand_s, cand_i + off, topk)
+        else:
+            for i in range(0, rows.size, step):
+                idx = rows[i:i + step]
+                cand_s, pos = _topk_rows(Q @ np.asarray(feats[idx], dtype=np.float32).T, topk)
+                best_s, best_i = _merge_topk(best_s, best_i, cand_s, idx[pos], topk)
+        if delta_rows.size:
+            cand_s, pos = _topk_rows(Q @ g.delta_features[delta_rows].T, topk)
+            best_s, best_i = _merge_topk(best_s, best_i, cand_s, delta_rows[pos] + int(feats.shape[0]), topk)
+        return best_s, best_i
+
+    def _iter_blocks(self, g: GalleryState, flt: Optional[SearchFilter] = None):
+        """按块产出 (特征块, 行号)：行号为 int 表示从该行起连续，为数组表示逐行对应。墓碑行由调用方剔除。"""
+        feats = g.features
+        n = int(feats.shape[0])
+        step = self.chunk_rows
+        if flt is None:
+            for off in range(0, n, step):
+                yield feats[off:min(off + step, n)], off
+            if g.delta_features is not None:
+                yield g.delta_features, n
+            return
+
+        rows, starts, ends, delta_rows = self._filter_rows(g, flt)
+        if starts.size * 64 <= rows.size:
+            for lo, hi in zip(starts.tolist(), ends.tolist()):
+                for off in range(lo, hi, step):
+                    yield feats[off:min(off + step, hi)], off
+        else:
+            for i in range(0, rows.size, step):
+                idx = rows[i:i + step]
+                yield np.asarray(feats[idx], dtype=np.float32), idx
+        if delta_rows.size:
+            yield g.delta_features[delta_rows], delta_rows + n
+
+    def search_range(
+        self,
+        q: np.ndarray,
+        threshold: float,
+        max_results: Optional[int] = None,
+        flt: Optional[SearchFilter] = None,
+    ) -> Sequence[SearchResult]:
+        """
+        范围检索：返回分数 >= threshold 的全部结果（降序），max_results 为可选上限。
+
+        分块扫描，每块只保留过线的行。设了上限时，候选攒够后把门槛抬到当前第 max_results 名的分数，
+        之后的分块里能过线的行越来越少，候选集合始终不超过 2 * max_results。
+        协调端把门槛和上限原样发给每个分片，合并后再截断到 max_results。
+        """
+        g = self._gallery
+        if g.remote is not None:
+            return self._remote_hits(*g.remote.search_range(self._remote_query(g, q)[0], threshold, max_results, flt))
+        return self._search_range(g, q, threshold, max_results, flt)
+
+    def _search_range(self, g: GalleryState, q: np.ndarray, threshold: float, max_results: Optional[int] = None,
+                      flt: Optional[SearchFilter] = None):
+        feats = g.features
+        if feats is None:
+            return []
+        if q.ndim == 1 and q.shape[0] != feats.shape[1]:
+            q = g.project(_norm(q.astype(np.float32, copy=False)))
+        if q.ndim != 1 or q.shape[0] != feats.shape[1]:
+            return []
+
+        cap = max(0, int(max_results or 0))
+        bar = float(threshold)
+        n = int(feats.shape[0])
+        tomb = g.tombstones if flt is None else None
+        got_s: List[np.ndarray] = []
+        got_i: List[np.ndarray] = []
+        count = 0
+
+        for block, ids in self._iter_blocks(g, flt):
+            sims = block @ q
+            keep = np.flatnonzero(sims >= bar)
+            if keep.size == 0:
+                continue
+            rows = keep + ids if isinstance(ids, int) else ids[keep]
+            scores = sims[keep]
+            if tomb is not None and tomb.size:
+                alive = (rows >= n) | ~np.isin(rows, tomb)
+                rows, scores = rows[alive], scores[alive]
+            got_s.append(scores)
+            got_i.append(rows)
+            count += int(rows.size)
+
+            if cap and count >= 2 * cap:
+                s_all = np.concatenate(got_s)
+                i_all = np.concatenate(got_i)
+                top = np.argpartition(-s_all, kth=cap - 1)[:cap]
+                got_s, got_i, count = [s_all[top]], [i_all[top]], cap
+                bar = max(bar, float(s_all[top].min()))
+
+        if not got_s:
+            return self._make_results(g, np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.float32))
+        s_all = np.concatenate(got_s)
+        i_all = np.concatenate(got_i)
+        order = np.argsort(-s_all, kind="stable")
+        if cap:
+            order = order[:cap]
+        return self._make_results(g, i_all[order], s_all[order])
+
+    def search_batch(
+        self,
+        Q: np.ndarray,
+        topk: int = 50,
+        block_bytes: int = 256 << 20,
+        flt: Optional[SearchFilter] = None,
+    ) -> List[Sequence[SearchResult]]:
+        """
+        多 query 检索：(B, D) 一次 GEMM 打分 + 按行 argpartition 取 TopK。
+
+        block_bytes 限制单次相似度矩阵 (b, N) 的大小，B 很大时按 query 分块，避免内存爆掉。
+        """
+        g = self._gallery
+        if g.remote is not None:
+            Q = np.asarray(Q, dtype=np.float32)
+            return self._remote_search(g, Q, topk, flt) if Q.size else []
+        return self._search_batch(g, Q, topk, block_bytes, flt)
+
+    def _search_batch(self, g: GalleryState, Q: np.ndarray, topk: int = 50, block_bytes: int = 256 << 20,
+                      flt: Optional[SearchFilter] = None) -> List[Sequence[SearchResult]]:
+        feats = g.features
+        Q = np.asarray(Q, dtype=np.float32)
+        if Q.ndim == 1:
+            Q = Q[None, :]
+        if feats is None or Q.ndim != 2 or Q.shape[0] == 0:
+            return [[] for _ in range(Q.shape[0] if Q.ndim == 2 else 0)]
+        # 按行 L2 归一化（批量 query 常来自外部脚本，不保证已归一化），必要时再投影
+        Q = g.project(Q / (np.linalg.norm(Q, axis=1, keepdims=True) + 1e-12))
+        if Q.shape[1] != feats.shape[1]:
+            return [[] for _ in range(Q.shape[0])]
+
+        if flt is not None:
+            subset = self._filter_rows(g, flt)
+            n = int(subset[0].size + subset[3].size)
+        else:
+            n = g.size()
+        topk = min(int(topk), n)
+        if n <= 0 or topk <= 0:
+            return [[] for _ in range(Q.shape[0])]
+
+        out: List[Sequence[SearchResult]] = []
+        if flt is not None:
+            def scan(g_, Qb, k):
+                return self._scan_subset(g_, Qb, k, subset)
+        else:
+            scan = self._scan_all if g.has_delta else self._scan_base
+        rows_per_block = max(1, int(block_bytes // (4 * min(n, self.chunk_rows if g.streaming else n))))
+        for b0 in range(0, Q.shape[0], rows_per_block):
+            top_scores, top = scan(g, Q[b0:b0 + rows_per_block], topk)
+            for r in range(top.shape[0]):
+                out.append(self._make_results(g, top[r], top_scores[r]))
+        return out
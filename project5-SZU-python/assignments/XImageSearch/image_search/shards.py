@@ -0,0 +1,230 @@
+"""
+分片检索：每个分片服务进程只加载图库的一段行（SearchEngine(shard=(i, n))），协调端（SearchEngine(shard_addresses=...)）
+把 query 并行发给所有分片，合并各自的 TopK。
+
+- 传输用 multiprocessing.connection（带 authkey 认证），地址写成 "unix:/path/to.sock" 或 "host:port"
+- 连接上传的是 pickle，默认只允许 Unix socket 和回环地址；其他地址要显式 allow_remote=True（GALLERY_SHARD_ALLOW_REMOTE）
+- 分片返回全局行号（本地行号 + 分片起始行）和相对路径，协调端不持有特征矩阵也不持有路径表
+- 请求 (op, kwargs) -> 响应 ("ok", payload) 或 ("error", message)
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+def _is_loopback(host: str) -> bool:
+    if host.lower() == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_address(addr: str, allow_remote: bool = False):
+    """"unix:/tmp/shard0.sock" -> ("/tmp/shard0.sock", "AF_UNIX")；"127.0.0.1:7001" -> (("127.0.0.1", 7001), "AF_INET")。
+
+    非回环的 TCP 地址需要 allow_remote=True：authkey 泄露时对端发来的 pickle 可以在本进程执行任意代码。
+    """
+    addr = (addr or "").strip()
+    if addr.startswith("unix:"):
+        return addr[5:], "AF_UNIX"
+    host, _, port = addr.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"bad shard address: {addr!r} (expected unix:/path or host:port)")
+    if not allow_remote and not _is_loopback(host):
+        raise ValueError(f"shard address {addr!r} is not loopback; set GALLERY_SHARD_ALLOW_REMOTE=1 to allow it")
+    return (host, int(port)), "AF_INET"
+
+
+def _hit_paths(g, ids: np.ndarray) -> List[str]:
+    n = len(g.paths)
+    return [g.paths[int(i)] if i < n else g.delta_paths[int(i) - n] for i in ids]
+
+
+class ShardServer:
+    """分片服务：持有一个只加载本分片行的 SearchEngine，每个连接一个线程（打分时 BLAS 会释放 GIL）。"""
+
+    def __init__(self, engine, address: str, authkey: bytes, allow_remote: bool = False):
+        if not authkey:
+            raise ValueError("shard authkey is empty")
+        self.engine = engine
+        self.address, self.family = parse_address(address, allow_remote)
+        self.authkey = authkey
+        self._listener: Optional[Listener] = None
+
+    def serve_forever(self) -> None:
+        self._listener = Listener(self.address, family=self.family, authkey=self.authkey)
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError):
+                if self._listener is None:
+                    return
+                # 认证失败等单个连接的问题不影响服务
+                continue
+            threading.Thread(target=self._serve_conn, args=(conn,), name="shard-conn", daemon=True).start()
+
+    def close(self) -> None:
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+    def _serve_conn(self, conn) -> None:
+        with conn:
+            while True:
+                try:
+                    op, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send(("ok", self.handle(op, **kwargs)))
+                except Exception as e:
+                    conn.send(("error", f"{type(e).__name__}: {e}"))
+
+    def handle(self, op: str, **kwargs):
+        eng = self.engine
+        g = eng._gallery
+        if op == "info":
+            return {
+                "rows": g.size(),
+                "offset": g.row_offset,
+                "dim": None if g.features is None else int(g.features.shape[1]),
+                "tag": g.embedding_tag,
+                "version": g.version,
+                "error": g.error,
+            }
+        if g.features is None:
+            raise RuntimeError(eng.last_error or "gallery not loaded")
+        if op == "search":
+            Q = np.asarray(kwargs["Q"], dtype=np.float32)
+            topk = int(kwargs["topk"])
+            hits = eng._search_batch(g, Q, topk, flt=kwargs.get("flt"))
+            return [self._pack(g, h) for h in hits]
+        if op == "range":
+            h = eng._search_range(g, np.asarray(kwargs["q"], dtype=np.float32), float(kwargs["threshold"]),
+                                  kwargs.get("max_results"), kwargs.get("flt"))
+            return self._pack(g, h)
+        raise ValueError(f"unknown op: {op}")
+
+    @staticmethod
+    def _pack(g, hits):
+        if not len(hits):
+            return np.zeros((0,), np.float32), np.zeros((0,), np.int64), []
+        ids = np.asarray(hits.indices, dtype=np.int64)
+        return np.asarray(hits.scores, dtype=np.float32), ids + g.row_offset, _hit_paths(g, ids)
+
+
+class ShardClient:
+    """协调端：每个分片一个连接池（空闲连接复用，不够就新建），扇出用线程池并行等待各分片。"""
+
+    def __init__(self, addresses: Sequence[str], authkey: bytes, timeout: float = 30.0, allow_remote: bool = False):
+        self.addresses = [a.strip() for a in addresses if a and a.strip()]
+        if not self.addresses:
+            raise ValueError("no shard addresses")
+        if not authkey:
+            raise ValueError("shard authkey is empty")
+        # 先把地址都校验一遍，配置错误在启动时报出来而不是第一次检索时
+        self._targets = [parse_address(a, allow_remote) for a in self.addresses]
+        self.authkey = authkey
+        self.timeout = float(timeout)
+        self._idle = [queue.SimpleQueue() for _ in self.addresses]
+        self._pool = ThreadPoolExecutor(max_workers=len(self.addresses), thread_name_prefix="shard-client")
+        self.info: List[dict] = []
+        self.dim = 0
+        self.rows = 0
+
+    def connect(self) -> None:
+        """向所有分片取 info，检查维度一致、行段首尾相接（分片来自同一份图库）。"""
+        infos = self._fanout("info", [{}] * len(self.addresses))
+        for addr, info in zip(self.addresses, infos):
+            if info["dim"] is None:
+                raise RuntimeError(f"shard {addr} has no gallery: {info['error']}")
+        dims = {info["dim"] for info in infos}
+        if len(dims) != 1:
+            raise RuntimeError(f"shards disagree on dimension: {sorted(dims)}")
+        order = sorted(range(len(infos)), key=lambda i: infos[i]["offset"])
+        end = 0
+        for i in order:
+            if infos[i]["offset"] != end:
+                raise RuntimeError(f"shard {self.addresses[i]} starts at row {infos[i]['offset']}, expected {end}")
+            end += infos[i]["rows"]
+        self.info = infos
+        self.dim = dims.pop()
+        self.rows = end
+
+    def search(self, Q: np.ndarray, topk: int, flt=None) -> List[tuple]:
+        """(b, D) -> 每个 query 的 (scores, 全局 ids, paths)，已按分数合并为全局 TopK。"""
+        parts = self._fanout("search", [{"Q": Q, "topk": topk, "flt": flt}] * len(self.addresses))
+        out = []
+        for r in range(Q.shape[0]):
+            out.append(self._merge([p[r] for p in parts], topk))
+        return out
+
+    def search_range(self, q: np.ndarray, threshold: float, max_results: Optional[int], flt=None) -> tuple:
+        kw = {"q": q, "threshold": threshold, "max_results": max_results, "flt": flt}
+        parts = self._fanout("range", [kw] * len(self.addresses))
+        return self._merge(parts, int(max_results or 0) or sum(p[0].size for p in parts))
+
+    @staticmethod
+    def _merge(parts, topk: int) -> tuple:
+        scores = np.concatenate([p[0] for p in parts])
+        ids = np.concatenate([p[1] for p in parts])
+        paths = [s for p in parts for s in p[2]]
+        order = np.argsort(-scores, kind="stable")[:topk]
+        return scores[order], ids[order], [paths[i] for i in order]
+
+    def _fanout(self, op: str, kwargs_list: List[dict]) -> list:
+        futs = [self._pool.submit(self._call, i, op, kw) for i, kw in enumerate(kwargs_list)]
+        return [f.result() for f in futs]
+
+    def _call(self, i: int, op: str, kwargs: dict):
+        # 池里的连接可能已被分片重启断开，失败时换新连接重试一次
+        for attempt in range(2):
+            conn = self._acquire(i, fresh=attempt > 0)
+            try:
+                conn.send((op, kwargs))
+                if not conn.poll(self.timeout):
+                    raise TimeoutError(f"shard {self.addresses[i]} did not answer within {self.timeout:.0f}s")
+                status, payload = conn.recv()
+            except TimeoutError:
+                conn.close()
+                raise
+            except (EOFError, OSError) as e:
+                conn.close()
+                if attempt:
+                    raise RuntimeError(f"shard {self.addresses[i]} unreachable: {e}")
+                continue
+            except Exception:
+                conn.close()
+                raise
+            self._idle[i].put(conn)
+            if status != "ok":
+                raise RuntimeError(f"shard {self.addresses[i]}: {payload}")
+            return payload
+
+    def _acquire(self, i: int, fresh: bool = False):
+        if not fresh:
+            try:
+                return self._idle[i].get_nowait()
+            except queue.Empty:
+                pass
+        address, family = self._targets[i]
+        return Client(address, family=family, authkey=self.authkey)
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+        for q in self._idle:
+            while True:
+                try:
+                    q.get_nowait().close()
+                except queue.Empty:
+                    break
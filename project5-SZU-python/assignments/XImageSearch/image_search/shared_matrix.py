@@ -0,0 +1,129 @@
+"""
+按名字共享的只读 float32 矩阵（multiprocessing.shared_memory）。
+
+归一化/PCA 后的图库矩阵不是磁盘上现成的文件时（无法直接 mmap），第一个加载的进程把结果写进一块命名共享内存，
+同一台机器上其他进程（Django worker、检索子进程）按同一个名字直接映射，不再各自复制一份。
+
+    [header, 64 bytes] b"XISREADY"（写完数据后才写入，映射方据此判断内容已就绪）+ 创建方 pid（int64）
+    [data]             float32 (rows, dim)
+
+创建方在填充途中崩溃时，同名的半成品会一直没有 XISREADY：等待方发现创建方进程已经不在就 unlink 掉重新创建，
+不会每次加载都白等 wait_s 秒。
+
+名字由图库文件的 stamp 决定，文件变化后是一块新的共享内存；创建方的对象释放时 unlink 旧名字，
+已映射的进程不受影响（内存在最后一个映射关闭后回收）。
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import struct
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Tuple
+
+import numpy as np
+
+_HEADER = 64
+_READY = b"XISREADY"
+_PID = struct.Struct("<q")
+_PID_OFF = len(_READY)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # 没有权限发信号：进程存在
+        return True
+    return True
+
+
+def attach_shm(name: str) -> shared_memory.SharedMemory:
+    """映射已有的共享内存，不登记到本进程的 resource_tracker（否则本进程退出时会把别人的内存 unlink 掉）。"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        pass
+    shm = shared_memory.SharedMemory(name=name)
+    # multiprocessing 子进程与父进程共用同一个 resource_tracker，重复登记无害，注销反而会删掉父进程的登记
+    if mp.parent_process() is None:
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+        except Exception:
+            pass
+    return shm
+
+
+class SharedMatrix:
+    def __init__(self, shm: shared_memory.SharedMemory, shape: Tuple[int, int], owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.array = np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=_HEADER)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @classmethod
+    def open_or_create(
+        cls,
+        name: str,
+        shape: Tuple[int, int],
+        fill: Callable[[np.ndarray], None],
+        wait_s: float = 120.0,
+    ) -> "SharedMatrix":
+        """
+        已有同名矩阵就映射（等待创建方写完，最多 wait_s 秒），否则创建并调用 fill(array) 填充。
+        fill 失败时 unlink，不留下半成品。
+        """
+        shape = (int(shape[0]), int(shape[1]))
+        size = _HEADER + shape[0] * shape[1] * 4
+        deadline = time.monotonic() + wait_s
+        while True:
+            try:
+                shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                try:
+                    shm = attach_shm(name)
+                except FileNotFoundError:
+                    # 创建方刚好 unlink 了（例如填充失败），重新竞争创建
+                    continue
+                if shm.size >= size and bytes(shm.buf[:len(_READY)]) == _READY:
+                    return cls(shm, shape, owner=False)
+                pid = _PID.unpack_from(shm.buf, _PID_OFF)[0] if shm.size >= _HEADER else 0
+                # 创建方已退出（填充途中崩溃），或过了 wait_s 仍没写上 pid：半成品不会再完成，删掉重新竞争创建
+                stale = (pid > 0 and not _pid_alive(pid)) or (pid <= 0 and time.monotonic() > deadline)
+                shm.close()
+                if stale:
+                    try:
+                        dead = shared_memory.SharedMemory(name=name)
+                        dead.close()
+                        dead.unlink()
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"shared gallery {name} was not ready within {wait_s:.0f}s")
+                time.sleep(0.05)
+                continue
+
+            _PID.pack_into(shm.buf, _PID_OFF, os.getpid())
+            m = cls(shm, shape, owner=True)
+            try:
+                fill(m.array)
+            except BaseException:
+                shm.unlink()
+                raise
+            shm.buf[:len(_READY)] = _READY
+            return m
+
+    def __del__(self):
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except Exception:
+                pass
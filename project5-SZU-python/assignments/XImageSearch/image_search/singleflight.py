@@ -0,0 +1,49 @@
+"""
+进程内的 single-flight：同一个 key 同时只计算一次，计算期间到达的相同请求等待并复用同一个结果。
+
+只合并“正在进行”的计算，结束后立即移除，不充当缓存（结果缓存另有 embedding 缓存）。
+计算抛出的异常同样传给所有等待者。
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self._leaders = 0
+        self._shared = 0
+
+    def do(self, key: Hashable, fn: Callable, *args) -> Tuple[object, bool]:
+        """返回 (结果, 是否复用了别人的计算)。"""
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+                self._leaders += 1
+            else:
+                self._shared += 1
+        if not leader:
+            return fut.result(), True
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._calls), "computed": self._leaders, "shared": self._shared}
@@ -127,6 +127,12 @@
         let data = null;
         try{ data = JSON.parse(xhr.responseText); }catch{}
 
+        if (xhr.status === 429){
+          const wait = data?.retryAfter || xhr.getResponseHeader('Retry-After') || 5;
+          window.UI?.toast({title:"服务繁忙", message:`排队已满，请 ${wait} 秒后重试`, type:"warn", timeout:5200});
+          return;
+        }
+
         if (!data || data.ok !== true){
           const msg = data?.error || `请求失败（HTTP ${xhr.status}）`;
           window.UI?.toast({title:"上传失败", message: msg, type:"bad", timeout:5200});
@@ -1,7 +1,7 @@
 /* ==========================================================================
    Results page (Hardened)
    - Applies threshold styling/filtering
-   - Polls /api/results/?hid=... until ready
+   - Long-polls /api/results/wait/?hid=... until ready
    - Shows backend error explicitly
    - Supports add favorite + copy url
    ========================================================================== */
@@ -270,6 +270,29 @@
     }
   }
 
+  async function refreshHistory(){
+    const hid = grid?.getAttribute('data-hid');
+    if (!hid) return;
+
+    const fd = new FormData();
+    fd.append('id', hid);
+
+    const csrftoken = getCookie('csrftoken');
+    const resp = await fetch('/api/history/refresh/', {
+      method: 'POST',
+      body: fd,
+      headers: csrftoken ? {'X-CSRFToken': csrftoken} : {},
+    });
+
+    if (resp.ok){
+      window.location.reload();
+      return;
+    }
+    let msg = `HTTP ${resp.status}`;
+    try{ msg = (await resp.json()).error || msg; }catch{}
+    UI?.toast({title:"重新检索失败", message: msg, type:"bad"});
+  }
+
   async function addFavorite(url, score){
     const tags = (prompt('请输入收藏标签（必填，可用逗号分隔多个）') || '').trim();
     if (!tags){
@@ -316,6 +339,12 @@
       if (btn.classList.contains('fav-add')){
         await addFavorite(url, score);
       }
+
+      if (btn.classList.contains('more-like')){
+        const gallery = grid?.getAttribute('data-gallery') || '';
+        window.location.href = '/similar/?url=' + encodeURIComponent(url)
+          + (gallery ? '&gallery=' + encodeURIComponent(gallery) : '');
+      }
     });
   }
 
@@ -345,6 +374,7 @@
         <div style="padding: 0 10px 12px; display:flex; gap:10px; align-items:center;">
           <button class="button secondary fav-add" type="button">收藏</button>
           <button class="button ghost copy-url" type="button">复制链接</button>
+          <button class="button ghost more-like" type="button">相似</button>
         </div>
       `;
       div.querySelector('.url').textContent = url;
@@ -363,27 +393,20 @@
     if (!hid) return;
 
     const hasAnyItem = grid.querySelector('.item[data-score]');
-    // 如果已经有结果就不轮询
+    // 如果已经有结果就不等待
     if (hasAnyItem) return;
 
-    let tries = 0;
-    // 更快首屏：前几秒更密集轮询，随后退避，整体上限仍约 2 分钟
-    const maxTries = 260;
-
-    function nextDelayMs(t){
-      // 0~2s：200ms，2~10s：400ms，之后：750ms
-      if (t <= 10) return 200;
-      if (t <= 40) return 400;
-      return 750;
-    }
+    // 长轮询：服务端挂起请求直到后台检索结束（单次最多约 25s），超时返回 pending 就立即重发；整体上限约 2 分钟
+    const deadline = Date.now() + 120000;
+    let failures = 0;
 
-    async function tick(){
-      tries += 1;
+    async function wait(){
       try{
-        const resp = await fetch(`/api/results/?hid=${encodeURIComponent(hid)}`, {
+        const resp = await fetch(`/api/results/wait/?hid=${encodeURIComponent(hid)}&timeout=25`, {
           headers: {'Accept': 'application/json'}
         });
         const j = await resp.json();
+        failures = 0;
 
         if (!j.ok){
           setStatus(`请求失败：${j.error || 'unknown'}`, 'bad');
@@ -397,31 +420,38 @@
         }
 
         if (j.pending){
-          setStatus('后端检索中...（自动刷新）');
-          if (tries < maxTries) return setTimeout(tick, nextDelayMs(tries));
+          setStatus(j.queued ? '排队中...（结果就绪后自动显示）'
+            : `后端检索中...（排队 ${j.queueWaitMs ?? 0}ms，结果就绪后自动显示）`);
+          if (Date.now() < deadline) return wait();
           setStatus('等待超时：请刷新页面或检查后端配置/日志', 'warn');
           return;
         }
 
         // done
+        if (j.stale){
+          setStatus('图库已更新，这条历史保存的结果已失效；点“重新检索”用保存的特征在当前图库上重跑', 'warn');
+          return;
+        }
         if (Array.isArray(j.results) && j.results.length){
-          setStatus(`已加载 ${j.results.length} 条结果`);
+          setStatus(`已加载 ${j.results.length} 条结果` + (j.queueWaitMs ? `（排队 ${j.queueWaitMs}ms）` : ''));
           renderResults(j.results);
         }else{
           setStatus('检索完成，但没有结果（可能 gallery 未加载或被过滤）', 'warn');
         }
       }catch(e){
-        setStatus(`轮询异常：${String(e)}`, 'warn');
-        if (tries < maxTries) setTimeout(tick, 1200);
+        failures += 1;
+        setStatus(`连接异常：${String(e)}`, 'warn');
+        if (Date.now() < deadline) setTimeout(wait, Math.min(1200 * failures, 5000));
       }
     }
 
     setStatus('正在等待后端返回结果...');
-    tick();
+    wait();
   }
 
   bindControls();
   bindItemActions();
+  document.getElementById('refresh-btn')?.addEventListener('click', ()=> refreshHistory());
 
   sortItems();
   applyStyles();
@@ -0,0 +1,60 @@
+"""
+后台检索任务完成通知：长轮询请求按 record id 登记等待，_run_search_async 结束时唤醒同进程内的所有等待者。
+
+- 等待方是 asyncio 协程（ASGI 下不占线程；WSGI 下 Django 为 async view 起一个事件循环，同样可用）
+- 通知来自任务线程，通过 loop.call_soon_threadsafe 投递到各等待者自己的事件循环
+- 只负责“同进程内尽快醒来”；多进程部署时任务可能在别的进程完成，调用方仍需定期看一眼 cache 里的任务状态
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Dict, List, Tuple
+
+
+class TaskEvents:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: Dict[int, List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]] = {}
+
+    async def wait(self, key: int, timeout: float) -> bool:
+        """等到 notify(key) 或超时；返回是否被唤醒。"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        entry = (loop, fut)
+        with self._lock:
+            self._waiters.setdefault(key, []).append(entry)
+        try:
+            await asyncio.wait_for(fut, timeout=max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key)
+                if waiters and entry in waiters:
+                    waiters.remove(entry)
+                    if not waiters:
+                        del self._waiters[key]
+
+    def notify(self, key: int) -> int:
+        """唤醒 key 上的所有等待者，返回人数。"""
+        with self._lock:
+            waiters = self._waiters.pop(key, [])
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut)
+            except RuntimeError:
+                # 等待者的事件循环已经关闭（请求已结束）
+                pass
+        return len(waiters)
+
+    def waiting(self) -> int:
+        with self._lock:
+            return sum(len(v) for v in self._waiters.values())
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(True)
@@ -1,15 +1,26 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 urlpatterns = [
-    path("", views.index, name="index"),
+    # ASGI 部署可设 INDEX_ASYNC=1：上传后 await 后台检索，不占线程
+    path("", views.index_async if getattr(settings, "INDEX_ASYNC", False) else views.index, name="index"),
     path("results/", views.results, name="results"),
     path("history/", views.history, name="history"),
     path("history/<int:record_id>/", views.history_detail, name="history_detail"),
     path("favorites/", views.favorites, name="favorites"),
+    path("similar/", views.similar, name="similar"),
 
     path("api/results/", views.api_results, name="api_results"),
+    path("api/results/wait/", views.api_results_wait, name="api_results_wait"),
+    path("api/similar/", views.api_similar, name="api_similar"),
+    path("api/search/bulk/", views.api_search_bulk, name="api_search_bulk"),
+    path("api/admin/engine/stats/", views.api_engine_stats, name="api_engine_stats"),
+    path("api/admin/gallery/reload/", views.api_gallery_reload, name="api_gallery_reload"),
+    path("api/admin/gallery/add/", views.api_gallery_add, name="api_gallery_add"),
+    path("api/admin/gallery/remove/", views.api_gallery_remove, name="api_gallery_remove"),
     path("api/history/remove/", views.api_history_remove, name="api_history_remove"),
+    path("api/history/refresh/", views.api_history_refresh, name="api_history_refresh"),
     path("api/favorite/remove/", views.api_favorite_remove, name="api_favorite_remove"),
     path("api/favorite/add/", views.api_favorite_add, name="api_favorite_add"),
 ]
@@ -1,52 +1,297 @@
 from __future__ import annotations
 
+import io
 import os
+import asyncio
 import time
+import atexit
 import hashlib
+import hmac
+import threading
 from urllib.parse import quote, unquote
 from typing import Iterable
-from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import TimeoutError as FutureTimeout
 
 import numpy as np
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import ContentFile
 from django.db import transaction, close_old_connections
-from django.http import JsonResponse, HttpRequest, HttpResponse
+from django.db.models import Q
+from django.http import JsonResponse, HttpRequest, HttpResponse, HttpResponseNotAllowed
+from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django.views.decorators.http import require_http_methods, require_POST
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_protect, csrf_exempt
 
 from .models import HistoryRecord, HistoryItem, Favorite
-from .search_engine import SearchEngine
+from .embed_cache import EmbeddingCache
+from .history_writer import HistoryWriter
+from .registry import EngineRegistry
+from .scheduler import Overloaded, TaskScheduler, Ticket
+from .singleflight import SingleFlight
+from .task_events import TaskEvents
+from .search_engine import SearchEngine, SearchFilter, SearchHits
+from .workers import WorkerPool
 from .dinov2_onnx import parse_providers
 
 
-# ---------- Engine singleton ----------
-_ENGINE: SearchEngine | None = None
+# ---------- Engine registry ----------
+# 每个图库（租户）一个 SearchEngine，模型进程内共享；见 registry.EngineRegistry
+_REGISTRY: EngineRegistry | None = None
+_REGISTRY_LOCK = threading.Lock()
 
+# 各图库自己的文件；未配置时为空（root/url/cdn_base 未配置时沿用 default 图库）
+_GALLERY_KEYS = ("features", "index", "file", "pca", "delta", "knn", "ivf", "trigger", "shards")
+
+
+def default_gallery() -> str:
+    return str(getattr(settings, "DEFAULT_GALLERY", "default") or "default")
+
+
+def _gallery_configs() -> dict:
+    default = {
+        "features": getattr(settings, "GALLERY_FEATURES", ""),
+        "index": getattr(settings, "GALLERY_INDEX", ""),
+        "file": str(getattr(settings, "GALLERY_FILE", "") or ""),
+        "pca": str(getattr(settings, "GALLERY_PCA", "") or ""),
+        "delta": str(getattr(settings, "GALLERY_DELTA", "") or ""),
+        "knn": str(getattr(settings, "GALLERY_KNN", "") or ""),
+        "ivf": str(getattr(settings, "GALLERY_IVF", "") or ""),
+        "shards": list(getattr(settings, "GALLERY_SHARDS", None) or []),
+        "trigger": str(getattr(settings, "GALLERY_RELOAD_TRIGGER", "") or ""),
+        "root": str(getattr(settings, "GALLERY_ROOT", "") or ""),
+        "url": getattr(settings, "GALLERY_URL", "/gallery/"),
+        "cdn_base": getattr(settings, "GALLERY_CDN_BASE", None),
+    }
+    configs = {default_gallery(): default}
+    for gid, cfg in (getattr(settings, "GALLERIES", None) or {}).items():
+        merged = dict(default)
+        merged.update({k: "" for k in _GALLERY_KEYS})
+        merged.update(cfg or {})
+        configs[str(gid)] = merged
+    return configs
+
+
+# mysite/settings.py 里 SECRET_KEY 的开发默认值
+_DEFAULT_SECRET_KEY = "dev-secret-key-change-me"
+
+
+def shard_authkey() -> bytes:
+    """分片连接的认证密钥：必须显式配置，不能借用 SECRET_KEY（开发默认值人人都知道，而连接上传的是 pickle）。"""
+    key = str(getattr(settings, "GALLERY_SHARD_AUTHKEY", "") or "")
+    if not key:
+        raise ImproperlyConfigured("GALLERY_SHARD_AUTHKEY must be set to use gallery shards")
+    if key == _DEFAULT_SECRET_KEY:
+        raise ImproperlyConfigured("GALLERY_SHARD_AUTHKEY must not be the default SECRET_KEY")
+    return key.encode("utf-8")
+
+
+def shard_allow_remote() -> bool:
+    return bool(getattr(settings, "GALLERY_SHARD_ALLOW_REMOTE", False))
+
+
+def _engine_kwargs(cfg: dict, **overrides) -> dict:
+    """图库配置 -> SearchEngine 参数（Django 进程内的引擎和检索子进程共用）"""
+    kwargs = dict(
+        gallery_features_path=cfg.get("features") or "",
+        gallery_index_path=cfg.get("index") or "",
+        gallery_url_prefix=cfg.get("url") or "/gallery/",
+        cdn_base=cfg.get("cdn_base") or None,
+        gallery_root=str(cfg.get("root") or ""),
+        weights_path=getattr(settings, "DINO_WEIGHTS", None),
+        backend=str(getattr(settings, "DINO_BACKEND", "numpy") or "numpy"),
+        onnx_model_path=str(getattr(settings, "DINO_ONNX_PATH", "") or "") or None,
+        ort_providers=parse_providers(str(getattr(settings, "DINO_ORT_PROVIDERS", "") or "")),
+        pca_path=cfg.get("pca") or None,
+        mmap_search=bool(getattr(settings, "GALLERY_MMAP_SEARCH", True)),
+        chunk_rows=int(getattr(settings, "GALLERY_CHUNK_ROWS", 65536) or 65536),
+        gallery_file_path=cfg.get("file") or None,
+        search_threads=int(getattr(settings, "ENGINE_SEARCH_THREADS", 1) or 0),
+        min_shard_rows=int(getattr(settings, "ENGINE_MIN_SHARD_ROWS", 50000) or 50000),
+        reload_trigger_path=cfg.get("trigger") or None,
+        delta_path=cfg.get("delta") or None,
+        upload_subdir=str(getattr(settings, "GALLERY_UPLOAD_SUBDIR", "uploads") or "uploads"),
+        knn_path=cfg.get("knn") or None,
+        ivf_path=cfg.get("ivf") or None,
+        ann_target_p95_ms=float(getattr(settings, "ANN_TARGET_P95_MS", 0) or 0),
+        ann_target_recall=float(getattr(settings, "ANN_TARGET_RECALL", 0) or 0),
+        shard_addresses=cfg.get("shards") or None,
+        shard_authkey=shard_authkey() if cfg.get("shards") else b"",
+        shard_timeout=float(getattr(settings, "GALLERY_SHARD_TIMEOUT", 30) or 30),
+        shard_allow_remote=shard_allow_remote(),
+        embed_batch_window_ms=float(getattr(settings, "EMBED_BATCH_WINDOW_MS", 0) or 0),
+        embed_max_batch=int(getattr(settings, "EMBED_MAX_BATCH", 8) or 1),
+        share_features=bool(getattr(settings, "GALLERY_SHARED_MEMORY", False)) or _worker_processes() > 0,
+        result_cache_bytes=int(getattr(settings, "RESULT_CACHE_MAX_MB", 32) or 0) << 20,
+    )
+    kwargs.update(overrides)
+    return kwargs
+
+
+def _build_engine(gid: str, cfg: dict, **overrides) -> SearchEngine:
+    engine = SearchEngine(**_engine_kwargs(cfg, **overrides))
+    engine.start_watcher(float(getattr(settings, "GALLERY_WATCH_INTERVAL", 0) or 0))
+    return engine
+
+
+def _memory_budget() -> int:
+    """GALLERY_MEMORY_BUDGET_MB -> 字节（0=不限），本进程和每个检索子进程各自按它卸载图库"""
+    try:
+        return int(getattr(settings, "GALLERY_MEMORY_BUDGET_MB", 0) or 0) << 20
+    except Exception:
+        return 0
+
+
+def get_registry() -> EngineRegistry:
+    global _REGISTRY
+    if _REGISTRY is None:
+        with _REGISTRY_LOCK:
+            if _REGISTRY is None:
+                _REGISTRY = EngineRegistry(_gallery_configs(), _build_engine, budget_bytes=_memory_budget())
+    return _REGISTRY
+
+
+def get_engine(gallery: str | None = None) -> SearchEngine:
+    """取图库引擎（默认图库为 DEFAULT_GALLERY），未加载时按需加载。未知图库抛 KeyError。"""
+    return get_registry().get(gallery or default_gallery())
+
+
+def _worker_processes() -> int:
+    try:
+        return max(0, int(getattr(settings, "ENGINE_WORKER_PROCESSES", 0) or 0))
+    except Exception:
+        return 0
+
+
+# ---------- Worker processes ----------
+# ENGINE_WORKER_PROCESSES > 0 时上传检索（embedding + 打分）交给子进程池，见 workers.WorkerPool
+_WORKER_POOL: WorkerPool | None = None
+_WORKER_POOL_LOCK = threading.Lock()
+# 各图库最近一次子进程返回的 cache_tag（模型 + 检索空间），用于在进程外查 embedding 缓存
+_WORKER_TAGS: dict = {}
+
+
+def get_worker_pool() -> WorkerPool | None:
+    global _WORKER_POOL
+    n = _worker_processes()
+    if n <= 0:
+        return None
+    if _WORKER_POOL is None:
+        with _WORKER_POOL_LOCK:
+            if _WORKER_POOL is None:
+                # 子进程不开微批（每个进程同一时刻只处理一个 query），图库矩阵走共享内存
+                configs = {gid: _engine_kwargs(cfg, embed_batch_window_ms=0.0, share_features=True)
+                           for gid, cfg in _gallery_configs().items()}
+                _WORKER_POOL = WorkerPool(
+                    configs,
+                    processes=n,
+                    slot_bytes=int(getattr(settings, "ENGINE_WORKER_SLOT_MB", 16) or 16) << 20,
+                    max_hits=max(200, _range_cap()),  # topk 上限 200，范围检索上限 RANGE_SEARCH_MAX_RESULTS
+                    timeout=float(getattr(settings, "ENGINE_WORKER_TIMEOUT", 60) or 60),
+                    watch_interval=float(getattr(settings, "GALLERY_WATCH_INTERVAL", 0) or 0),
+                    budget_bytes=_memory_budget(),
+                )
+                atexit.register(_WORKER_POOL.close)
+    return _WORKER_POOL
+
+
+def _pool_search(pool: WorkerPool, gallery: str, topk: int, flt: SearchFilter | None = None,
+                 threshold: float = 0.0, image: bytes | None = None, q: np.ndarray | None = None):
+    """子进程里 embedding（或直接用 q）+ 检索，返回 (q_feat, SearchHits, embedding_tag, cache_tag)"""
+    q_feat, ids, scores, urls, tag, cache_tag, rows_tag = pool.run(
+        gallery, image=image, q=q, topk=topk, flt=flt, threshold=threshold,
+        max_results=_range_cap() if threshold > 0 else 0,
+    )
+    _WORKER_TAGS[gallery] = cache_tag
+    by_id = dict(zip(ids.tolist(), urls))
+    return q_feat, SearchHits(ids, scores, by_id.__getitem__, rows_tag), tag, cache_tag
+
+
+def _gallery_param(data) -> str:
+    return str(data.get("gallery") or "").strip() or default_gallery()
+
+
+def _unknown_gallery(gallery: str) -> JsonResponse:
+    return JsonResponse({"ok": False, "error": f"unknown gallery: {gallery}"}, status=400)
 
-def get_engine() -> SearchEngine:
-    global _ENGINE
-    if _ENGINE is None:
-        _ENGINE = SearchEngine(
-            gallery_features_path=getattr(settings, "GALLERY_FEATURES", ""),
-            gallery_index_path=getattr(settings, "GALLERY_INDEX", ""),
-            gallery_url_prefix=getattr(settings, "GALLERY_URL", "/gallery/"),
-            cdn_base=getattr(settings, "GALLERY_CDN_BASE", None),
-            gallery_root=str(getattr(settings, "GALLERY_ROOT", "") or ""),
-            weights_path=getattr(settings, "DINO_WEIGHTS", None),
-            backend=str(getattr(settings, "DINO_BACKEND", "numpy") or "numpy"),
-            onnx_model_path=str(getattr(settings, "DINO_ONNX_PATH", "") or "") or None,
-            ort_providers=parse_providers(str(getattr(settings, "DINO_ORT_PROVIDERS", "") or "")),
-        )
-    return _ENGINE
+
+def _index_context(**extra) -> dict:
+    ids = get_registry().ids()
+    return {"galleries": ids if len(ids) > 1 else [], "default_gallery": default_gallery(), **extra}
+
+
+def touch_reload_trigger(gallery: str | None = None) -> bool:
+    """更新触发文件的 mtime，所有 worker 的 watcher 会在下一轮轮询时重新加载该图库。未知图库抛 KeyError。"""
+    cfg = get_registry().configs[gallery or default_gallery()]
+    path = str(cfg.get("trigger") or "")
+    if not path:
+        return False
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8"):
+        pass
+    os.utime(path, None)
+    return True
 
 
 # ---------- Async execution ----------
-_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# 后台检索任务的调度：有界队列 + 会话并发上限 + 优先级通道（上传优先于批量重检索），见 scheduler.TaskScheduler
+# 多个任务并发时，各自的 ViT 前向会被微批调度器（EMBED_BATCH_WINDOW_MS）拼成一个 batch
+def _history_backlogged() -> bool:
+    """历史写线程的队列满了：准入时拒绝新任务（已在跑的任务改为同步写库）"""
+    writer = _HISTORY_WRITER
+    return writer is not None and writer.backlogged
+
+
+_SCHEDULER = TaskScheduler(
+    workers=max(1, int(getattr(settings, "ENGINE_TASK_WORKERS", 1) or 1)),
+    max_queue=max(1, int(getattr(settings, "TASK_QUEUE_MAX", 64) or 64)),
+    per_session=max(0, int(getattr(settings, "TASK_SESSION_MAX", 4) or 0)),
+    lanes=("interactive", "bulk"),
+    backlogged=_history_backlogged,
+)
+
+
+def _client_key(request: HttpRequest) -> str:
+    """
+    会话并发上限按 session 计。反向代理后面 REMOTE_ADDR 是代理自己的地址，所有人会共用一个名额，所以不用它：
+    没有 session 时先看可信代理头（TASK_CLIENT_HEADER，代理负责覆盖客户端自带的值），否则当场建一个 session
+    """
+    session = getattr(request, "session", None)
+    if session is not None and session.session_key:
+        return f"s:{session.session_key}"
+    header = str(getattr(settings, "TASK_CLIENT_HEADER", "") or "")
+    value = request.META.get(header, "") if header else ""
+    if value:
+        # X-Forwarded-For 形式取第一跳
+        return f"h:{value.split(',')[0].strip()}"
+    if session is not None:
+        session.save()
+        return f"s:{session.session_key}"
+    return ""
+
+
+def _overloaded(e: Overloaded, request: HttpRequest | None = None) -> HttpResponse:
+    """429 + Retry-After；request 给出时（表单提交）渲染首页并提示"""
+    msg = f"服务繁忙（{e.reason}），请 {e.retry_after} 秒后重试"
+    if request is not None:
+        resp = render(request, "image_search/index.html", _index_context(error=msg), status=429)
+    else:
+        resp = JsonResponse({"ok": False, "error": e.reason, "retryAfter": e.retry_after}, status=429)
+    resp["Retry-After"] = str(e.retry_after)
+    return resp
+
+
+def _run_in_lane(request: HttpRequest, lane: str, fn, *args):
+    """在调度器的某个通道里执行并等待结果（重检索、相似图的精确检索用）；超限抛 Overloaded"""
+    return _SCHEDULER.submit(lane, _client_key(request), fn, *args).result()
+
+
+# 任务结束时唤醒同进程内等待结果的长轮询请求（api_results_wait）
+_TASK_EVENTS = TaskEvents()
 
 # cache keys (survive multi-worker if cache backend is shared)
 def _ck_status(record_id: int) -> str:
@@ -55,20 +300,32 @@ def _ck_status(record_id: int) -> str:
 def _ck_error(record_id: int) -> str:
     return f"image_search:task:{record_id}:error"
 
-def _ck_embed(sha256_hex: str) -> str:
-    return f"image_search:embed:{sha256_hex}"
+def _ck_wait(record_id: int) -> str:
+    return f"image_search:task:{record_id}:wait_ms"
+
+def _ck_results(record_id: int) -> str:
+    return f"image_search:task:{record_id}:results"
+
+def _ck_embed(sha256_hex: str, tag: str = "raw") -> str:
+    return f"image_search:embed:{tag}:{sha256_hex}"
 
 def _set_task_pending(record_id: int, ttl: int = 3600) -> None:
     cache.set(_ck_status(record_id), "pending", ttl)
     cache.delete(_ck_error(record_id))
 
+def _set_task_started(record_id: int, wait_s: float, ttl: int = 3600) -> None:
+    """任务出队开始执行：记下排队等待时间（结果 API 返回给客户端）"""
+    cache.set(_ck_wait(record_id), int(round(wait_s * 1000)), ttl)
+
 def _set_task_done(record_id: int, ttl: int = 3600) -> None:
     cache.set(_ck_status(record_id), "done", ttl)
     cache.delete(_ck_error(record_id))
+    _TASK_EVENTS.notify(record_id)
 
 def _set_task_error(record_id: int, error: str, ttl: int = 3600) -> None:
     cache.set(_ck_status(record_id), "error", ttl)
     cache.set(_ck_error(record_id), error[:4000], ttl)  # cap to avoid huge payloads
+    _TASK_EVENTS.notify(record_id)
 
 
 def _gallery_url_fix_and_exists(url: str) -> tuple[str, bool]:
@@ -110,6 +367,29 @@ def _gallery_url_fix_and_exists(url: str) -> tuple[str, bool]:
     return prefix + rest_q, False
 
 
+# 质量分档（与结果页的 Strong/Medium/Weak/Poor 一致），也用作范围检索的阈值档位
+QUALITY_TIERS = {"strong": 0.55, "medium": 0.45, "weak": 0.35}
+
+
+def _results_limit() -> int:
+    try:
+        return max(1, int(getattr(settings, "RESULTS_MAX_ITEMS", 50)))
+    except Exception:
+        return 50
+
+
+def _parse_threshold(data) -> float:
+    """tier=strong/medium/weak 优先，其次 threshold 数值；<= 0 表示普通 TopK 检索。"""
+    tier = str(data.get("tier") or "").strip().lower()
+    if tier in QUALITY_TIERS:
+        return QUALITY_TIERS[tier]
+    try:
+        th = float(data.get("threshold") or 0)
+    except Exception:
+        return 0.0
+    return th if 0.0 < th <= 1.0 else 0.0
+
+
 def _quality_stats(scores: Iterable[float]) -> dict:
     vals: list[float] = []
     for s in scores:
@@ -125,9 +405,9 @@ def _quality_stats(scores: Iterable[float]) -> dict:
         return {"avg": None, "best": None, "total": 0, "strong": 0, "medium": 0, "weak": 0, "poor": 0}
 
     # keep consistent with your current heuristic (do not break UI meaning)
-    strong_t = 0.55
-    medium_t = 0.45
-    weak_t = 0.35
+    strong_t = QUALITY_TIERS["strong"]
+    medium_t = QUALITY_TIERS["medium"]
+    weak_t = QUALITY_TIERS["weak"]
 
     return {
         "avg": float(sum(vals) / len(vals)),
@@ -140,60 +420,408 @@ def _quality_stats(scores: Iterable[float]) -> dict:
     }
 
 
-def _run_search_async(record_id: int, image_bytes: bytes, filename: str, topk: int) -> None:
+def _parse_filter(data) -> SearchFilter | None:
+    """表单里的过滤条件：folder=图库子目录前缀，attr.<列名>=取值（索引 CSV 的属性列）。"""
+    attrs = {k[len("attr."):]: v for k, v in data.items() if k.startswith("attr.") and str(v).strip()}
+    return SearchFilter.make(folder=data.get("folder"), attrs=attrs)
+
+
+def _range_cap() -> int:
+    try:
+        return int(getattr(settings, "RANGE_SEARCH_MAX_RESULTS", 200))
+    except Exception:
+        return 200
+
+
+def _engine_search(engine: SearchEngine, q_feat: np.ndarray, topk: int, flt: SearchFilter | None = None,
+                   threshold: float = 0.0):
+    """TopK 检索；threshold > 0 时改为范围检索（例如“全部 Strong”），上限 RANGE_SEARCH_MAX_RESULTS"""
+    if threshold > 0:
+        return engine.search_range(q_feat, threshold, max_results=_range_cap(), flt=flt)
+    return engine.search(q_feat, topk=topk, flt=flt)
+
+
+def _replace_items(rec: HistoryRecord, results) -> None:
+    """用新结果整体替换一条历史的 HistoryItem（调用方负责事务）"""
+    HistoryItem.objects.filter(record=rec).delete()
+    if results:
+        HistoryItem.objects.bulk_create(
+            [HistoryItem(record=rec, rank=i + 1, url=r.url, score=r.score) for i, r in enumerate(results)],
+            batch_size=500,
+        )
+
+
+# 紧凑结果的一项：图库行号 + 分数，各 4 字节（小端）
+_HIT_DTYPE = np.dtype([("row", "<i4"), ("score", "<f4")])
+RESULT_FIELDS = ["results_blob", "results_tag"]
+
+
+def _compact_results() -> bool:
+    return bool(getattr(settings, "HISTORY_COMPACT_RESULTS", False))
+
+
+def _store_results(rec: HistoryRecord, results) -> None:
+    """
+    写入一条历史的结果（调用方负责事务，并用 update_fields=RESULT_FIELDS 保存 rec）：
+    默认打包成 results_blob，一条记录一个字段；结果的行号不能在本地解析时（分片协调端）退回逐行的 HistoryItem
+    """
+    tag = getattr(results, "rows_tag", "")
+    if not (_compact_results() and tag and isinstance(results, SearchHits)):
+        _replace_items(rec, results)
+        rec.results_blob, rec.results_tag = None, ""
+        return
+    if rec.results_blob is None:
+        # 之前存成 HistoryItem 的记录（旧记录 / 切换过存储方式）
+        HistoryItem.objects.filter(record=rec).delete()
+    packed = np.empty((len(results),), dtype=_HIT_DTYPE)
+    packed["row"] = results.indices
+    packed["score"] = results.scores
+    rec.results_blob, rec.results_tag = packed.tobytes(), tag
+
+
+def _result_count(rec: HistoryRecord) -> int:
+    if rec.results_blob is not None:
+        return len(rec.results_blob) // _HIT_DTYPE.itemsize
+    # 批量处理时查询集 annotate(n_items=Count("items")) 预先算好，不逐条 count
+    n = getattr(rec, "n_items", None)
+    return int(n) if n is not None else rec.items.count()
+
+
+def _quality(score: float) -> str:
+    for name in ("strong", "medium", "weak"):
+        if score >= QUALITY_TIERS[name]:
+            return name.capitalize()
+    return "Poor"
+
+
+def _blob_hits(rec: HistoryRecord):
+    """
+    results_blob -> 结果（url 用当前图库快照的路径表解析）。
+    base 行变过（合并增量、重建图库）或引用的增量行被删过之后行号不再对应原来的图片，返回 None；
+    读取时不重新检索也不改写记录，由用户点“重新检索”或 rescore_history 刷新。
+    """
+    packed = np.frombuffer(bytes(rec.results_blob), dtype=_HIT_DTYPE)
+    try:
+        engine = get_engine(rec.gallery or None)
+    except KeyError:
+        return None
+    return engine.resolve_rows(packed["row"].astype(np.int64), packed["score"], rec.results_tag)
+
+
+def _hit_rows(hits) -> list:
+    return [
+        {"rank": i + 1, "url": r.url, "score": float(r.score), "quality": _quality(r.score)}
+        for i, r in enumerate(hits[:_results_limit()])
+    ]
+
+
+def _result_rows(rec: HistoryRecord) -> tuple[list, bool]:
+    """
+    一条历史的结果行（按分数降序，最多 RESULTS_MAX_ITEMS 条），两种存储方式都支持。
+    返回 (结果行, stale)：stale=True 表示图库已变化、存下的行号解析不了（结果行为空）
+    """
+    pending = cache.get(_ck_results(rec.id))
+    if isinstance(pending, list):
+        # 检索已完成、写线程还没落库
+        return pending, False
+    if rec.results_blob is not None:
+        hits = _blob_hits(rec)
+        return ([], True) if hits is None else (_hit_rows(hits), False)
+    items = HistoryItem.objects.filter(record_id=rec.id).order_by("-score")[:_results_limit()]
+    return [
+        {
+            "rank": idx + 1,
+            "url": item.url,
+            "score": float(item.score),
+            "quality": item.quality,
+        }
+        for idx, item in enumerate(items)
+    ], False
+
+
+# 存下的行号已对不上当前图库时结果页的提示
+_STALE_HINT = "图库已更新，这条历史保存的结果已失效；点“重新检索”用保存的特征在当前图库上重跑。"
+
+
+def _stored_feat(rec: HistoryRecord, engine: SearchEngine) -> np.ndarray | None:
+    """
+    取出历史记录里的 query embedding，只有与当前检索空间一致时才返回：
+    维度等于图库维度（且 feat_tag 一致），或者是 PCA 之前的原始维度（search 会自动投影）。
+    """
+    if not rec.query_feat or not engine.ready:
+        return None
+    q = np.frombuffer(bytes(rec.query_feat), dtype=np.float32)
+    if rec.feat_tag and rec.feat_tag != engine.embedding_tag and q.shape[0] == engine.query_dim:
+        return None
+    if q.shape[0] == engine.query_dim:
+        return q
+    if engine.pca_proj is not None and q.shape[0] == int(engine.pca_proj.shape[0]):
+        return q
+    return None
+
+
+def _embed_ttl() -> int:
+    try:
+        return int(getattr(settings, "ENGINE_EMBED_CACHE_TTL", 86400))
+    except Exception:
+        return 86400
+
+
+# ---------- In-flight dedup ----------
+# 相同检索（图片 sha256 + 图库及版本 + topk/过滤/阈值）进行中时后来者复用结果；相同图片的 ViT 前向同理
+_SEARCH_FLIGHT = SingleFlight()
+_EMBED_FLIGHT = SingleFlight()
+
+
+# ---------- Embedding cache ----------
+# EMBED_CACHE_PATH 配置时用持久化的 SQLite 缓存（同机 worker 共享、重启不丢），否则退回 Django cache
+_EMBED_CACHE: EmbeddingCache | None = None
+_EMBED_CACHE_LOCK = threading.Lock()
+
+
+def get_embed_cache() -> EmbeddingCache | None:
+    global _EMBED_CACHE
+    path = str(getattr(settings, "EMBED_CACHE_PATH", "") or "")
+    if not path:
+        return None
+    if _EMBED_CACHE is None:
+        with _EMBED_CACHE_LOCK:
+            if _EMBED_CACHE is None:
+                try:
+                    max_mb = int(getattr(settings, "EMBED_CACHE_MAX_MB", 256) or 0)
+                except Exception:
+                    max_mb = 256
+                _EMBED_CACHE = EmbeddingCache(path, max_bytes=max_mb << 20)
+    return _EMBED_CACHE
+
+
+def _cached_embedding(digest: str, tag: str) -> np.ndarray | None:
+    store = get_embed_cache()
+    if store is not None:
+        return store.get(digest, tag)
+    cached = cache.get(_ck_embed(digest, tag))
+    if isinstance(cached, (bytes, bytearray)) and len(cached) % 4 == 0:
+        return np.frombuffer(cached, dtype=np.float32)
+    return None
+
+
+def _store_embedding(digest: str, tag: str, q_feat: np.ndarray) -> None:
+    store = get_embed_cache()
+    if store is not None:
+        store.put(digest, tag, q_feat)
+    else:
+        cache.set(_ck_embed(digest, tag), q_feat.astype(np.float32, copy=False).tobytes(), _embed_ttl())
+
+
+# 写历史记录时进程内串行：SQLite 上并发的“先读后写”事务升级写锁时会直接报 database is locked
+# （写线程和重检索接口可能同时写）
+_SAVE_LOCK = threading.Lock()
+
+
+def _write_search(record_id: int, image_bytes: bytes, filename: str, feat: np.ndarray, tag: str, results,
+                  image_name: str | None = None) -> bool:
+    """把一次检索写进它的历史记录（调用方负责事务和 _SAVE_LOCK）；用上了 image_name 时返回 True"""
+    rec = HistoryRecord.objects.select_for_update().get(id=record_id)
+    rec.query_feat = feat.tobytes()
+    rec.feat_dim = int(feat.shape[0])
+    rec.feat_tag = tag
+    used = False
+    if not rec.query_image and image_name:
+        rec.query_image.name = image_name
+        used = True
+    _store_results(rec, results)
+    rec.save(update_fields=["query_feat", "feat_dim", "feat_tag", "query_image"] + RESULT_FIELDS)
+    return used
+
+
+def _save_query_images(batch: list) -> dict:
+    """事务开始前把还没有 query 图的记录的图片写进存储，返回 {record_id: 存储名}"""
+    ids = [item[0] for item in batch]
+    missing = set(
+        HistoryRecord.objects.filter(id__in=ids)
+        .filter(Q(query_image="") | Q(query_image__isnull=True))
+        .values_list("id", flat=True)
+    )
+    field = HistoryRecord._meta.get_field("query_image")
+    names = {}
+    for record_id, image_bytes, filename, *_ in batch:
+        if record_id in missing and record_id not in names:
+            name = field.generate_filename(None, filename or "query.jpg")
+            names[record_id] = field.storage.save(name, ContentFile(image_bytes), max_length=field.max_length)
+    return names
+
+
+def _delete_query_images(names: Iterable[str]) -> None:
+    storage = HistoryRecord._meta.get_field("query_image").storage
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            pass
+
+
+def _commit_searches(batch: list) -> None:
+    """
+    一批检索结果在一个事务里写库。图片文件在事务外先写好，事务里只改数据库行：
+    事务回滚（写线程随后逐条重试）时删掉这次写的文件，提交后删掉没用上的（记录已经有图了）
+    """
+    names = _save_query_images(batch)
+    used = set()
+    try:
+        with _SAVE_LOCK, transaction.atomic():
+            for item in batch:
+                if _write_search(*item, image_name=names.get(item[0])):
+                    used.add(item[0])
+    except BaseException:
+        _delete_query_images(names.values())
+        raise
+    _delete_query_images(name for rid, name in names.items() if rid not in used)
+
+
+def _save_search(record_id: int, image_bytes: bytes, filename: str, feat: np.ndarray, tag: str, results) -> None:
+    _commit_searches([(record_id, image_bytes, filename, feat, tag, results)])
+
+
+def _save_searches(batch: list) -> None:
+    """写线程：一批检索结果在一个事务里写库，提交后删掉 cache 里的临时结果（之后从 DB 读）"""
+    close_old_connections()
+    _commit_searches(batch)
+    cache.delete_many([_ck_results(item[0]) for item in batch])
+
+
+def _save_search_failed(item: tuple, error: BaseException) -> None:
+    cache.delete(_ck_results(item[0]))
+    _set_task_error(item[0], f"failed to save results: {error}")
+
+
+# ---------- Write-behind history ----------
+# HISTORY_WRITE_BEHIND 开启时，检索任务把结果放进 cache 后立即结束，写库交给专用写线程成批提交
+_HISTORY_WRITER: HistoryWriter | None = None
+_HISTORY_WRITER_LOCK = threading.Lock()
+
+
+def get_history_writer() -> HistoryWriter | None:
+    global _HISTORY_WRITER
+    if not bool(getattr(settings, "HISTORY_WRITE_BEHIND", True)):
+        return None
+    if _HISTORY_WRITER is None:
+        with _HISTORY_WRITER_LOCK:
+            if _HISTORY_WRITER is None:
+                try:
+                    batch = int(getattr(settings, "HISTORY_WRITE_BATCH", 64) or 1)
+                    window_ms = float(getattr(settings, "HISTORY_WRITE_WINDOW_MS", 20) or 0)
+                    max_pending = int(getattr(settings, "HISTORY_WRITE_MAX_PENDING", 1024) or 1)
+                except Exception:
+                    batch, window_ms, max_pending = 64, 20.0, 1024
+                _HISTORY_WRITER = HistoryWriter(_save_searches, window_ms=window_ms, max_batch=batch,
+                                                on_error=_save_search_failed, max_pending=max_pending)
+                # 正常退出时把队列里还没写的记录写完
+                atexit.register(_HISTORY_WRITER.close)
+    return _HISTORY_WRITER
+
+
+def _persist_search(record_id: int, image_bytes: bytes, filename: str, feat: np.ndarray, tag: str, results) -> None:
+    """写库并把任务标记为完成。write-behind 时先标记完成再交给写线程：写库失败的 error 总是落在 done 之后，不会被覆盖"""
+    writer = get_history_writer()
+    if writer is None:
+        _save_search(record_id, image_bytes, filename, feat, tag, results)
+        _set_task_done(record_id)
+        return
+    # 结果先放进 cache，结果页/轮询立即可见；cache TTL 与任务状态一致
+    cache.set(_ck_results(record_id), _hit_rows(results), 3600)
+    _set_task_done(record_id)
+    try:
+        queued = writer.submit((record_id, image_bytes, filename, feat, tag, results))
+    except RuntimeError:
+        # 进程正在退出，写线程已关闭
+        queued = False
+    if not queued:
+        # 写线程队列已满（或已关闭）：同步写库，写完再删 cache 里的临时结果
+        try:
+            _save_search(record_id, image_bytes, filename, feat, tag, results)
+        except Exception as e:
+            _set_task_error(record_id, f"failed to save results: {e}")
+        cache.delete(_ck_results(record_id))
+
+
+def _search_pooled(pool: WorkerPool, gallery: str, image_bytes: bytes, digest: str, topk: int,
+                   flt: SearchFilter | None, threshold: float):
+    """子进程池版本：缓存里有 embedding 时只把 embedding 发过去，省掉解码和 ViT 前向。返回 (q_feat, 结果, tag)"""
+    cache_tag = _WORKER_TAGS.get(gallery)
+    cached = _cached_embedding(digest, cache_tag) if cache_tag else None
+
+    if cached is not None:
+        try:
+            # 维度/检索空间不符时子进程检索会抛错，退回完整流程
+            q_feat, results, tag, _ = _pool_search(pool, gallery, topk, flt, threshold, q=cached)
+            return q_feat, results, tag
+        except (RuntimeError, ValueError):
+            pass
+    q_feat, results, tag, cache_tag = _pool_search(pool, gallery, topk, flt, threshold, image=image_bytes)
+    _store_embedding(digest, cache_tag, q_feat)
+    return q_feat, results, tag
+
+
+def _embed_and_store(engine: SearchEngine, image_bytes: bytes, digest: str) -> np.ndarray:
+    q_feat = engine.embed_query(image_bytes)
+    _store_embedding(digest, engine.cache_tag, q_feat)
+    return q_feat
+
+
+def _search_local(engine: SearchEngine, image_bytes: bytes, digest: str, topk: int,
+                  flt: SearchFilter | None, threshold: float):
+    """本进程 embedding + 检索，返回 (q_feat, 结果, tag)"""
+    # 性能优化：同一张图重复上传时，直接复用 embedding
+    cached = _cached_embedding(digest, engine.cache_tag)
+    # 维度校验，避免权重/特征切换导致错配
+    if cached is not None and engine.ready and cached.shape[0] == engine.query_dim:
+        q_feat = cached
+    else:
+        # 同一张图正在别的任务里跑 ViT 时（topk/过滤条件不同）等它算完，复用同一个 embedding
+        q_feat, _ = _EMBED_FLIGHT.do((digest, engine.cache_tag), _embed_and_store, engine, image_bytes, digest)
+
+    results = _engine_search(engine, q_feat, topk, flt=flt, threshold=threshold)
+    return q_feat.astype(np.float32, copy=False), results, engine.embedding_tag
+
+
+def _run_search_async(
+    record_id: int,
+    image_bytes: bytes,
+    filename: str,
+    topk: int,
+    flt: SearchFilter | None = None,
+    threshold: float = 0.0,
+    gallery: str | None = None,
+) -> None:
     """
     后台线程：计算 query embedding，检索，写入 DB
     关键改进：
     - 错误写 cache，results/api_results 一定能看见
     - 任何异常都不会影响“网页打开”
+    - 同一张图、同样参数的检索正在进行时（双击、分享链接），直接等它的结果，不重复计算
+    - 结果放进 cache 即标记完成，写库交给写线程成批提交（HISTORY_WRITE_BEHIND），不在这里等 SQLite 写锁
     """
     close_old_connections()
     _set_task_pending(record_id)
 
     try:
-        engine = get_engine()
-
-        # 性能优化：同一张图重复上传时，直接复用 embedding
+        gallery = gallery or default_gallery()
         digest = hashlib.sha256(image_bytes).hexdigest()
-        cached = cache.get(_ck_embed(digest))
-        q_feat = None
-        if isinstance(cached, (bytes, bytearray)):
-            try:
-                arr = np.frombuffer(cached, dtype=np.float32)
-                # 维度校验，避免权重/特征切换导致错配
-                if engine.features is not None and arr.shape[0] == int(engine.features.shape[1]):
-                    q_feat = arr
-            except Exception:
-                q_feat = None
-
-        if q_feat is None:
-            q_feat = engine.embed_query(image_bytes)
-            try:
-                ttl = int(getattr(settings, "ENGINE_EMBED_CACHE_TTL", 86400))
-            except Exception:
-                ttl = 86400
-            cache.set(_ck_embed(digest), q_feat.astype(np.float32, copy=False).tobytes(), ttl)
-
-        results = engine.search(q_feat, topk=topk)
-
-        feat = q_feat.astype(np.float32, copy=False)
-
-        with transaction.atomic():
-            rec = HistoryRecord.objects.select_for_update().get(id=record_id)
-            rec.query_feat = feat.tobytes()
-            rec.feat_dim = int(feat.shape[0])
-            if not rec.query_image:
-                rec.query_image.save(filename or "query.jpg", ContentFile(image_bytes), save=True)
-            rec.save(update_fields=["query_feat", "feat_dim", "query_image"])
-
-            HistoryItem.objects.filter(record=rec).delete()
-            if results:
-                HistoryItem.objects.bulk_create(
-                    [HistoryItem(record=rec, rank=i + 1, url=r.url, score=r.score) for i, r in enumerate(results)],
-                    batch_size=500,
-                )
-
-        _set_task_done(record_id)
+        pool = get_worker_pool()
+        if pool is not None:
+            if gallery not in get_registry().configs:
+                raise KeyError(f"unknown gallery: {gallery}")
+            # 子进程各自热更新图库，这里拿不到版本号；合并窗口只有一次检索的时长
+            key = (digest, gallery, None, topk, flt, threshold)
+            (feat, results, tag), _ = _SEARCH_FLIGHT.do(
+                key, _search_pooled, pool, gallery, image_bytes, digest, topk, flt, threshold)
+        else:
+            engine = get_engine(gallery)
+            key = (digest, gallery, engine.gallery_version, topk, flt, threshold)
+            (feat, results, tag), _ = _SEARCH_FLIGHT.do(
+                key, _search_local, engine, image_bytes, digest, topk, flt, threshold)
+
+        _persist_search(record_id, image_bytes, filename, feat, tag, results)
 
     except Exception as e:
         _set_task_error(record_id, str(e))
@@ -209,18 +837,99 @@ def index(request: HttpRequest) -> HttpResponse:
     """首页 - 处理GET和POST上传"""
     if request.method != "POST":
         # GET 请求：返回首页
-        return render(request, "image_search/index.html")
+        return render(request, "image_search/index.html", _index_context())
     
     # POST 请求：处理上传
+    is_xhr = _is_xhr(request)
+    parsed = _parse_upload(request, is_xhr)
+    if isinstance(parsed, HttpResponse):
+        return parsed
+
+    # 准入检查在建记录之前：队列满时快速返回 429，不落盘
+    try:
+        ticket = _SCHEDULER.admit("interactive", _client_key(request))
+    except Overloaded as e:
+        return _overloaded(e, None if is_xhr else request)
+    try:
+        rec_id = _create_upload_record(request, parsed)
+    except BaseException:
+        ticket.release()
+        raise
+
+    # kick async task
+    fut = _submit_search(ticket, rec_id, parsed)
+
+    # 尝试在请求内“抢一把”：如果机器够快，直接一秒内拿到结果
+    # 默认等待 900ms，可用环境变量/设置关闭或调整
+    wait_ms = _sync_wait_ms()
+    if wait_ms > 0:
+        try:
+            fut.result(timeout=wait_ms / 1000.0)
+        except FutureTimeout:
+            pass
+
+    return _upload_response(rec_id, is_xhr)
+
+
+async def index_async(request: HttpRequest) -> HttpResponse:
+    """
+    首页的 async 版本（INDEX_ASYNC=1，ASGI 部署用）：流程与 index 相同，
+    但等待后台检索时 await 而不占线程，一个 worker 可以同时挂着很多个进行中的检索。
+    ASGI 下请求体在进入 view 之前已由 Django 分块异步读入临时文件；表单解析和 ORM 写入走 sync_to_async。
+    """
+    if request.method != "POST":
+        return await sync_to_async(index)(request)
+
+    # Django 4.2 的 csrf_exempt / ensure_csrf_cookie 装饰器不支持 async view，这里手动做同样的事
+    get_token(request)
+    is_xhr = _is_xhr(request)
+    parsed = await sync_to_async(_parse_upload)(request, is_xhr)
+    if isinstance(parsed, HttpResponse):
+        return parsed
+
+    try:
+        ticket = _SCHEDULER.admit("interactive", _client_key(request))
+    except Overloaded as e:
+        if is_xhr:
+            return _overloaded(e)
+        return await sync_to_async(_overloaded)(e, request)
+    try:
+        rec_id = await sync_to_async(_create_upload_record)(request, parsed)
+    except BaseException:
+        ticket.release()
+        raise
+    fut = _submit_search(ticket, rec_id, parsed)
+
+    wait_ms = _sync_wait_ms()
+    if wait_ms > 0:
+        # asyncio.wait 超时不会取消任务（wait_for 会尝试取消还没开始的后台任务）
+        await asyncio.wait({asyncio.wrap_future(fut)}, timeout=wait_ms / 1000.0)
+
+    return _upload_response(rec_id, is_xhr)
+
+
+index_async.csrf_exempt = True
+
+
+def _is_xhr(request: HttpRequest) -> bool:
     accept = request.headers.get("Accept", "") or ""
-    is_xhr = (request.headers.get("X-Requested-With") == "XMLHttpRequest") or ("application/json" in accept)
+    return (request.headers.get("X-Requested-With") == "XMLHttpRequest") or ("application/json" in accept)
+
 
+def _parse_upload(request: HttpRequest, is_xhr: bool):
+    """上传表单 -> dict(image_bytes, filename, gallery, topk, flt, threshold)；参数错误时直接返回响应"""
     up = request.FILES.get("image")
     if not up:
         msg = "未选择图片（字段名必须为 image）"
         if is_xhr:
             return JsonResponse({"ok": False, "error": msg}, status=400)
-        return render(request, "image_search/index.html", {"error": msg})
+        return render(request, "image_search/index.html", _index_context(error=msg))
+
+    gallery = _gallery_param(request.POST)
+    if gallery not in get_registry().configs:
+        if is_xhr:
+            return _unknown_gallery(gallery)
+        return render(request, "image_search/index.html", _index_context(error=f"未知图库：{gallery}"))
 
     # topk hardening
     try:
@@ -229,37 +938,48 @@ def index(request: HttpRequest) -> HttpResponse:
         topk = 50
     topk = max(1, min(topk, 200))
 
-    image_bytes = up.read()
+    return {
+        "image_bytes": up.read(),
+        "filename": up.name or "query.jpg",
+        "gallery": gallery,
+        "topk": topk,
+        "flt": _parse_filter(request.POST),
+        "threshold": _parse_threshold(request.POST),
+    }
+
 
+def _create_upload_record(request: HttpRequest, upload: dict) -> int:
     # create record immediately, so results page can open even if async fails
     with transaction.atomic():
-        rec = HistoryRecord.objects.create()
-        rec.query_image.save(up.name or "query.jpg", ContentFile(image_bytes), save=True)
+        rec = HistoryRecord.objects.create(gallery=upload["gallery"])
+        rec.query_image.save(upload["filename"], ContentFile(upload["image_bytes"]), save=True)
 
     request.session["last_history_id"] = rec.id
 
     # mark pending immediately to avoid race with results page polling
     _set_task_pending(rec.id)
+    return rec.id
 
-    # kick async task
-    fut = _EXECUTOR.submit(_run_search_async, rec.id, image_bytes, up.name or "query.jpg", topk)
 
-    # 尝试在请求内“抢一把”：如果机器够快，直接一秒内拿到结果
-    # 默认等待 900ms，可用环境变量/设置关闭或调整
+def _submit_search(ticket: Ticket, rec_id: int, upload: dict):
+    return ticket.submit(
+        _run_search_async, rec_id, upload["image_bytes"], upload["filename"], upload["topk"],
+        upload["flt"], upload["threshold"], upload["gallery"],
+        on_start=lambda wait_s: _set_task_started(rec_id, wait_s),
+    )
+
+
+def _sync_wait_ms() -> int:
     try:
-        wait_ms = int(getattr(settings, "INDEX_SYNC_WAIT_MS", 900))
+        return int(getattr(settings, "INDEX_SYNC_WAIT_MS", 900))
     except Exception:
-        wait_ms = 900
+        return 900
 
-    if wait_ms > 0:
-        try:
-            fut.result(timeout=wait_ms / 1000.0)
-        except FutureTimeout:
-            pass
 
-    redirect_url = reverse("results") + f"?hid={rec.id}"
+def _upload_response(rec_id: int, is_xhr: bool) -> HttpResponse:
+    redirect_url = reverse("results") + f"?hid={rec_id}"
     if is_xhr:
-        return JsonResponse({"ok": True, "redirect": redirect_url, "hid": rec.id, "pending": True})
+        return JsonResponse({"ok": True, "redirect": redirect_url, "hid": rec_id, "pending": True})
     return redirect(redirect_url)
 
 
@@ -300,16 +1020,7 @@ def results(request: HttpRequest) -> HttpResponse:
         })
     
     # 加载搜索结果
-    items = HistoryItem.objects.filter(record=rec).order_by("-score")[:50]
-    results_list = [
-        {
-            "rank": idx + 1,
-            "url": item.url,
-            "score": item.score,
-            "quality": item.quality,
-        }
-        for idx, item in enumerate(items)
-    ]
+    results_list, stale = _result_rows(rec)
     
     # 检查是否还在等待中
     status = cache.get(_ck_status(rec.id), "done")
@@ -319,7 +1030,107 @@ def results(request: HttpRequest) -> HttpResponse:
         "query_web_url": rec.query_preview_url,
         "results": results_list,
         "pending": pending,
+        "stale": _STALE_HINT if stale else None,
         "hid": rec.id,
+        "gallery": rec.gallery,
+    })
+
+
+def _similar_lookup(request: HttpRequest):
+    """
+    gid（图库行号）或 url -> (engine, 行号, 该行 url, 相似结果)；参数错误时行号为 -1。未知图库抛 KeyError。
+    kNN 图覆盖不到、要做一次精确检索时放进 interactive 通道，队列满或超出会话并发时抛 Overloaded。
+    """
+    engine = get_engine(_gallery_param(request.GET))
+    try:
+        topk = int(request.GET.get("topk", "50"))
+    except Exception:
+        topk = 50
+    topk = max(1, min(topk, 200))
+
+    row, url = -1, None
+    gid = request.GET.get("gid")
+    if gid not in (None, ""):
+        try:
+            row = int(gid)
+        except Exception:
+            row = -1
+    else:
+        url = request.GET.get("url") or None
+    if row < 0 and not url:
+        return engine, -1, None, []
+    row, query_url, hits = engine.similar_to(url, row=row, topk=topk, scan=False)
+    if hits is None:
+        row, query_url, hits = _run_in_lane(request, "interactive", engine.similar_to, url, row, topk)
+    return engine, row, query_url, hits
+
+
+@require_http_methods(["GET"])
+@ensure_csrf_cookie
+def similar(request: HttpRequest) -> HttpResponse:
+    """相似图页（more like this）：直接用图库行的预计算邻居，不需要重新上传/embedding"""
+    try:
+        engine, row, query_url, hits = _similar_lookup(request)
+    except KeyError:
+        return render(request, "image_search/results.html", {
+            "query_web_url": None,
+            "results": [],
+            "pending": False,
+            "error": "未知图库",
+        })
+    except Overloaded as e:
+        resp = render(request, "image_search/results.html", {
+            "query_web_url": None,
+            "results": [],
+            "pending": False,
+            "error": f"服务繁忙（{e.reason}），请 {e.retry_after} 秒后重试",
+        }, status=429)
+        resp["Retry-After"] = str(e.retry_after)
+        return resp
+    if row < 0 or not len(hits):
+        return render(request, "image_search/results.html", {
+            "query_web_url": None,
+            "results": [],
+            "pending": False,
+            "error": engine.last_error if not engine.ready else "图库中找不到这张图片",
+        })
+
+    results_list = [
+        {"rank": i + 1, "url": r.url, "score": r.score}
+        for i, r in enumerate(hits)
+    ]
+    return render(request, "image_search/results.html", {
+        "query_web_url": query_url,
+        "results": results_list,
+        "pending": False,
+        "gallery": _gallery_param(request.GET),
+    })
+
+
+@require_http_methods(["GET"])
+def api_similar(request: HttpRequest) -> JsonResponse:
+    """相似图API：?gid=<图库行号> 或 ?url=<图库 url>，可选 topk、gallery"""
+    try:
+        engine, row, query_url, hits = _similar_lookup(request)
+    except KeyError:
+        return _unknown_gallery(_gallery_param(request.GET))
+    except Overloaded as e:
+        return _overloaded(e)
+    if not engine.ready:
+        return JsonResponse({"ok": False, "error": engine.last_error or "gallery not loaded"}, status=503)
+    if row < 0:
+        return JsonResponse({"ok": False, "error": "gid or url of a gallery image required"}, status=400)
+    if not len(hits):
+        return JsonResponse({"ok": False, "error": "not found"}, status=404)
+
+    return JsonResponse({
+        "ok": True,
+        "gid": row,
+        "resultsCount": len(hits),
+        "results": [
+            {"rank": i + 1, "url": r.url, "score": float(r.score), "index": r.index}
+            for i, r in enumerate(hits)
+        ],
     })
 
 
@@ -336,23 +1147,15 @@ def history(request: HttpRequest) -> HttpResponse:
 def history_detail(request: HttpRequest, record_id: int) -> HttpResponse:
     """历史详情页"""
     rec = get_object_or_404(HistoryRecord, id=record_id)
-    items = HistoryItem.objects.filter(record=rec).order_by("-score")[:50]
-    
-    results_list = [
-        {
-            "rank": idx + 1,
-            "url": item.url,
-            "score": item.score,
-            "quality": item.quality,
-        }
-        for idx, item in enumerate(items)
-    ]
+    results_list, stale = _result_rows(rec)
     
     return render(request, "image_search/results.html", {
         "query_web_url": rec.query_preview_url,
         "results": results_list,
         "pending": False,
+        "stale": _STALE_HINT if stale else None,
         "hid": rec.id,
+        "gallery": rec.gallery,
     })
 
 
@@ -379,25 +1182,300 @@ def api_results(request: HttpRequest) -> JsonResponse:
     status = cache.get(_ck_status(rec.id), "done")
     pending = status == "pending"
     
-    items = HistoryItem.objects.filter(record=rec).order_by("-score")[:50]
-    results_list = [
-        {
-            "rank": idx + 1,
-            "url": item.url,
-            "score": float(item.score),
-            "quality": item.quality,
-        }
-        for idx, item in enumerate(items)
-    ]
+    results_list, stale = _result_rows(rec)
     
     return JsonResponse({
         "ok": True,
         "pending": pending,
+        # 排队等待时间（毫秒）；None 表示还在排队（或记录早于调度器/缓存已过期）
+        "queueWaitMs": cache.get(_ck_wait(rec.id)),
+        # 图库已变化、保存的结果解析不了（可调 /api/history/refresh/ 重新检索）
+        "stale": stale,
         "resultsCount": len(results_list),
         "results": results_list,
     })
 
 
+def _result_rows_or_none(record_id: int) -> tuple[list, bool] | None:
+    pending = cache.get(_ck_results(record_id))
+    if isinstance(pending, list):
+        return pending, False
+    rec = HistoryRecord.objects.filter(id=record_id).first()
+    return None if rec is None else _result_rows(rec)
+
+
+# 同进程内的任务由 _TASK_EVENTS 立即唤醒；别的进程完成的任务靠每秒看一次 cache 里的状态发现
+_WAIT_RECHECK_S = 1.0
+
+
+async def api_results_wait(request: HttpRequest) -> HttpResponse:
+    """
+    长轮询版的结果 API：任务还在进行时挂起请求，直到后台任务结束（或 timeout 秒，上限 RESULTS_WAIT_TIMEOUT）。
+    等待期间只读 cache 里的任务状态，不查 DB；结束后查一次结果返回。超时返回 pending=true，客户端立即重发。
+    async view：ASGI 下等待不占线程，WSGI 下同样可用。
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    try:
+        hid = int(request.GET.get("hid") or 0)
+    except Exception:
+        hid = 0
+    if hid <= 0:
+        return JsonResponse({"ok": False, "error": "hid required"}, status=400)
+
+    try:
+        cap = float(getattr(settings, "RESULTS_WAIT_TIMEOUT", 25))
+    except Exception:
+        cap = 25.0
+    try:
+        timeout = min(cap, max(0.0, float(request.GET.get("timeout") or cap)))
+    except Exception:
+        timeout = cap
+
+    deadline = time.monotonic() + timeout
+    status = await cache.aget(_ck_status(hid))
+    while status == "pending":
+        left = deadline - time.monotonic()
+        if left <= 0:
+            wait_ms = await cache.aget(_ck_wait(hid))
+            return JsonResponse({"ok": True, "pending": True, "queued": wait_ms is None, "queueWaitMs": wait_ms})
+        await _TASK_EVENTS.wait(hid, min(left, _WAIT_RECHECK_S))
+        status = await cache.aget(_ck_status(hid))
+
+    wait_ms = await cache.aget(_ck_wait(hid))
+    if status == "error":
+        error = await cache.aget(_ck_error(hid))
+        return JsonResponse({"ok": True, "pending": False, "error": error or "unknown error", "queueWaitMs": wait_ms})
+
+    loaded = await sync_to_async(_result_rows_or_none)(hid)
+    if loaded is None:
+        return JsonResponse({"ok": False, "error": "not found"}, status=404)
+    results_list, stale = loaded
+    return JsonResponse({
+        "ok": True,
+        "pending": False,
+        "queueWaitMs": wait_ms,
+        "stale": stale,
+        "resultsCount": len(results_list),
+        "results": results_list,
+    })
+
+
+@require_POST
+@csrf_protect
+def api_history_refresh(request: HttpRequest) -> JsonResponse:
+    """
+    用历史记录里存的 query_feat 在当前图库上重新检索并覆盖结果（不解码图片、不跑 ViT）。
+    可选参数与首页一致：topk、tier/threshold、folder/attr.<列名>。
+    """
+    try:
+        rec = HistoryRecord.objects.get(id=int(request.POST.get("id", 0)))
+    except Exception:
+        return JsonResponse({"ok": False, "error": "not found"}, status=404)
+
+    try:
+        engine = get_engine(rec.gallery or None)
+    except KeyError:
+        return _unknown_gallery(rec.gallery)
+    if not engine.ready:
+        return JsonResponse({"ok": False, "error": engine.last_error or "gallery not loaded"}, status=503)
+
+    q_feat = _stored_feat(rec, engine)
+    if q_feat is None:
+        return JsonResponse(
+            {"ok": False, "error": "stored embedding does not match the current gallery; search again with the image"},
+            status=409,
+        )
+
+    try:
+        topk = int(request.POST.get("topk") or _result_count(rec) or 50)
+    except Exception:
+        topk = 50
+    topk = max(1, min(topk, 200))
+
+    try:
+        results = _run_in_lane(request, "bulk", _engine_search, engine, q_feat, topk,
+                               _parse_filter(request.POST), _parse_threshold(request.POST))
+    except Overloaded as e:
+        return _overloaded(e)
+    except ValueError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+
+    with _SAVE_LOCK, transaction.atomic():
+        rec = HistoryRecord.objects.select_for_update().get(id=rec.id)
+        _store_results(rec, results)
+        rec.save(update_fields=RESULT_FIELDS)
+
+    return JsonResponse({
+        "ok": True,
+        "resultsCount": len(results),
+        "results": [
+            {"rank": i + 1, "url": r.url, "score": float(r.score)}
+            for i, r in enumerate(results)
+        ],
+    })
+
+
+def _bulk_token(request: HttpRequest) -> str:
+    """请求带的批量检索 token（Authorization: Bearer <token> 或 X-API-Token），没带返回空串"""
+    auth = request.META.get("HTTP_AUTHORIZATION", "")
+    if auth[:7].lower() == "bearer ":
+        return auth[7:].strip()
+    return request.META.get("HTTP_X_API_TOKEN", "").strip()
+
+
+def _bulk_token_ok(token: str) -> bool:
+    expected = str(getattr(settings, "BULK_SEARCH_API_TOKEN", "") or "")
+    return bool(token and expected) and hmac.compare_digest(token.encode(), expected.encode())
+
+
+def _bulk_max_bytes() -> int:
+    try:
+        return max(1, int(float(getattr(settings, "BULK_SEARCH_MAX_MB", 64)) * 1024 * 1024))
+    except Exception:
+        return 64 * 1024 * 1024
+
+
+@csrf_exempt
+@require_POST
+def api_search_bulk(request: HttpRequest) -> HttpResponse:
+    """
+    批量检索API（离线去重/评测用），一次 GEMM 打分：
+    - images: 多个图片文件（同一字段名重复上传）
+    - queries: 一个 .npy 文件，形状 (B, D) 的 float32 query embedding
+    - folder / attr.<列名>: 可选过滤条件，只在命中的行里检索
+    - tier / threshold: 可选范围检索，返回所有过线结果（上限 RANGE_SEARCH_MAX_RESULTS，忽略 topk）
+    - gallery: 可选图库 id（默认 DEFAULT_GALLERY）
+
+    只对 staff 会话（照常校验 CSRF）或带 BULK_SEARCH_API_TOKEN 的调用方开放。
+    鉴权、请求体大小和队列准入都在解析上传之前完成，被拒的请求不会读文件、不会 np.load。
+    """
+    token = _bulk_token(request)
+    if _bulk_token_ok(token):
+        # token 调用方没有 session，按 token 计并发名额
+        client, view = "t:" + hashlib.sha256(token.encode()).hexdigest()[:16], _search_bulk
+    elif _is_staff(request):
+        client, view = _client_key(request), _search_bulk_csrf
+    else:
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length > _bulk_max_bytes():
+        return JsonResponse({"ok": False, "error": "request body too large"}, status=413)
+
+    # 批量检索走低优先级通道：排在交互式上传之后，且只能占用一部分队列
+    try:
+        ticket = _SCHEDULER.admit("bulk", client)
+    except Overloaded as e:
+        return _overloaded(e)
+    try:
+        return view(request, ticket)
+    finally:
+        # 提前返回（参数错误、CSRF 失败）时归还名额；已 submit 的 ticket 这里是空操作
+        ticket.release()
+
+
+def _search_bulk(request: HttpRequest, ticket: Ticket) -> JsonResponse:
+    try:
+        topk = int(request.POST.get("topk", "50"))
+    except Exception:
+        topk = 50
+    topk = max(1, min(topk, 200))
+
+    try:
+        max_queries = int(getattr(settings, "BULK_SEARCH_MAX_QUERIES", 1024))
+    except Exception:
+        max_queries = 1024
+
+    gallery = _gallery_param(request.POST)
+    try:
+        engine = get_engine(gallery)
+    except KeyError:
+        return _unknown_gallery(gallery)
+    if not engine.ready:
+        return JsonResponse({"ok": False, "error": engine.last_error or "gallery not loaded"}, status=503)
+
+    names: list[str] = []
+    images: list[bytes] = []
+    Q_ext: np.ndarray | None = None
+    try:
+        ups = request.FILES.getlist("images")
+        if ups:
+            if len(ups) > max_queries:
+                return JsonResponse({"ok": False, "error": f"too many images (max {max_queries})"}, status=400)
+            images = [u.read() for u in ups]
+            names.extend(u.name or f"image_{i}" for i, u in enumerate(ups))
+
+        qf = request.FILES.get("queries")
+        if qf:
+            Q = np.load(io.BytesIO(qf.read()), allow_pickle=False)
+            Q = np.asarray(Q, dtype=np.float32)
+            if Q.ndim == 1:
+                Q = Q[None, :]
+            if Q.ndim != 2:
+                return JsonResponse({"ok": False, "error": f"bad queries shape: {Q.shape}"}, status=400)
+            if Q.shape[0] + len(names) > max_queries:
+                return JsonResponse({"ok": False, "error": f"too many queries (max {max_queries})"}, status=400)
+            Q_ext = Q
+            names.extend(f"query_{i}" for i in range(Q.shape[0]))
+    except Exception as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+
+    if not names:
+        return JsonResponse({"ok": False, "error": "images or queries required"}, status=400)
+
+    threshold = _parse_threshold(request.POST)
+    flt = _parse_filter(request.POST)
+
+    def work() -> list:
+        blocks: list[np.ndarray] = []
+        if images:
+            try:
+                blocks.append(engine.embed_queries(images))
+            except Exception as e:
+                raise ValueError(str(e))
+        if Q_ext is not None:
+            blocks.append(Q_ext)
+        # 图片 embedding 已在检索空间；外部 .npy 若是 768 维会被 search_batch 自动投影
+        if threshold > 0:
+            # 外部 .npy 若未归一化，先按行归一化（search_range 不会替调用方归一化）
+            batches = [
+                [engine.search_range(q / (np.linalg.norm(q) + 1e-12), threshold, max_results=_range_cap(), flt=flt)
+                 for q in Q]
+                for Q in blocks
+            ]
+        else:
+            batches = [engine.search_batch(Q, topk=topk, flt=flt) for Q in blocks]
+        return [r for b in batches for r in b]
+
+    try:
+        all_results = ticket.submit(work).result()
+    except ValueError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+
+    return JsonResponse({
+        "ok": True,
+        "count": len(names),
+        "queries": [
+            {
+                "name": name,
+                "results": [
+                    {"rank": i + 1, "url": r.url, "score": float(r.score), "index": r.index}
+                    for i, r in enumerate(res)
+                ],
+            }
+            for name, res in zip(names, all_results)
+        ],
+    })
+
+
+# staff 通过浏览器会话调用时仍要带 CSRF token（入口本身 csrf_exempt 是为了放行 token 调用方）
+_search_bulk_csrf = csrf_protect(_search_bulk)
+
+
 @require_http_methods(["POST"])
 @csrf_protect
 def api_history_remove(request: HttpRequest) -> JsonResponse:
@@ -461,4 +1539,118 @@ def api_favorite_remove(request: HttpRequest) -> JsonResponse:
         fav.delete()
         return JsonResponse({"ok": True})
     except Exception as e:
-        return JsonResponse({"ok": False, "error": str(e)}, status=400)
\ No newline at end of file
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+
+
+def _is_staff(request: HttpRequest) -> bool:
+    user = getattr(request, "user", None)
+    return bool(user is not None and user.is_authenticated and user.is_staff)
+
+
+@require_http_methods(["GET"])
+def api_engine_stats(request: HttpRequest) -> JsonResponse:
+    """引擎运行指标（仅 staff）：已加载图库及占用、微批调度器的批大小分布/填充率/等待时间、检索子进程池状态、
+    任务队列各通道的深度/排队等待/拒绝次数、embedding 缓存命中率、进行中检索的合并次数、历史写线程的批大小/积压、
+    各图库 TopK 结果缓存的命中率和占用（检索子进程各有一份缓存，这里只反映本进程）。"""
+    if not _is_staff(request):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+
+    registry = get_registry()
+    galleries, batching = [], None
+    for gid, nbytes in registry.loaded():
+        engine = registry.peek(gid)
+        if engine is None:
+            continue
+        galleries.append({
+            "id": gid,
+            "ready": engine.ready,
+            "version": engine.gallery_version,
+            "bytes": nbytes,
+            "error": engine.last_error,
+            "result_cache": engine.result_cache_stats(),
+        })
+        # 调度器按模型共享，任取一个已加载模型的引擎即可
+        batching = batching or engine.batch_stats()
+    pool = _WORKER_POOL
+    store = get_embed_cache()
+    return JsonResponse({"ok": True, "galleries": galleries, "embed_batching": batching,
+                         "workers": pool.stats() if pool is not None else None,
+                         "scheduler": _SCHEDULER.stats(),
+                         "embed_cache": store.stats() if store is not None else None,
+                         "single_flight": {"search": _SEARCH_FLIGHT.stats(), "embed": _EMBED_FLIGHT.stats()},
+                         "history_writer": _HISTORY_WRITER.stats() if _HISTORY_WRITER is not None else None})
+
+
+@require_POST
+def api_gallery_reload(request: HttpRequest) -> JsonResponse:
+    """
+    管理员触发图库热更新（仅 staff）：当前进程后台加载新索引并原子替换，
+    同时 touch 触发文件通知其他 worker。加载期间旧索引继续服务。
+    """
+    if not _is_staff(request):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+
+    gallery = _gallery_param(request.POST)
+    try:
+        engine = get_engine(gallery)
+    except KeyError:
+        return _unknown_gallery(gallery)
+    version = engine.gallery_version
+    # 先 touch 再加载：新快照记录的 stamp 已包含触发文件，本进程的 watcher 不会重复加载
+    try:
+        touched = touch_reload_trigger(gallery)
+    except Exception:
+        touched = False
+    engine.reload_gallery_async()
+    return JsonResponse({"ok": True, "version": version, "triggered": touched})
+
+
+@require_POST
+def api_gallery_add(request: HttpRequest) -> JsonResponse:
+    """
+    在线加入图片（仅 staff）：字段 images 可重复上传多张。
+    新图写入增量段后立即可检索，其他 worker 由 watcher 在 GALLERY_WATCH_INTERVAL 内同步。
+    """
+    if not _is_staff(request):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+
+    ups = request.FILES.getlist("images")
+    if not ups:
+        return JsonResponse({"ok": False, "error": "images required"}, status=400)
+
+    gallery = _gallery_param(request.POST)
+    try:
+        engine = get_engine(gallery)
+    except KeyError:
+        return _unknown_gallery(gallery)
+    try:
+        added = engine.add_images([(f.name, f.read()) for f in ups])
+    except Exception as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+    return JsonResponse({
+        "ok": True,
+        "added": [engine._to_url(p) for p in added],
+        "version": engine.gallery_version,
+    })
+
+
+@require_POST
+def api_gallery_remove(request: HttpRequest) -> JsonResponse:
+    """在线删除图片（仅 staff）：字段 paths 可重复，值为图库 url 或相对路径。"""
+    if not _is_staff(request):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+
+    paths = [p for p in request.POST.getlist("paths") if p.strip()]
+    if not paths:
+        return JsonResponse({"ok": False, "error": "paths required"}, status=400)
+
+    gallery = _gallery_param(request.POST)
+    try:
+        engine = get_engine(gallery)
+    except KeyError:
+        return _unknown_gallery(gallery)
+    try:
+        removed = engine.remove_images(paths)
+    except Exception as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+    return JsonResponse({"ok": True, "removed": removed, "version": engine.gallery_version})
@@ -0,0 +1,280 @@
+"""
+embedding + 检索子进程池：图片解码/预处理、ViT 前向和打分都在独立进程里做，不和 Django 的请求线程争 GIL。
+
+- 每个子进程按图库配置各自创建 SearchEngine（share_features=True），图库矩阵通过命名共享内存或 mmap 只映射一份；
+  子进程里的图库同样由 EngineRegistry 按内存预算（budget_bytes，与主进程相同）做 LRU 卸载
+- 固定数量的共享内存槽：请求方把图片字节（或已有的 embedding）写进槽的输入区，
+  子进程把 embedding、命中的行号和分数写进输出区，管道里只传槽号、参数和结果 URL
+- 每个子进程一条独立管道，槽位固定分给子进程（slot % processes）；
+  子进程被杀时只影响它自己的管道，结果线程把它手上的任务以异常结束、归还槽位并重启它
+"""
+
+from __future__ import annotations
+
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 输出区：embedding 最多 _MAX_DIM 维 + max_hits 个 (int64 行号, float32 分数)
+_MAX_DIM = 4096
+
+
+def _worker_main(conn, configs: dict, slot_names: List[str], in_bytes: int, max_hits: int,
+                 watch_interval: float, budget_bytes: int = 0) -> None:
+    from .registry import EngineRegistry
+    from .search_engine import SearchEngine
+    from .shared_matrix import attach_shm
+
+    def build(gid: str, kwargs: dict) -> SearchEngine:
+        eng = SearchEngine(**kwargs)
+        eng.start_watcher(watch_interval)
+        return eng
+
+    slots = [attach_shm(name) for name in slot_names]
+    engines = EngineRegistry(configs, build, budget_bytes=budget_bytes)
+    out_ids = in_bytes + _MAX_DIM * 4
+    out_scores = out_ids + max_hits * 8
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        tid, slot, nbytes, kind, gallery, topk, flt, threshold, max_results = msg
+        try:
+            eng = engines.get(gallery)
+            buf = slots[slot].buf
+            if kind == "image":
+                q = eng.embed_query(bytes(buf[:nbytes]))
+            else:
+                q = np.frombuffer(buf, dtype=np.float32, count=nbytes // 4).copy()
+                raw_dim = int(eng.pca_proj.shape[0]) if eng.pca_proj is not None else eng.query_dim
+                if eng.ready and q.shape[0] not in (eng.query_dim, raw_dim):
+                    raise ValueError(f"query dim {q.shape[0]} != gallery dim {eng.query_dim}")
+            if threshold > 0:
+                hits = eng.search_range(q, threshold, max_results=max_results or max_hits, flt=flt)
+            else:
+                hits = eng.search(q, topk=topk, flt=flt)
+            if not eng.ready:
+                raise RuntimeError(eng.last_error or "gallery not loaded")
+
+            top = list(hits[:max_hits])
+            q = np.asarray(q, dtype=np.float32)
+            np.ndarray(q.shape, dtype=np.float32, buffer=buf, offset=in_bytes)[:] = q
+            np.ndarray((len(top),), dtype=np.int64, buffer=buf, offset=out_ids)[:] = [r.index for r in top]
+            np.ndarray((len(top),), dtype=np.float32, buffer=buf, offset=out_scores)[:] = [r.score for r in top]
+            conn.send(("ok", tid, (int(q.shape[0]), len(top), [r.url for r in top], eng.embedding_tag,
+                                   eng.cache_tag, getattr(hits, "rows_tag", ""))))
+        except Exception as e:
+            conn.send(("error", tid, f"{type(e).__name__}: {e}"))
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        configs: Dict[str, dict],
+        processes: int = 2,
+        slot_bytes: int = 16 << 20,
+        max_hits: int = 1024,
+        timeout: float = 60.0,
+        watch_interval: float = 0.0,
+        budget_bytes: int = 0,
+    ):
+        self.configs = configs
+        self.processes = max(1, int(processes))
+        self.in_bytes = max(1 << 20, int(slot_bytes))
+        self.max_hits = max(1, int(max_hits))
+        self.timeout = float(timeout)
+        self.watch_interval = float(watch_interval)
+        self.budget_bytes = max(0, int(budget_bytes or 0))
+
+        # 每个子进程 2 个槽：处理一个任务时，下一个任务的输入已经写好在管道里
+        size = self.in_bytes + _MAX_DIM * 4 + self.max_hits * 12
+        self._slots = [shared_memory.SharedMemory(create=True, size=size) for _ in range(2 * self.processes)]
+        self._free: "queue.SimpleQueue[int]" = queue.SimpleQueue()
+        for i in range(len(self._slots)):
+            self._free.put(i)
+
+        # spawn：子进程不继承 Django 线程/连接状态，只导入 search_engine
+        self._ctx = mp.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # tid -> [future, slot, worker id]
+        self._pending: Dict[int, list] = {}
+        self._procs: List[Optional[mp.process.BaseProcess]] = [None] * self.processes
+        self._conns: list = [None] * self.processes
+        self._send_locks = [threading.Lock() for _ in range(self.processes)]
+        self._restarts = 0
+        self._closed = False
+        for wid in range(self.processes):
+            self._spawn(wid)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="worker-results", daemon=True)
+        self._dispatcher.start()
+
+    def _spawn(self, wid: int) -> None:
+        parent, child = self._ctx.Pipe(duplex=True)
+        p = self._ctx.Process(
+            target=_worker_main,
+            args=(child, self.configs, [s.name for s in self._slots], self.in_bytes, self.max_hits,
+                  self.watch_interval, self.budget_bytes),
+            name=f"xis-worker-{wid}",
+            daemon=True,
+        )
+        p.start()
+        child.close()
+        self._procs[wid] = p
+        self._conns[wid] = parent
+
+    def run(
+        self,
+        gallery: str,
+        image: Optional[bytes] = None,
+        q: Optional[np.ndarray] = None,
+        topk: int = 50,
+        flt=None,
+        threshold: float = 0.0,
+        max_results: int = 0,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str], str, str, str]:
+        """
+        在子进程里 embedding（传 image）或直接用已有 embedding（传 q），再检索。
+        返回 (embedding, 行号, 分数, URL 列表, embedding_tag, cache_tag, rows_tag)；子进程里的异常以 RuntimeError 抛出。
+        """
+        if self._closed:
+            raise RuntimeError("worker pool is closed")
+        if image is not None:
+            kind, data = "image", memoryview(image)
+        else:
+            kind, data = "feat", memoryview(np.ascontiguousarray(q, dtype=np.float32)).cast("B")
+        if data.nbytes > self.in_bytes:
+            raise ValueError(f"query is {data.nbytes} bytes, worker slot holds {self.in_bytes}")
+
+        try:
+            slot = self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("no free worker slot")
+        wid = slot % self.processes
+        buf = self._slots[slot].buf
+        buf[:data.nbytes] = data
+        fut: Future = Future()
+        tid = next(self._ids)
+        with self._lock:
+            self._pending[tid] = [fut, slot, wid]
+        try:
+            with self._send_locks[wid]:
+                self._conns[wid].send((tid, slot, data.nbytes, kind, gallery, int(topk), flt, float(threshold),
+                                       int(max_results)))
+        except (OSError, ValueError) as e:
+            # 子进程刚好退出；结果线程会重启它
+            with self._lock:
+                self._pending.pop(tid, None)
+            self._free.put(slot)
+            raise RuntimeError(f"worker {wid} unavailable: {e}")
+
+        try:
+            dim, k, urls, tag, cache_tag, rows_tag = fut.result(timeout=self.timeout)
+        except FutureTimeout:
+            # 取消后由结果线程在子进程交回结果（或子进程退出）时归还槽位
+            if fut.cancel():
+                raise TimeoutError(f"worker did not answer within {self.timeout:.0f}s")
+            dim, k, urls, tag, cache_tag, rows_tag = fut.result()
+        except BaseException:
+            self._free.put(slot)
+            raise
+
+        try:
+            off = self.in_bytes
+            emb = np.ndarray((dim,), dtype=np.float32, buffer=buf, offset=off).copy()
+            off += _MAX_DIM * 4
+            ids = np.ndarray((k,), dtype=np.int64, buffer=buf, offset=off).copy()
+            off += self.max_hits * 8
+            scores = np.ndarray((k,), dtype=np.float32, buffer=buf, offset=off).copy()
+        finally:
+            self._free.put(slot)
+        return emb, ids, scores, urls, tag, cache_tag, rows_tag
+
+    def _dispatch(self) -> None:
+        while not self._closed:
+            conns = [c for c in self._conns if c is not None]
+            for conn in wait(conns, timeout=1.0):
+                wid = self._conns.index(conn)
+                try:
+                    kind, tid, payload = conn.recv()
+                except (EOFError, OSError):
+                    if not self._closed:
+                        self._restart(wid)
+                    continue
+                with self._lock:
+                    entry = self._pending.pop(tid, None)
+                if entry is None:
+                    continue
+                fut, slot = entry[0], entry[1]
+                # 先把 future 置为运行中：此后 run() 里的 cancel() 不会成功，写结果不会撞上 InvalidStateError；
+                # 已被取消的直接归还槽位
+                if not fut.set_running_or_notify_cancel():
+                    self._free.put(slot)
+                elif kind == "ok":
+                    fut.set_result(payload)
+                else:
+                    fut.set_exception(RuntimeError(payload))
+
+    def _restart(self, wid: int) -> None:
+        """子进程退出：它手上的任务以异常结束（已取消的直接归还槽位），换新管道重启。"""
+        p = self._procs[wid]
+        if p is not None:
+            p.join(timeout=1.0)
+        with self._lock:
+            lost = [tid for tid, e in self._pending.items() if e[2] == wid]
+            entries = [self._pending.pop(tid) for tid in lost]
+        for fut, slot, _ in entries:
+            if not fut.set_running_or_notify_cancel():
+                self._free.put(slot)
+            else:
+                fut.set_exception(RuntimeError(f"worker {wid} exited with code {p.exitcode if p else None}"))
+        with self._send_locks[wid]:
+            self._conns[wid].close()
+            self._spawn(wid)
+        self._restarts += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "processes": self.processes,
+            "alive": sum(1 for p in self._procs if p is not None and p.is_alive()),
+            "restarts": self._restarts,
+            "slots": len(self._slots),
+            "free_slots": self._free.qsize(),
+            "in_flight": pending,
+        }
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for wid, conn in enumerate(self._conns):
+            try:
+                with self._send_locks[wid]:
+                    conn.send(None)
+            except Exception:
+                pass
+        for p in self._procs:
+            if p is not None:
+                p.join(timeout=2.0)
+                if p.is_alive():
+                    p.terminate()
+        for s in self._slots:
+            try:
+                s.close()
+                s.unlink()
+            except Exception:
+                pass
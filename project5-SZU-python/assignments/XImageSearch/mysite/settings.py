@@ -1,4 +1,5 @@
 from pathlib import Path
+import json
 import os
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -68,6 +69,8 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # 检索任务线程（ENGINE_TASK_WORKERS）和多进程部署会并发写库：拿不到写锁时最多等这么多秒再报 database is locked
+        "OPTIONS": {"timeout": float(os.getenv("SQLITE_TIMEOUT", "20"))},
     }
 }
 
@@ -103,6 +106,49 @@ GALLERY_ROOT = Path(os.getenv("GALLERY_ROOT", str(DATA_DIR / "images")))
 GALLERY_INDEX = os.getenv("GALLERY_INDEX", str(DATA_DIR / "features" / "gallery_index.csv"))
 GALLERY_FEATURES = os.getenv("GALLERY_FEATURES", str(DATA_DIR / "features" / "gallery_features.npy"))
 GALLERY_CDN_BASE = os.getenv("GALLERY_CDN_BASE") or None
+# 单文件图库索引（build_gallery.py --out_bin 生成）；存在时优先于 GALLERY_FEATURES + GALLERY_INDEX
+GALLERY_FILE = os.getenv("GALLERY_FILE", str(DATA_DIR / "features" / "gallery.idx"))
+# 可选：PCA/whitening 降维投影（assignments/fit_pca.py 生成）；文件不存在时按原始 768 维检索
+GALLERY_PCA = os.getenv("GALLERY_PCA", str(DATA_DIR / "features" / "gallery_pca.npz"))
+# 预归一化的特征文件（assignments/normalize_gallery.py 生成）直接 mmap 分块扫描，常驻内存与图库大小无关
+GALLERY_MMAP_SEARCH = os.getenv("GALLERY_MMAP_SEARCH", "1").lower() in ("1", "true", "yes")
+GALLERY_CHUNK_ROWS = int(os.getenv("GALLERY_CHUNK_ROWS", "65536"))
+# 热更新：每隔 N 秒检查上面的图库文件是否变化，变化后后台加载并原子替换（0=关闭）
+# 所有 worker 都会监视 GALLERY_RELOAD_TRIGGER，`manage.py reload_gallery` 通过 touch 它来通知全部进程
+GALLERY_WATCH_INTERVAL = float(os.getenv("GALLERY_WATCH_INTERVAL", "5"))
+GALLERY_RELOAD_TRIGGER = os.getenv("GALLERY_RELOAD_TRIGGER", str(DATA_DIR / "features" / "gallery.reload"))
+# 在线增删图片的增量段（新增特征 + 删除墓碑），`manage.py merge_gallery_delta` 合并进 base
+GALLERY_DELTA = os.getenv("GALLERY_DELTA", str(DATA_DIR / "features" / "gallery_delta.npz"))
+# 预计算的图库 kNN 图（assignments/build_knn.py 生成），用于结果页“相似”；不存在时退化为精确检索
+GALLERY_KNN = os.getenv("GALLERY_KNN", str(DATA_DIR / "features" / "gallery_knn.bin"))
+# 可选 ANN（IVF）索引（assignments/build_ivf.py 生成，文件里带离线调参的 Pareto 表）；不存在时精确检索
+GALLERY_IVF = os.getenv("GALLERY_IVF", str(DATA_DIR / "features" / "gallery_ivf.bin"))
+# 按目标从 Pareto 表选 nprobe/rerank：单 query p95 延迟预算（毫秒）和/或 recall@k 目标，都为 0 则始终精确检索
+ANN_TARGET_P95_MS = float(os.getenv("ANN_TARGET_P95_MS", "0"))
+ANN_TARGET_RECALL = float(os.getenv("ANN_TARGET_RECALL", "0.95"))
+# 分片检索：协调端只加载模型，query 扇出到这些分片服务（`manage.py run_shard_server --shard i/n --listen ...`）
+# 地址逗号分隔，形如 unix:/run/xis/shard0.sock 或 127.0.0.1:7001；为空时在本进程检索
+GALLERY_SHARDS = [a.strip() for a in os.getenv("GALLERY_SHARDS", "").split(",") if a.strip()]
+# 分片连接的认证密钥，协调端和分片必须一致；配置了分片时必填（不借用 SECRET_KEY，连接上传的是 pickle）
+GALLERY_SHARD_AUTHKEY = os.getenv("GALLERY_SHARD_AUTHKEY", "")
+# 默认只允许 unix: 和回环地址（127.0.0.1/::1/localhost）；确需跨机器时再打开，并只在可信内网里用
+GALLERY_SHARD_ALLOW_REMOTE = os.getenv("GALLERY_SHARD_ALLOW_REMOTE", "0").lower() in ("1", "true", "yes")
+GALLERY_SHARD_TIMEOUT = float(os.getenv("GALLERY_SHARD_TIMEOUT", "30"))
+# 在线新增的原图保存在 GALLERY_ROOT 下的这个子目录
+GALLERY_UPLOAD_SUBDIR = os.getenv("GALLERY_UPLOAD_SUBDIR", "uploads")
+
+# ====== 多图库（租户）======
+# 上面的 GALLERY_* 是默认图库（id = DEFAULT_GALLERY）；GALLERIES_CONFIG 指向一个 JSON 文件，按 id 配置其他图库：
+#   {"shop": {"file": ".../shop.idx", "root": ".../shop_images", "url": "/gallery/shop/", "knn": "..."}}
+# 可用键：features/index/file/pca/delta/knn/ivf/trigger/shards/root/url/cdn_base，未写的文件键为空，root/url/cdn_base 沿用默认图库
+DEFAULT_GALLERY = os.getenv("DEFAULT_GALLERY", "default")
+GALLERIES_CONFIG = os.getenv("GALLERIES_CONFIG", "")
+GALLERIES = {}
+if GALLERIES_CONFIG and os.path.isfile(GALLERIES_CONFIG):
+    with open(GALLERIES_CONFIG, "r", encoding="utf-8") as _f:
+        GALLERIES = json.load(_f)
+# 已加载图库（特征 + 路径表等常驻内存）的总预算，超过后按 LRU 卸载最久未用的图库（0=不限制）
+GALLERY_MEMORY_BUDGET_MB = int(os.getenv("GALLERY_MEMORY_BUDGET_MB", "0"))
 
 # DINOv2 NumPy 权重
 DINO_WEIGHTS = os.getenv("DINO_WEIGHTS", str(DATA_DIR / "models" / "vit-dinov2-base.npz"))
@@ -127,9 +173,65 @@ ENGINE_WARMUP = os.getenv("ENGINE_WARMUP", "1").lower() in ("1", "true", "yes")
 ENGINE_WARMUP_EMBED = os.getenv("ENGINE_WARMUP_EMBED", "0").lower() in ("1", "true", "yes")
 # embedding 缓存：同一张图重复搜可以秒出
 ENGINE_EMBED_CACHE_TTL = int(os.getenv("ENGINE_EMBED_CACHE_TTL", "86400"))
+# 持久化 embedding 缓存（SQLite，同机 worker 共享、重启不丢，按图片 sha256 + 模型指纹 + PCA 区分）；
+# 置空则退回 Django cache（上面的 TTL 只对这种情况生效）。超过 EMBED_CACHE_MAX_MB 时按最近使用淘汰
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", str(DATA_DIR / "embed_cache.sqlite3"))
+EMBED_CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "256"))
+# TopK 结果缓存（每个图库、每个进程一份，按 query 向量 + topk + 过滤条件 + 图库版本命中，图库热更新时清空）；0=关闭
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "32"))
+
+# 精确检索分片并行：总线程预算（1=单线程，0=CPU 核数）；图库行数 >= 2*ENGINE_MIN_SHARD_ROWS 才分片
+# 安装 threadpoolctl 后，进程启动时把 BLAS 线程设为 CPU 核数 / 预算（只设一次），避免线程过度订阅
+ENGINE_SEARCH_THREADS = int(os.getenv("ENGINE_SEARCH_THREADS", "1"))
+ENGINE_MIN_SHARD_ROWS = int(os.getenv("ENGINE_MIN_SHARD_ROWS", "50000"))
+
+# 范围检索（阈值/Strong 档位）最多返回多少条；结果页最多展示多少条（默认 50 与原来一致，调大需显式设置）
+RANGE_SEARCH_MAX_RESULTS = int(os.getenv("RANGE_SEARCH_MAX_RESULTS", "200"))
+RESULTS_MAX_ITEMS = int(os.getenv("RESULTS_MAX_ITEMS", "50"))
+# 1=历史结果存成每条记录一个紧凑 blob（图库行号 + 分数，读取时解析 url）；默认 0=每个结果一行 HistoryItem
+# 两种方式存下的记录都能读；base 行变化（合并增量、重建图库）后 blob 记录显示“已失效”，用“重新检索”或 rescore_history 刷新
+HISTORY_COMPACT_RESULTS = os.getenv("HISTORY_COMPACT_RESULTS", "0").lower() in ("1", "true", "yes")
+# write-behind：检索完成后结果先从内存（cache）返回，历史记录由专用写线程在 HISTORY_WRITE_WINDOW_MS 窗口内
+# 攒最多 HISTORY_WRITE_BATCH 条放进一个事务写库；进程正常退出时写完队列。0=检索线程里同步写库（旧方式）
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "1").lower() in ("1", "true", "yes")
+HISTORY_WRITE_BATCH = int(os.getenv("HISTORY_WRITE_BATCH", "64"))
+HISTORY_WRITE_WINDOW_MS = float(os.getenv("HISTORY_WRITE_WINDOW_MS", "20"))
+# 写线程最多积压这么多条：满了以后检索线程同步写库，任务队列准入也会拒绝新任务（429）
+HISTORY_WRITE_MAX_PENDING = int(os.getenv("HISTORY_WRITE_MAX_PENDING", "1024"))
+
+# 批量检索接口 /api/search/bulk/ 单次最多接受的 query 数（图片 + embedding 合计）
+BULK_SEARCH_MAX_QUERIES = int(os.getenv("BULK_SEARCH_MAX_QUERIES", "1024"))
+# 批量检索只对 staff 会话开放；脚本/离线任务用这个 token 调用（Authorization: Bearer <token> 或 X-API-Token），留空表示不开放 token 访问
+BULK_SEARCH_API_TOKEN = os.getenv("BULK_SEARCH_API_TOKEN", "")
+# 批量检索请求体上限（MB），超过直接 413，不解析上传
+BULK_SEARCH_MAX_MB = float(os.getenv("BULK_SEARCH_MAX_MB", "64"))
 
 # 上传后在当前请求里最多等待多少毫秒，尽量做到“秒出”（0 表示不等待，完全异步）
 INDEX_SYNC_WAIT_MS = int(os.getenv("INDEX_SYNC_WAIT_MS", "900"))
+# ASGI 部署（uvicorn/daphne + mysite.asgi）时用 async 版首页：等待期间不占线程，单 worker 可同时挂很多检索
+INDEX_ASYNC = os.getenv("INDEX_ASYNC", "0").lower() in ("1", "true", "yes")
+# 结果页长轮询 /api/results/wait/ 单次最多挂起多少秒（超时返回 pending，前端立即重发）
+RESULTS_WAIT_TIMEOUT = float(os.getenv("RESULTS_WAIT_TIMEOUT", "25"))
+
+# 后台检索任务线程数；>1 时并发上传的 ViT 前向才有机会被微批合并。至少 2：其中一个总是留给交互式上传，批量任务用不到
+ENGINE_TASK_WORKERS = int(os.getenv("ENGINE_TASK_WORKERS", "4"))
+# 任务队列准入：排队任务超过 TASK_QUEUE_MAX 时返回 429 + Retry-After（批量接口最多占一半）；
+# 每个会话同时进行的检索不超过 TASK_SESSION_MAX（0=不限）
+TASK_QUEUE_MAX = int(os.getenv("TASK_QUEUE_MAX", "64"))
+TASK_SESSION_MAX = int(os.getenv("TASK_SESSION_MAX", "4"))
+# 没有 session 的请求（API 客户端）按这个请求头计会话，如 HTTP_X_REAL_IP；只在代理会覆盖该头时设置，为空时给请求新建 session
+TASK_CLIENT_HEADER = os.getenv("TASK_CLIENT_HEADER", "")
+# 微批：第一个 query 到达后最多等 EMBED_BATCH_WINDOW_MS 毫秒收集其他 query，攒满 EMBED_MAX_BATCH 立即前向（0=关闭）
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "10"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "8"))
+
+# 检索子进程池：>0 时上传检索（图片解码 + ViT 前向 + 打分）在这么多个子进程里做，不占 Django 进程的 GIL
+ENGINE_WORKER_PROCESSES = int(os.getenv("ENGINE_WORKER_PROCESSES", "0"))
+# 每个任务槽的共享内存输入区大小（上传图片字节数上限）
+ENGINE_WORKER_SLOT_MB = int(os.getenv("ENGINE_WORKER_SLOT_MB", "16"))
+ENGINE_WORKER_TIMEOUT = float(os.getenv("ENGINE_WORKER_TIMEOUT", "60"))
+# 归一化后的内存图库放进命名共享内存，同机多个进程只存一份（启用子进程池时自动打开）
+GALLERY_SHARED_MEMORY = os.getenv("GALLERY_SHARED_MEMORY", "0").lower() in ("1", "true", "yes")
 
 # ✅ 如果你想在 DEBUG=False 的情况下也临时用 Django 来服务 /media/ /gallery/
 # （生产不推荐，但能“兜底避免页面打不开/图片404”）
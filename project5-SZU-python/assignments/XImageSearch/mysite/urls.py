@@ -8,9 +8,18 @@ urlpatterns = [
     path("", include("image_search.urls")),
 ]
 
+# 其他图库（GALLERIES）的 url/root；放在默认图库前面，/gallery/shop/ 这类子路径才不会被 /gallery/ 抢先匹配
+_TENANT_GALLERIES = [
+    (cfg["url"], cfg["root"])
+    for cfg in (getattr(settings, "GALLERIES", None) or {}).values()
+    if cfg.get("url") and cfg.get("root") and cfg["url"] != settings.GALLERY_URL
+]
+
 # 开发环境：Django 直接服务 media/gallery
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    for _url, _root in _TENANT_GALLERIES:
+        urlpatterns += static(_url, document_root=_root)
     urlpatterns += static(settings.GALLERY_URL, document_root=settings.GALLERY_ROOT)
 
 # 生产兜底：可选用 Django 服务 media/gallery（不推荐长期使用）
@@ -19,5 +28,11 @@ elif getattr(settings, "SERVE_MEDIA_GALLERY", False):
 
     urlpatterns += [
         path("media/<path:path>", serve, {"document_root": settings.MEDIA_ROOT}),
+    ]
+    urlpatterns += [
+        path(_url.lstrip("/") + "<path:path>", serve, {"document_root": _root})
+        for _url, _root in _TENANT_GALLERIES
+    ]
+    urlpatterns += [
         path(settings.GALLERY_URL.lstrip("/") + "<path:path>", serve, {"document_root": settings.GALLERY_ROOT}),
     ]
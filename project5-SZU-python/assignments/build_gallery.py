@@ -1,4 +1,5 @@
 import os
+import sys
 import csv
 import numpy as np
 import argparse
@@ -7,6 +8,9 @@ import time
 from dinov2_numpy import Dinov2Numpy
 from preprocess_image import resize_short_side
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "XImageSearch"))
+from image_search.gallery_format import model_fingerprint, write_gallery_file  # noqa: E402
+
 EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tiff")
 
 
@@ -17,6 +21,43 @@ def iter_images(root):
                 yield os.path.join(dp, fn)
 
 
+def _abs_path(path: str) -> str:
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(__file__), path)
+
+
+def _read_index_paths(index_path: str) -> list:
+    paths = []
+    with open(index_path, "r", encoding="utf-8") as f:
+        r = csv.reader(f)
+        next(r, None)
+        for row in r:
+            if row:
+                paths.append(row[0])
+    return paths
+
+
+def pack_gallery(feats_path: str, index_path: str, out_bin: str, images_root: str, weights_path: str = "") -> None:
+    """把 gallery_features.npy + gallery_index.csv 打包成单文件 .idx（路径转为相对 images_root）。"""
+    feats = np.load(feats_path, mmap_mode="r", allow_pickle=False)
+    paths = _read_index_paths(index_path)
+    n = min(len(paths), int(feats.shape[0]))
+    root = os.path.abspath(images_root)
+    rel = []
+    for p in paths[:n]:
+        if os.path.isabs(p):
+            try:
+                p = os.path.relpath(p, start=root)
+            except ValueError:
+                p = os.path.basename(p)
+        rel.append(p)
+
+    t0 = time.time()
+    h = write_gallery_file(out_bin, feats[:n], rel, fingerprint=model_fingerprint(weights_path), normalize=True)
+    print(f"Packed {out_bin} count={h.count} dim={h.dim} fingerprint={h.fingerprint or '-'} time={time.time()-t0:.1f}s", flush=True)
+
+
 def build_gallery(
     images_root: str,
     weights_path: str = "vit-dinov2-base.npz",
@@ -26,6 +67,7 @@ def build_gallery(
     max_images: int = 0,
     resume: bool = True,
     log_every: int = 200,
+    out_bin: str = "",
 ) -> None:
     base_dir = os.path.dirname(__file__)
 
@@ -45,6 +87,10 @@ def build_gallery(
     if not os.path.isabs(out_index_abs):
         out_index_abs = os.path.join(base_dir, out_index_abs)
 
+    out_bin_abs = out_bin
+    if out_bin_abs and not os.path.isabs(out_bin_abs):
+        out_bin_abs = os.path.join(base_dir, out_bin_abs)
+
     weights = np.load(weights_abs)
     vit = Dinov2Numpy(weights)
 
@@ -56,12 +102,7 @@ def build_gallery(
     old_feats = None
     if resume and os.path.exists(out_index_abs) and os.path.exists(out_feats_abs):
         try:
-            with open(out_index_abs, "r", encoding="utf-8") as f:
-                r = csv.reader(f)
-                next(r, None)
-                for row in r:
-                    if row:
-                        processed.add(row[0])
+            processed = set(_read_index_paths(out_index_abs))
             old_feats = np.load(out_feats_abs)
         except Exception:
             processed = set()
@@ -84,6 +125,8 @@ def build_gallery(
 
     if total == 0:
         print("Nothing to do.", flush=True)
+        if out_bin_abs and os.path.exists(out_feats_abs) and os.path.exists(out_index_abs):
+            pack_gallery(out_feats_abs, out_index_abs, out_bin_abs, images_root_abs, weights_abs)
         return
 
     if log_every <= 0:
@@ -153,6 +196,9 @@ def build_gallery(
 
     print(f"Done. new={len(paths_all)} total_feats={feats.shape} failures={failures} time={time.time()-t0:.1f}s", flush=True)
 
+    if out_bin_abs:
+        pack_gallery(out_feats_abs, out_index_abs, out_bin_abs, images_root_abs, weights_abs)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Build gallery features from an image folder")
@@ -164,8 +210,20 @@ def main():
     parser.add_argument("--out_index", type=str, default="gallery_index.csv")
     parser.add_argument("--weights", type=str, default="vit-dinov2-base.npz")
     parser.add_argument("--log_every", type=int, default=200, help="Print progress every N images")
+    parser.add_argument("--out_bin", type=str, default="", help="Also write a single-file gallery index (.idx)")
+    parser.add_argument("--pack_only", action="store_true", help="Only pack existing --out_feats/--out_index into --out_bin")
     args = parser.parse_args()
 
+    if args.pack_only:
+        pack_gallery(
+            _abs_path(args.out_feats),
+            _abs_path(args.out_index),
+            _abs_path(args.out_bin or "gallery.idx"),
+            _abs_path(args.images_root),
+            _abs_path(args.weights),
+        )
+        return
+
     build_gallery(
         images_root=args.images_root,
         weights_path=args.weights,
@@ -175,6 +233,7 @@ def main():
         max_images=args.max_images,
         resume=(not args.no_resume),
         log_every=args.log_every,
+        out_bin=args.out_bin,
     )
 
 
@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "XImageSearch"))
+from image_search.gallery_format import write_ivf_index, write_ivf_table  # noqa: E402
+from image_search.search_engine import SearchEngine  # noqa: E402
+
+
+def _abs(path: str) -> str:
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(__file__), path)
+
+
+def _l2norm(x: np.ndarray) -> np.ndarray:
+    return x / (np.linalg.norm(x, axis=-1, keepdims=True) + 1e-12)
+
+
+def _assign(feats, centroids: np.ndarray, chunk_rows: int = 65536) -> np.ndarray:
+    """每行分到内积最大的聚类中心（向量均已归一化，即余弦最近），分块进行。"""
+    n = int(feats.shape[0])
+    out = np.empty((n,), dtype=np.int32)
+    for i in range(0, n, chunk_rows):
+        x = np.asarray(feats[i:i + chunk_rows], dtype=np.float32)
+        out[i:i + x.shape[0]] = np.argmax(x @ centroids.T, axis=1)
+    return out
+
+
+def train_ivf(feats, nlist: int, iters: int = 20, sample: int = 100000, seed: int = 0) -> np.ndarray:
+    """在采样行上做球面 k-means（中心每轮重新归一化），返回 (nlist, dim) float32 聚类中心。"""
+    n = int(feats.shape[0])
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(n, size=min(max(sample, nlist), n), replace=False))
+    x = np.asarray(feats[idx], dtype=np.float32)
+    centroids = x[rng.choice(x.shape[0], size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=nlist)
+        # 空簇重新随机取一个样本，避免中心退化
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = x[rng.choice(x.shape[0], size=int(empty.sum()), replace=False)]
+        centroids = _l2norm(sums).astype(np.float32)
+    return centroids
+
+
+def build_ivf(engine: SearchEngine, out_path: str, nlist: int = 0, iters: int = 20, sample: int = 100000,
+              chunk_rows: int = 65536) -> tuple:
+    """
+    在 engine 的检索空间（已归一化、已 PCA）上训练 IVF，写成 gallery_format 的 IVF 文件（不含调参表）。
+    nlist=0 时取 4 * sqrt(N)。
+    """
+    if engine.features is None:
+        raise RuntimeError(f"Gallery not loaded: {engine.last_error}")
+    feats = engine.features
+    n = int(feats.shape[0])
+    nlist = int(nlist) if nlist > 0 else max(1, int(4 * np.sqrt(n)))
+    nlist = min(nlist, n)
+
+    centroids = train_ivf(feats, nlist, iters=iters, sample=sample)
+    assign = _assign(feats, centroids, chunk_rows)
+    order = np.argsort(assign, kind="stable")
+    lists = np.zeros((nlist + 1,), dtype=np.int64)
+    lists[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+
+    def blocks():
+        for i in range(0, n, chunk_rows):
+            rows = order[i:i + chunk_rows]
+            yield rows.astype(np.int32), np.asarray(feats[rows], dtype=np.float32)
+
+    write_ivf_index(out_path, centroids, lists, blocks(), tag=engine.knn_tag(engine._gallery))
+    return n, nlist
+
+
+def _percentile_ms(times: list, p: float) -> float:
+    return float(np.percentile(np.asarray(times), p) * 1000.0)
+
+
+def tune_ivf(engine: SearchEngine, k: int = 10, queries: int = 500, nprobes=None, reranks=(1, 2, 4, 8), seed: int = 0):
+    """
+    用图库自身采样的行做 query，对 (nprobe, rerank) 网格测 recall@k（对照精确 feats @ q）和单 query 延迟，
+    返回只保留 Pareto 前沿的调参表；精确扫描本身作为 nprobe=0 的点一并参与比较。
+    rerank 以 k 的倍数给出。engine 需以 ivf_path 打开该索引（不设目标，不影响这里直接指定参数）。
+    """
+    g = engine._gallery
+    if g.ivf is None:
+        raise RuntimeError(f"ANN index not loaded: {g.error or engine.last_error}")
+    n = int(g.features.shape[0])
+    k = max(1, min(int(k), n))
+    rng = np.random.default_rng(seed)
+    qidx = np.sort(rng.choice(n, size=min(queries, n), replace=False))
+    Q = np.asarray(g.features[qidx], dtype=np.float32)
+
+    exact_ids, times = [], []
+    for q in Q:
+        t0 = time.perf_counter()
+        _, ids = engine._scan_topk(g, q[None, :], k)
+        times.append(time.perf_counter() - t0)
+        exact_ids.append(set(ids[0].tolist()))
+    points = [{"nprobe": 0, "rerank": 0, "recall": 1.0,
+               "p50_ms": _percentile_ms(times, 50), "p95_ms": _percentile_ms(times, 95)}]
+
+    if not nprobes:
+        nprobes = [p for p in (1, 2, 4, 8, 16, 32, 64, 128, 256) if p <= g.ivf.nlist]
+    for nprobe in nprobes:
+        for mult in reranks:
+            rerank = int(mult) * k
+            hits, times = 0, []
+            for q, truth in zip(Q, exact_ids):
+                t0 = time.perf_counter()
+                _, ids = engine._ivf_topk(g, q[None, :], k, nprobe, rerank)
+                times.append(time.perf_counter() - t0)
+                hits += len(truth.intersection(ids[0].tolist()))
+            points.append({"nprobe": int(nprobe), "rerank": rerank, "recall": hits / float(k * len(exact_ids)),
+                           "p50_ms": _percentile_ms(times, 50), "p95_ms": _percentile_ms(times, 95)})
+            print(f"  nprobe={nprobe:<4d} rerank={rerank:<5d} recall={points[-1]['recall']:.4f} "
+                  f"p95={points[-1]['p95_ms']:.2f}ms", flush=True)
+
+    # Pareto 前沿：按 p95 升序，只保留召回严格更高的点
+    front, best = [], -1.0
+    for p in sorted(points, key=lambda p: (p["p95_ms"], -p["recall"])):
+        if p["recall"] > best:
+            front.append(p)
+            best = p["recall"]
+    return {"k": k, "queries": int(len(qidx)), "points": front}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an IVF ANN index for the gallery and tune nprobe/rerank")
+    parser.add_argument("--feats", type=str, default="gallery_features.npy")
+    parser.add_argument("--index", type=str, default="gallery_index.csv")
+    parser.add_argument("--bin", type=str, default="", help="Single-file gallery (.idx); takes precedence over --feats/--index")
+    parser.add_argument("--pca", type=str, default="", help="gallery_pca.npz used by the web app, if any")
+    parser.add_argument("--images_root", type=str, default="", help="Gallery root (to make CSV paths relative like the web app)")
+    parser.add_argument("--out", type=str, default="gallery_ivf.bin")
+    parser.add_argument("--nlist", type=int, default=0, help="Number of inverted lists (0 = 4 * sqrt(N))")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--sample", type=int, default=100000, help="Rows sampled for k-means training")
+    parser.add_argument("--tune_only", action="store_true", help="Keep the existing index, only re-run the tuner")
+    parser.add_argument("--k", type=int, default=10, help="recall@k measured by the tuner")
+    parser.add_argument("--queries", type=int, default=500, help="Gallery rows sampled as tuner queries")
+    parser.add_argument("--nprobes", type=str, default="", help="Comma-separated nprobe grid (default: powers of 2)")
+    parser.add_argument("--reranks", type=str, default="1,2,4,8", help="Comma-separated re-rank depths, in multiples of k")
+    parser.add_argument("--threads", type=int, default=1, help="Search thread budget (0 = CPU count)")
+    args = parser.parse_args()
+
+    out = _abs(args.out)
+    # 与 Web 端用同样的参数加载图库，保证行号和检索空间一致（IVF 文件头里的 tag 会校验）
+    kwargs = dict(
+        gallery_root=_abs(args.images_root) or None,
+        pca_path=_abs(args.pca) or None,
+        gallery_file_path=_abs(args.bin) or None,
+        search_threads=args.threads,
+    )
+    t0 = time.time()
+    if not args.tune_only:
+        engine = SearchEngine(_abs(args.feats), _abs(args.index), **kwargs)
+        n, nlist = build_ivf(engine, out, nlist=args.nlist, iters=args.iters, sample=args.sample)
+        print(f"Built {out} rows={n} nlist={nlist} time={time.time()-t0:.1f}s", flush=True)
+        del engine
+
+    engine = SearchEngine(_abs(args.feats), _abs(args.index), ivf_path=out, **kwargs)
+    nprobes = [int(x) for x in args.nprobes.split(",") if x.strip()]
+    reranks = [int(x) for x in args.reranks.split(",") if x.strip()]
+    table = tune_ivf(engine, k=args.k, queries=args.queries, nprobes=nprobes, reranks=reranks)
+    engine.close()
+    del engine
+    write_ivf_table(out, table)
+
+    print("Pareto table (nprobe=0 is the exact scan):")
+    for p in table["points"]:
+        print(f"  nprobe={p['nprobe']:<4d} rerank={p['rerank']:<5d} recall@{table['k']}={p['recall']:.4f} "
+              f"p50={p['p50_ms']:.2f}ms p95={p['p95_ms']:.2f}ms")
+    print(f"Done. size={os.path.getsize(out)/1e6:.1f}MB time={time.time()-t0:.1f}s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
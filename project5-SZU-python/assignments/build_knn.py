@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "XImageSearch"))
+from image_search.gallery_format import write_knn_graph  # noqa: E402
+from image_search.search_engine import SearchEngine  # noqa: E402
+
+
+def _abs(path: str) -> str:
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(__file__), path)
+
+
+def build_knn(engine: SearchEngine, out_path: str, k: int = 50, batch_rows: int = 1024) -> tuple:
+    """
+    为 base 图库每一行预计算 k 个最近邻（int32 行号 + float16 分数），写成 gallery_format 的 kNN 文件。
+
+    图库行本身就是 query（已在检索空间），按 batch_rows 分块做 GEMM + TopK，不跑任何 embedding；
+    输出按块写入 memmap，内存只占一个块的相似度矩阵。
+    """
+    if engine.features is None:
+        raise RuntimeError(f"Gallery not loaded: {engine.last_error}")
+    n = int(engine.features.shape[0])
+    k = min(int(k), n - 1)
+    if k <= 0:
+        raise ValueError("gallery needs at least 2 rows")
+
+    def blocks():
+        t0 = time.time()
+        for lo in range(0, n, batch_rows):
+            hi = min(lo + batch_rows, n)
+            ids, scores = engine.exact_neighbors(lo, hi, k)
+            yield ids.astype("int32"), scores.astype("float16")
+            print(f"  rows {hi}/{n}  {time.time()-t0:.1f}s", flush=True)
+
+    write_knn_graph(out_path, n, k, blocks(), tag=engine.knn_tag(engine._gallery))
+    return n, k
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute each gallery item's top-K neighbors for 'more like this'")
+    parser.add_argument("--feats", type=str, default="gallery_features.npy")
+    parser.add_argument("--index", type=str, default="gallery_index.csv")
+    parser.add_argument("--bin", type=str, default="", help="Single-file gallery (.idx); takes precedence over --feats/--index")
+    parser.add_argument("--pca", type=str, default="", help="gallery_pca.npz used by the web app, if any")
+    parser.add_argument("--images_root", type=str, default="", help="Gallery root (to make CSV paths relative like the web app)")
+    parser.add_argument("--out", type=str, default="gallery_knn.bin")
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--batch_rows", type=int, default=1024)
+    parser.add_argument("--threads", type=int, default=1, help="Search thread budget (0 = CPU count)")
+    args = parser.parse_args()
+
+    # 与 Web 端用同样的参数加载图库，保证行号、路径和检索空间一致（kNN 文件头里的 tag 会校验）
+    engine = SearchEngine(
+        _abs(args.feats),
+        _abs(args.index),
+        gallery_root=_abs(args.images_root) or None,
+        pca_path=_abs(args.pca) or None,
+        gallery_file_path=_abs(args.bin) or None,
+        search_threads=args.threads,
+    )
+    t0 = time.time()
+    n, k = build_knn(engine, _abs(args.out), k=args.k, batch_rows=args.batch_rows)
+    size = os.path.getsize(_abs(args.out))
+    print(f"Done. wrote {_abs(args.out)} rows={n} k={k} size={size/1e6:.1f}MB time={time.time()-t0:.1f}s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
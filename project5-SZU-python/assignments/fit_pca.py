@@ -0,0 +1,145 @@
+import os
+import time
+import argparse
+
+import numpy as np
+
+
+def _abs(path: str) -> str:
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(__file__), path)
+
+
+def _l2norm(x: np.ndarray) -> np.ndarray:
+    x = x.astype(np.float32, copy=False)
+    return x / (np.linalg.norm(x, axis=-1, keepdims=True) + 1e-12)
+
+
+def fit_pca(feats: np.ndarray, dim: int = 256, whiten_power: float = 0.5, chunk_rows: int = 65536):
+    """
+    在 L2 归一化后的 gallery 特征上拟合 PCA/whitening。
+
+    返回 (mean, proj, eigvals, explained)，投影为 y = (x - mean) @ proj，proj 形状 (D, dim)。
+    whiten_power: 0=纯 PCA，1=完全白化，0.5 为折中（低方差方向不会被过度放大）
+    """
+    n, d = int(feats.shape[0]), int(feats.shape[1])
+    if dim <= 0 or dim > d:
+        raise ValueError(f"dim must be in [1, {d}], got {dim}")
+
+    # 分块累加一阶/二阶矩，避免一次性把 (N,D) 转成 float64
+    s1 = np.zeros((d,), dtype=np.float64)
+    s2 = np.zeros((d, d), dtype=np.float64)
+    for i in range(0, n, chunk_rows):
+        x = _l2norm(np.asarray(feats[i:i + chunk_rows], dtype=np.float32)).astype(np.float64)
+        s1 += x.sum(axis=0)
+        s2 += x.T @ x
+
+    mean = s1 / n
+    cov = s2 / n - np.outer(mean, mean)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    total = float(np.maximum(eigvals, 0).sum()) + 1e-12
+    order = np.argsort(eigvals)[::-1][:dim]
+    eigvals = np.maximum(eigvals[order], 1e-12)
+    proj = eigvecs[:, order]
+    if whiten_power:
+        proj = proj / (eigvals ** (0.5 * whiten_power))[None, :]
+
+    explained = float(eigvals.sum()) / total
+    return mean.astype(np.float32), proj.astype(np.float32), eigvals.astype(np.float32), explained
+
+
+def apply_pca(x: np.ndarray, mean: np.ndarray, proj: np.ndarray) -> np.ndarray:
+    return _l2norm((_l2norm(x) - mean) @ proj)
+
+
+def _merge_topk(best_s, best_i, sims, offset, k):
+    """把一个分块的相似度并入每行的 running Top-K（best_s/best_i 形状 (Q,k)）。"""
+    kk = min(k, sims.shape[1])
+    part = np.argpartition(-sims, kth=kk - 1, axis=1)[:, :kk]
+    cand_s = np.concatenate([best_s, np.take_along_axis(sims, part, axis=1)], axis=1)
+    cand_i = np.concatenate([best_i, part + offset], axis=1)
+    keep = np.argpartition(-cand_s, kth=k - 1, axis=1)[:, :k]
+    return np.take_along_axis(cand_s, keep, axis=1), np.take_along_axis(cand_i, keep, axis=1)
+
+
+def eval_overlap(feats, mean, proj, queries: int = 500, topk: int = 10, seed: int = 0, chunk_rows: int = 65536) -> dict:
+    """用 gallery 自身采样作为 query，统计降维前后 Top-K 的重合率和打分耗时（分块扫描，内存有界）。"""
+    n = int(feats.shape[0])
+    topk = max(1, min(topk, n))
+    rng = np.random.default_rng(seed)
+    qidx = np.sort(rng.choice(n, size=min(queries, n), replace=False))
+
+    q_full = _l2norm(np.asarray(feats[qidx], dtype=np.float32))
+    q_red = apply_pca(q_full, mean, proj)
+
+    nq = int(qidx.shape[0])
+    bf_s = np.full((nq, topk), -np.inf, dtype=np.float32)
+    bf_i = np.full((nq, topk), -1, dtype=np.int64)
+    br_s, br_i = bf_s.copy(), bf_i.copy()
+    t_full = t_red = 0.0
+
+    for off in range(0, n, chunk_rows):
+        full = _l2norm(np.asarray(feats[off:off + chunk_rows], dtype=np.float32))
+        red = apply_pca(full, mean, proj)
+
+        t0 = time.perf_counter()
+        bf_s, bf_i = _merge_topk(bf_s, bf_i, q_full @ full.T, off, topk)
+        t_full += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        br_s, br_i = _merge_topk(br_s, br_i, q_red @ red.T, off, topk)
+        t_red += time.perf_counter() - t0
+
+    overlaps = [len(np.intersect1d(a, b)) / float(topk) for a, b in zip(bf_i, br_i)]
+    return {
+        "queries": nq,
+        "topk": topk,
+        "overlap_mean": float(np.mean(overlaps)),
+        "overlap_min": float(np.min(overlaps)),
+        "time_full_s": t_full,
+        "time_reduced_s": t_red,
+        "bytes_full": int(n * feats.shape[1] * 4),
+        "bytes_reduced": int(n * proj.shape[1] * 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit PCA/whitening over gallery features and report Top-K overlap")
+    parser.add_argument("--feats", type=str, default="gallery_features.npy")
+    parser.add_argument("--out", type=str, default="", help="Output .npz (default: gallery_pca.npz next to --feats)")
+    parser.add_argument("--dim", type=int, default=256, help="Target dimension, e.g. 128 or 256")
+    parser.add_argument("--whiten_power", type=float, default=0.5, help="0=plain PCA, 1=full whitening")
+    parser.add_argument("--eval_only", action="store_true", help="Load --out and only report overlap")
+    parser.add_argument("--eval_queries", type=int, default=500, help="Sampled gallery queries for the report (0=skip)")
+    parser.add_argument("--eval_topk", type=int, default=10)
+    args = parser.parse_args()
+
+    feats_abs = _abs(args.feats)
+    out_abs = _abs(args.out) if args.out else os.path.join(os.path.dirname(feats_abs), "gallery_pca.npz")
+
+    feats = np.load(feats_abs, mmap_mode="r", allow_pickle=False)
+    print(f"Loaded {feats_abs} shape={feats.shape}", flush=True)
+
+    if args.eval_only:
+        with np.load(out_abs, allow_pickle=False) as z:
+            mean, proj = z["mean"], z["proj"]
+    else:
+        t0 = time.time()
+        mean, proj, eigvals, explained = fit_pca(feats, dim=args.dim, whiten_power=args.whiten_power)
+        np.savez(out_abs, mean=mean, proj=proj, eigvals=eigvals, whiten_power=np.float32(args.whiten_power))
+        print(f"Saved {out_abs} dim={proj.shape[1]} whiten_power={args.whiten_power} time={time.time()-t0:.1f}s", flush=True)
+        print(f"explained_variance={explained:.4f}", flush=True)
+
+    if args.eval_queries > 0:
+        r = eval_overlap(feats, mean, proj, queries=args.eval_queries, topk=args.eval_topk)
+        print(
+            f"overlap@{r['topk']} mean={r['overlap_mean']:.4f} min={r['overlap_min']:.4f} "
+            f"queries={r['queries']} gemm_full={r['time_full_s']*1000:.1f}ms gemm_reduced={r['time_reduced_s']*1000:.1f}ms "
+            f"mem_full={r['bytes_full']/1e6:.1f}MB mem_reduced={r['bytes_reduced']/1e6:.1f}MB",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
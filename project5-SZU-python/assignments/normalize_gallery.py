@@ -0,0 +1,67 @@
+import os
+import time
+import argparse
+
+import numpy as np
+
+
+def _abs(path: str) -> str:
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(__file__), path)
+
+
+def normalize_gallery(src: str, dst: str, pca_path: str = "", chunk_rows: int = 65536) -> tuple:
+    """
+    把 gallery 特征转换为“检索空间”格式：float32、C 连续、按行 L2 归一化（可选先做 PCA 投影）。
+
+    Web 端检测到这种文件会直接 mmap 分块扫描，不再把整个矩阵复制进内存。
+    转换本身也是分块进行的（输入 mmap 读，输出 open_memmap 写），可以处理大于内存的图库。
+    """
+    feats = np.load(src, mmap_mode="r", allow_pickle=False)
+    if feats.ndim != 2 or feats.shape[0] <= 0:
+        raise ValueError(f"bad gallery_features shape: {feats.shape}")
+
+    mean = proj = None
+    if pca_path:
+        with np.load(pca_path, allow_pickle=False) as z:
+            mean = np.asarray(z["mean"], dtype=np.float32)
+            proj = np.asarray(z["proj"], dtype=np.float32)
+
+    n = int(feats.shape[0])
+    dim = int(proj.shape[1]) if proj is not None else int(feats.shape[1])
+
+    tmp = dst + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(n, dim))
+    for i in range(0, n, chunk_rows):
+        x = np.asarray(feats[i:i + chunk_rows], dtype=np.float32)
+        x = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+        if proj is not None:
+            x = (x - mean) @ proj
+            x = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+        out[i:i + x.shape[0]] = x
+    out.flush()
+    del out, feats  # Windows 上替换前必须先关闭 mmap
+
+    # 先写临时文件再原子替换，正在运行的 worker 不会读到写了一半的文件
+    os.replace(tmp, dst)
+    return n, dim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a pre-normalized (optionally PCA-projected) gallery for mmap search")
+    parser.add_argument("--feats", type=str, default="gallery_features.npy")
+    parser.add_argument("--out", type=str, default="", help="Output .npy (default: overwrite --feats in place)")
+    parser.add_argument("--pca", type=str, default="", help="Optional gallery_pca.npz to bake into the output")
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    args = parser.parse_args()
+
+    src = _abs(args.feats)
+    dst = _abs(args.out) if args.out else src
+    t0 = time.time()
+    n, dim = normalize_gallery(src, dst, pca_path=_abs(args.pca) if args.pca else "", chunk_rows=args.chunk_rows)
+    print(f"Done. wrote {dst} shape=({n}, {dim}) time={time.time()-t0:.1f}s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,46 @@
-import csv
+import os
 import sys
+import argparse
 import numpy as np
 from dinov2_numpy import Dinov2Numpy
 from preprocess_image import resize_short_side
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "XImageSearch"))
+from image_search.search_engine import SearchEngine  # noqa: E402
 
-def load_gallery():
-    feats = np.load("gallery_features.npy")  # (N, 768)
-    paths = []
-    with open("gallery_index.csv", "r", encoding="utf-8") as f:
-        r = csv.reader(f)
-        next(r, None)
-        for row in r:
-            if row:
-                paths.append(row[0])
-    return feats, paths
 
-
-def cosine_sim(a: np.ndarray, b: np.ndarray) -> np.ndarray:
-    a = a / (np.linalg.norm(a, axis=-1, keepdims=True) + 1e-8)
-    b = b / (np.linalg.norm(b, axis=-1, keepdims=True) + 1e-8)
-    return a @ b.T
+def embed_images(vit, paths, batch_size: int = 8) -> np.ndarray:
+    feats = []
+    for i in range(0, len(paths), batch_size):
+        X = np.concatenate([resize_short_side(p, target_size=224) for p in paths[i:i + batch_size]], axis=0)
+        feats.append(vit(X).astype(np.float32, copy=False))  # (B, 768)
+    return np.concatenate(feats, axis=0)
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python search_image.py <query_image_path>")
+    parser = argparse.ArgumentParser(description="Search the gallery with one or more query images")
+    parser.add_argument("queries", nargs="+", help="Query image path(s)")
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--feats", type=str, default="gallery_features.npy")
+    parser.add_argument("--index", type=str, default="gallery_index.csv")
+    parser.add_argument("--weights", type=str, default="vit-dinov2-base.npz")
+    args = parser.parse_args()
+
+    weights = np.load(args.weights)
+    vit = Dinov2Numpy(weights)
+    Q = embed_images(vit, args.queries, batch_size=args.batch_size)  # (B, 768)
+
+    # search_batch 会做 L2 归一化，并在配置了 PCA 时自动投影
+    engine = SearchEngine(args.feats, args.index)
+    if engine.features is None:
+        print(f"Gallery not loaded: {engine.last_error}")
         return
-    qpath = sys.argv[1]
 
-    weights = np.load("vit-dinov2-base.npz")
-    vit = Dinov2Numpy(weights)
-    qx = resize_short_side(qpath, target_size=224)
-    qf = vit(qx)[None]  # (1, 768)
-
-    feats, paths = load_gallery()
-    sims = cosine_sim(qf, feats)[0]
-    idx = np.argsort(-sims)[:10]
-    print("Top-10 similar images:")
-    for i in idx:
-        print(paths[i], float(sims[i]))
+    for qpath, results in zip(args.queries, engine.search_batch(Q, topk=args.topk)):
+        print(f"Top-{args.topk} similar images for {qpath}:")
+        for r in results:
+            print(engine.paths[r.index], r.score)
 
 
 if __name__ == "__main__":